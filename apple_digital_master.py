@@ -7,12 +7,9 @@ https://www.apple.com/apple-music/apple-digital-masters/
 Only works on macOS because it uses afconvert.
 """
 
-import os
 import argparse
 from pathlib import Path
-from shlex import quote
-from queue import Queue
-from utils import av, common, logger
+from utils import av, common, logger, proc
 
 LOGGER: logger.Logger
 
@@ -22,38 +19,36 @@ def is_valid_audio_file(path: Path) -> bool:
     return path.suffix.lower() in [str('.flac'), str('.wav')]
 
 
-def convert(p_queue: Queue, delete_orig: bool):
-    """Convert thread"""
-
-    while p_queue.empty() is False:
-        infile: Path = p_queue.get()
-
-        # Create wav file
-        wavfile = infile.with_suffix(".wav")
-        infos = av.get_file_infos(infile)
-        sr = "44100" if "44100" in infos else "48000"
-        cmd_wav = f"afconvert {quote(str(infile))} {quote(str(wavfile))} -d LEI24@{sr} --quality 127 -r 127 --src-complexity bats -f WAVE"
-        LOGGER.log(f"{common.COLOR_WHITE}[$] {common.COLOR_PURPLE}{cmd_wav}")
-        os.system(cmd_wav)
-        if wavfile.exists() is True:
-            # Create caf file
-            caffile = infile.with_suffix(".caf")
-            cmd_caf = f"afconvert {quote(str(wavfile))} {quote(str(caffile))} -d 0 -f caff --soundcheck-generate"
+def convert(infile: Path, delete_orig: bool):
+    """Convert job"""
+    # Create wav file
+    wavfile = infile.with_suffix(".wav")
+    audio_streams = av.probe(infile).streams_of_type("audio")
+    # Resample to 44.1kHz for the 44.1kHz family, 48kHz otherwise
+    rate = audio_streams[0].sample_rate if audio_streams else None
+    sr = "44100" if rate is not None and rate % 44100 == 0 else "48000"
+    cmd_wav = ["afconvert", infile, wavfile, "-d", f"LEI24@{sr}", "--quality", "127", "-r", "127", "--src-complexity", "bats", "-f", "WAVE"]
+    LOGGER.log(f"{common.COLOR_WHITE}[$] {common.COLOR_PURPLE}{proc.describe(cmd_wav)}")
+    ok = proc.check(proc.run(cmd_wav, capture=False))
+    if wavfile.exists() is True:
+        # Create caf file
+        caffile = infile.with_suffix(".caf")
+        cmd_caf = ["afconvert", wavfile, caffile, "-d", "0", "-f", "caff", "--soundcheck-generate"]
+        LOGGER.log(
+            f"{common.COLOR_WHITE}[$] {common.COLOR_PURPLE}{proc.describe(cmd_caf)}")
+        ok = ok is True and proc.check(proc.run(cmd_caf, capture=False)) is True
+        if caffile.exists() is True:
+            # Create aac file
+            outfile = infile.with_suffix(".m4a")
+            cmd_aac = ["afconvert", caffile, "-d", "aac", "-f", "m4af", "-u", "pgcm", "2", "--soundcheck-read", "-b", "256000", "-q", "127", "-s", "2", outfile]
             LOGGER.log(
-                f"{common.COLOR_WHITE}[$] {common.COLOR_PURPLE}{cmd_caf}")
-            os.system(cmd_caf)
-            if caffile.exists() is True:
-                # Create aac file
-                outfile = infile.with_suffix(".m4a")
-                cmd_aac = f"afconvert {quote(str(caffile))} -d aac -f m4af -u pgcm 2 --soundcheck-read -b 256000 -q 127 -s 2 {quote(str(outfile))}"
-                LOGGER.log(
-                    f"{common.COLOR_WHITE}[$] {common.COLOR_PURPLE}{cmd_aac}")
-                os.system(cmd_aac)
-                caffile.unlink()
-                if delete_orig is True:
-                    infile.unlink()
-            wavfile.unlink()
-        p_queue.task_done()
+                f"{common.COLOR_WHITE}[$] {common.COLOR_PURPLE}{proc.describe(cmd_aac)}")
+            ok = ok is True and proc.check(proc.run(cmd_aac, capture=False)) is True
+            caffile.unlink()
+            # The original is only removed if every step succeeded
+            if delete_orig is True and ok is True:
+                infile.unlink()
+        wavfile.unlink()
 
 
 if __name__ == "__main__":
@@ -68,13 +63,13 @@ if __name__ == "__main__":
     LOGGER = logger.Logger(args.verbose)
 
     # Sanity checks
-    common.ensure_exist(["afconvert"])
+    common.ensure_exist(["afconvert", "ffprobe"])
     if args.input.exists() is False:
         common.abort(parser.format_help())
 
     # Get a list of files
     files = common.list_directory(args.input.resolve(), is_valid_audio_file)
-    queue = common.as_queue(files)
 
     # Convert
-    common.parallel(convert, (queue, args.delete,))
+    results, _ = common.run_jobs(convert, files, (args.delete,))
+    common.print_failures(results)
@@ -7,13 +7,10 @@ Convert an audio file or directory of audio files to the highest quality in the
 ex: audio_convert.py -fmt aac /path/to/file/or/dir
 """
 
-import os
 import argparse
 from pathlib import Path
 from typing import List, Dict
-from shlex import quote
-from queue import Queue
-from utils import av, common, logger
+from utils import av, common, journal, logger, proc
 
 LOGGER: logger.Logger
 
@@ -73,53 +70,60 @@ def is_valid_output_format(fmt: str) -> bool:
     return fmt in SUPPORTED_OUTPUT_TYPES
 
 
-def convert(p_queue: Queue, fmt: str, sr: str, bd: str, ext: str, delete: bool):
-    """Convert thread"""
-    ffmpeg_options = '-y -hide_banner -loglevel quiet -vn -c:a '
+def ffmpeg_options_for(fmt: str, sr: str, bd: str) -> List[str]:
+    """Returns the ffmpeg encoding options for `fmt`"""
+    ffmpeg_options = ['-y', '-hide_banner', '-loglevel', 'quiet', '-vn', '-c:a']
     if fmt == 'alac':
-        ffmpeg_options += 'alac'
+        ffmpeg_options += ['alac']
     elif fmt == 'flac':
-        ffmpeg_options += 'flac -compression_level 12'
+        ffmpeg_options += ['flac', '-compression_level', '12']
     elif fmt == 'aac':
-        ffmpeg_options += f'libfdk_aac -vbr 5 -movflags +faststart'
+        ffmpeg_options += ['libfdk_aac', '-vbr', '5', '-movflags', '+faststart']
     elif fmt == 'mp3':
-        ffmpeg_options += 'libmp3lame -q:a 0'
+        ffmpeg_options += ['libmp3lame', '-q:a', '0']
     elif fmt == 'ac3':
-        ffmpeg_options += 'ac3'
+        ffmpeg_options += ['ac3']
     elif fmt == 'opus':
-        ffmpeg_options += 'libopus -compression_level 10 -vbr on'
+        ffmpeg_options += ['libopus', '-compression_level', '10', '-vbr', 'on']
     elif fmt == 'vorbis':
-        ffmpeg_options += 'libvorbis -qscale:a 10'
+        ffmpeg_options += ['libvorbis', '-qscale:a', '10']
     else:
         raise "Error."
 
     if sr is not None:
-        ffmpeg_options += f" -ar {sr}"
+        ffmpeg_options += ['-ar', sr]
 
     if bd is not None:
-        ffmpeg_options += f" -sample_fmt {BIT_DEPTH_MAP[bd]}"
-
-    out_extension = SUPPORTED_OUTPUT_TYPES[fmt]
-    if ext is not None:
-        out_extension = ext.lower()
-        if out_extension.startswith('.') is False:
-            out_extension = f".{out_extension}"
-
-    while p_queue.empty() is False:
-        infile: Path = p_queue.get()
-        if infile.suffix == out_extension:
-            LOGGER.log(f"{common.COLOR_WHITE}[+] No conversion needed for {common.COLOR_YELLOW}{infile}{common.COLOR_WHITE}")
-            p_queue.task_done()
-            continue
-        outfile = infile.with_suffix(out_extension)
-        cmd = f"ffmpeg -i {quote(str(infile))} {ffmpeg_options} {quote(str(outfile))}"
-        LOGGER.log(f"{common.COLOR_WHITE}[+] Converting {common.COLOR_YELLOW}{infile}{common.COLOR_WHITE} with {common.COLOR_PURPLE}{cmd}{common.COLOR_WHITE}")
-        os.system(cmd)
-        if delete is True:
-            LOGGER.log(f"{common.COLOR_WHITE}[+] Removing {common.COLOR_YELLOW}{infile}{common.COLOR_WHITE}")
-            infile.unlink()
-        p_queue.task_done()
-
+        ffmpeg_options += ['-sample_fmt', BIT_DEPTH_MAP[bd]]
+    return ffmpeg_options
+
+
+def convert(infile: Path, ffmpeg_options: List[str], out_extension: str, delete: bool, jrnl: journal.Journal) -> int:
+    """Convert job, returns ffmpeg exit status"""
+    if infile.suffix == out_extension:
+        LOGGER.log(f"{common.COLOR_WHITE}[+] No conversion needed for {common.COLOR_YELLOW}{infile}{common.COLOR_WHITE}")
+        return 0
+    outfile = infile.with_suffix(out_extension)
+    if jrnl.is_done(infile) is False:
+        # ffmpeg writes to a temporary file so an interrupted run never leaves a truncated output
+        tmpfile = outfile.with_name(f".{outfile.stem}.part{out_extension}")
+        cmd = ["ffmpeg", "-i", infile] + ffmpeg_options + [tmpfile]
+        LOGGER.log(f"{common.COLOR_WHITE}[+] Converting {common.COLOR_YELLOW}{infile}{common.COLOR_WHITE} with {common.COLOR_PURPLE}{proc.describe(cmd)}{common.COLOR_WHITE}")
+        jrnl.start(infile, [tmpfile])
+        status = proc.run(cmd, capture=False).returncode
+        if status != 0:
+            if tmpfile.exists() is True:
+                tmpfile.unlink()
+            jrnl.failed(infile, f"exit status {status}")
+            return status
+        tmpfile.replace(outfile)
+        jrnl.done(infile, outfile)
+    else:
+        LOGGER.log(f"{common.COLOR_WHITE}[+] {common.COLOR_YELLOW}{infile}{common.COLOR_WHITE} already converted")
+    if delete is True:
+        LOGGER.log(f"{common.COLOR_WHITE}[+] Removing {common.COLOR_YELLOW}{infile}{common.COLOR_WHITE}")
+        infile.unlink()
+    return 0
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -130,6 +134,7 @@ if __name__ == "__main__":
     parser.add_argument("-b", "--bit-depth", dest="bit_depth", type=str, help="Bit depth between 8, 16, 24, 32")
     parser.add_argument("-e", "--extension", dest="extension", type=str, help="Overwrite default output file extension (ex: for aac, .aac instead of .m4a)")
     parser.add_argument("-d", "--delete", dest="delete", action="store_true", help="Delete original file after conversion")
+    parser.add_argument("-r", "--redo", dest="redo", action="store_true", help="Convert again the files an earlier run already converted, default: false")
     args = parser.parse_args()
     LOGGER = logger.Logger(args.verbose)
 
@@ -154,9 +159,19 @@ if __name__ == "__main__":
         formats = "\n- ".join(sorted(SUPPORTED_OUTPUT_TYPES.keys()))
         common.abort(f"{common.COLOR_RED}[!] ERROR: Invalid format {common.COLOR_WHITE}{out_format}\n{common.COLOR_YELLOW}[+] Available formats:\n- {formats}")
 
-    # Get a list of files
-    files = common.walk_directory(args.input.resolve(), is_valid_audio_file)
-    queue = common.as_queue(files)
+    out_extension = SUPPORTED_OUTPUT_TYPES[out_format]
+    if args.extension is not None:
+        out_extension = args.extension.lower()
+        if out_extension.startswith('.') is False:
+            out_extension = f".{out_extension}"
 
-    # Convert
-    common.parallel(convert, (queue, out_format, args.samplerate, args.bit_depth, args.extension, args.delete,))
+    # Convert files as soon as the scan finds them
+    files = common.scan_directory(args.input.resolve(), lambda x: is_valid_audio_file(x.path))
+    options = ffmpeg_options_for(out_format, args.samplerate, args.bit_depth)
+    # Resume an interrupted run
+    jrnl = journal.Journal("audio_convert", [options, out_extension], args.redo)
+    recovered = jrnl.recover()
+    if recovered > 0:
+        LOGGER.log(f"{common.COLOR_WHITE}[+] Cleaned {recovered} interrupted conversion{'s' if recovered != 1 else ''}")
+    results, _ = common.run_jobs(convert, (x.path for x in files), (options, out_extension, args.delete, jrnl,))
+    common.print_failures(results)
@@ -3,78 +3,71 @@
 
 """
 Extract all audio streams of a given movie or directory of movies
-[!] ffmpeg must be installed and in your $PATH
+[!] ffmpeg and ffprobe must be installed and in your $PATH
 ex: extract_audio.py /path/to/movies/
 """
 
-import os
-import re
 import argparse
 from pathlib import Path
-from queue import Queue
-from collections import namedtuple
-from shlex import quote
-from utils import av, common, logger
+from utils import av, common, logger, probecache, proc
 
 LOGGER: logger.Logger
 
-AudioStreamInfo = namedtuple('AudioStreamInfo', ['id', 'infos', 'title'])
-
-
-def get_audio_streams(infos: str):
-    """Parse `ffmpeg -i` output to grab only audio streams"""
-    z = re.findall(r'Stream\s\#0:(\d+).*?Audio:\s*(.*?(?:\((default)\))?)\s*?(?:\(forced\))?\r?\n(?:\s*Metadata:\s*\r?\n\s*title\s*:\s*(.*?)\r?\n)?', infos)
-    return [AudioStreamInfo(int(x[0]), x[1].strip(), x[2]) for x in z]
-
-
-def extension_for_audio_info(audio_type: str) -> str:
-    """Returns the extension for a given audio info from `ffmpeg -i`"""
-    maps = {
-        'aac': '.m4a',
-        'ac3': '.ac3',
-        'dts': '.dts',
-        'flac': '.flac',
-        'pcm_': '.wav',
-        'true': '.thd',
-        'alac': '.m4a',
-        'opus': '.opus',
-    }
-
-    def sanitize_type(x: str) -> str:
-        """Clean extension"""
-        return maps[x] if x in maps else x
-    return sanitize_type(audio_type[:4].strip().replace(",", "").lower())
-
-
-def extract_audio(p_queue: Queue):
-    """Extract thread"""
-    while p_queue.empty() is False:
-        infile: Path = p_queue.get()
-        infos = av.get_file_infos(infile)
-        streams = get_audio_streams(infos)
-        for audio_stream in streams:
-            outfile = f"{str(infile)}.{audio_stream.id}{extension_for_audio_info(audio_stream.infos)}"
-            cmd = f"ffmpeg -i {quote(str(infile))} -v quiet -map 0:{audio_stream.id} -c copy {quote(outfile)}"
-            LOGGER.log(f"{common.COLOR_WHITE}[+] Extracting track {audio_stream.id} from {common.COLOR_YELLOW}{infile} with {common.COLOR_PURPLE}{cmd}{common.COLOR_WHITE}")
-            os.system(cmd)
-        p_queue.task_done()
+AUDIO_EXTENSIONS_MAP = {
+    'aac': '.m4a',
+    'ac3': '.ac3',
+    'alac': '.m4a',
+    'dts': '.dts',
+    'eac3': '.eac3',
+    'flac': '.flac',
+    'mp2': '.mp2',
+    'mp3': '.mp3',
+    'opus': '.opus',
+    'truehd': '.thd',
+    'vorbis': '.ogg',
+}
+
+
+def extension_for_audio_stream(stream: av.Stream) -> str:
+    """Returns the extension for a given ffprobe audio stream"""
+    if stream.codec_name.startswith("pcm_"):
+        return ".wav"
+    return AUDIO_EXTENSIONS_MAP.get(stream.codec_name, f".{stream.codec_name}")
+
+
+def extract_audio(infile: Path) -> int:
+    """Extract job, returns the first non-zero ffmpeg exit status"""
+    infos = av.probe(infile)
+    status = 0
+    for audio_stream in infos.streams_of_type("audio"):
+        outfile = f"{str(infile)}.{audio_stream.index}{extension_for_audio_stream(audio_stream)}"
+        cmd = ["ffmpeg", "-i", infile, "-v", "quiet", "-map", f"0:{audio_stream.index}", "-c", "copy", outfile]
+        LOGGER.log(f"{common.COLOR_WHITE}[+] Extracting track {audio_stream.index} from {common.COLOR_YELLOW}{infile} with {common.COLOR_PURPLE}{proc.describe(cmd)}{common.COLOR_WHITE}")
+        res = proc.run(cmd, capture=False)
+        if status == 0:
+            status = res.returncode
+    return status
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("input", type=Path, help="Path to directory or single video file")
     parser.add_argument("-v", "--verbose", dest="verbose", action="store_true", help="Verbose mode")
+    parser.add_argument("--no-cache", dest="no_cache", action="store_true", help="Do not use the probe cache")
     args = parser.parse_args()
     LOGGER = logger.Logger(args.verbose)
 
+    if args.no_cache is True:
+        probecache.disable()
+
     # Sanity checks
-    common.ensure_exist(["ffmpeg"])
+    common.ensure_exist(["ffmpeg", "ffprobe"])
     if args.input.exists() is False:
         common.abort(parser.format_help())
 
     # Get a list of files
     files = common.list_directory(args.input.resolve())
-    queue = common.as_queue(files)
 
     # Extract
-    common.parallel(extract_audio, (queue,))
+    results, _ = common.run_jobs(extract_audio, files)
+    common.print_failures(results)
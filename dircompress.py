@@ -2,13 +2,20 @@
 # coding: utf-8
 
 import argparse
-import os
 from pathlib import Path
-from shlex import quote
-from utils import common, io
+from utils import common, io, proc
 
 BIN7Z = "7zz"
 
+
+def compress(a_dir: Path) -> int:
+    """Compress job, returns 7zz exit status"""
+    # 7z a -t7z -m0=lzma2 -mx=9 -mfb=64 -md=32m -ms=on "asstraffic.7z" AssTraffic
+    filename = str(a_dir)
+    print(f"file = {filename}")
+    # 2 threads per archive, as declared in utils.resources
+    return proc.run([BIN7Z, "a", "-t7z", "-m0=lzma2", "-mx=9", "-mfb=64", "-md=32m", "-ms=on", "-mmt=2", f"{filename}.7z", filename], capture=False).returncode
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("input", type=Path, help="Path to directory")
@@ -19,8 +26,6 @@ if __name__ == "__main__":
     # Get files list
     all_directories = common.list_directory(Path("."))
 
-    for a_dir in all_directories:
-        # 7z a -t7z -m0=lzma2 -mx=9 -mfb=64 -md=32m -ms=on "asstraffic.7z" AssTraffic
-        filename = quote(str(a_dir))
-        print(f"file = {filename}")
-        os.system(f"{BIN7Z} a -t7z -m0=lzma2 -mx=9 -mfb=64 -md=32m -ms=on {filename}.7z {filename}")
+    # Directories are compressed in parallel, 7zz jobs start only when there is enough free memory
+    results, _ = common.run_jobs(compress, all_directories)
+    common.print_failures(results)
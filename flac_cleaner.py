@@ -3,65 +3,35 @@
 
 """
 Strip useless metadata in flac files
-[!] flac must be installed and in your $PATH
 ex: flac_cleaner.py -src /path/to/files
 """
 
-import os
 import argparse
 from pathlib import Path
-from queue import Queue
-from shlex import quote
-from threading import Lock
 from typing import List
-from utils import common, logger
+from utils import common, flac, logger
 
-LOCK = Lock()
 LOGGER: logger.Logger
 
 TAGS_TO_REMOVE = ['45B1D925-1448-5784-B4DA-B89901050A13', '8E90F26B-372A-5C8B-BB05-1EC0F36EE60C', '93A74BEA-CE97-5571-A56A-C5084DBA9873', 'ACCURATERIPDISCID', 'ACCURATERIPRESULT', 'ACOUSTID ID', 'ALBUMARTISTSORT', 'ALBUMARTIST_CREDIT', 'ALBUMSORT', 'ALLDISCCOUNT', 'ALLTRACKCOUNT', 'ARRANGED', 'ARTISTSORT', 'ARTIST_CREDIT', 'AccurateRipDiscID', 'AccurateRipResult', 'Acoustid Id', 'BAND', 'BE242671-3D48-5AC8-B762-7D2DB4F584B8', 'BPM', 'CATALOG', 'CATALOG NUMBER', 'CATALOGID', 'COMMENT', 'COMPOSER', 'COMPOSERSORT', 'CONTENTGROUP', 'COPYRIGHT', 'Catalog', 'Comment', 'DESCRIPTION', 'DJMIXER', 'ENCODEDBY', 'ENCODER', 'GROUPING', 'INITIALKEY', 'ITUNES_CDDB_1', 'ITUNNORM', 'LYRICS', 'MCN', 'MUSICBRAINZ ALBUM ARTIST ID', 'MUSICBRAINZ ALBUM ID', 'MUSICBRAINZ ALBUM RELEASE COUNTRY', 'MUSICBRAINZ ALBUM STATUS', 'MUSICBRAINZ ALBUM TYPE', 'MUSICBRAINZ ARTIST ID', 'MUSICBRAINZ RELEASE GROUP ID', 'MUSICBRAINZ RELEASE TRACK ID', 'MUSICBRAINZ TRACK ID', 'MusicBrainz Album Artist Id', 'MusicBrainz Album Id', 'MusicBrainz Album Release Country', 'MusicBrainz Album Status', 'MusicBrainz Album Type', 'MusicBrainz Artist Id', 'MusicBrainz Release Group Id', 'MusicBrainz Release Track Id', 'MusicBrainz Track Id', 'NOTES', 'ORGANIZATION', 'ORIGARTIST', 'ORIGINAL RELEASE DATE', 'ORIGINAL YEAR', 'ORIGINTYPE', 'OST', 'Organization', 'R128_ALBUM_GAIN', 'R128_TRACK_GAIN', 'RATING', 'RCALBUMID', 'RCARTISTID', 'RCMUSICID', 'REMIXEDBY', 'REMIXER', 'RIPPER', 'Release Type', 'Retail Date', 'Rip Date', 'Ripping Tool', 'STYLE', 'SUPPLIER', 'Source', 'TBPM', 'TDOR', 'TIPL', 'TITLESORT', 'TITLESORTEN', 'TMED', 'TORY', 'TSO2', 'TSRC', 'UPC', 'URL', 'account_id', 'artist-sort', 'be242671-3d48-5ac8-b762-7d2db4f584b8', 'compilation', 'composer', 'copyright', 'encoder', 'iTunNORM', 'iTunes_CDDB_1', 'iTunes_CDDB_TrackNumber', 'id3v2_priv.AverageLevel', 'id3v2_priv.PeakValue', 'id3v2_priv.ZuneCollectionID', 'lyrics-', 'lyrics-XXX', 'major_brand', 'media_type', 'minor_version', 'publisher', 'purchase_date', 'rating', 'sort_album', 'sort_album_artist', 'sort_artist', "musicbrainz_albumstatus", "musicbrainz_albumcomment", "musicbrainz_albumtype", 'DISC', 'DISCC', 'track', 'trackc', 'ALBUM ARTIST', 'year']
 
 
-def get_tags(flac_file: str) -> List[str]:
-    """return list of tags for `flac_file`"""
-    metaflac = f"metaflac --export-tags-to=- {quote(flac_file)}"
-    data = common.system_call(metaflac).decode('utf-8')
-    lines = data.split("\n")
-    return list(filter(lambda x: "=" in x, lines))
+def list_tags(flac_file: Path) -> List[str]:
+    """Get tags job"""
+    return [name for name, _ in flac.FlacFile(flac_file).tags()]
 
 
-def list_tags(p_queue: Queue, all_tags: List[str]):
-    """Get tags thread"""
-    while p_queue.empty() is False:
-        flac_file: Path = p_queue.get()
-        sflac = str(flac_file)
-        tags = get_tags(sflac)
-        t = list(map(lambda x: x.split("=")[0], tags))
-        LOCK.acquire()
-        all_tags.extend(t)
-        LOCK.release()
-        p_queue.task_done()
-
-
-def remove_tags_cmd() -> str:
-    """generate metaflac command"""
-    metaflac = "metaflac --dont-use-padding"
-    for tag in TAGS_TO_REMOVE:
-        metaflac += f" --remove-tag='{tag}'"
-    return metaflac
-
-
-def clean_flac(p_queue: Queue, metaflac: str, only_blocks: bool):
-    """Clean thread"""
-    while p_queue.empty() is False:
-        flac_file: Path = p_queue.get()
-        sflac = str(flac_file)
-        LOGGER.log(f"{common.COLOR_WHITE}[+] Cleaning {common.COLOR_YELLOW}{sflac}{common.COLOR_WHITE}")
-        if only_blocks is False:
-            os.system(f'{metaflac} {quote(sflac)}')
-        # Remove picture if any, padding, seektable
-        os.system(f"metaflac --dont-use-padding --remove --block-type=PADDING,PICTURE,SEEKTABLE {quote(sflac)}")
-        p_queue.task_done()
+def clean_flac(flac_file: Path, only_blocks: bool, use_padding: bool) -> int:
+    """Clean job, tags and blocks are removed in a single write (in place if the freed space is kept as padding), errors are raised to the job pool"""
+    sflac = str(flac_file)
+    LOGGER.log(f"{common.COLOR_WHITE}[+] Cleaning {common.COLOR_YELLOW}{sflac}{common.COLOR_WHITE}")
+    f = flac.FlacFile(flac_file)
+    if only_blocks is False:
+        f.remove_tags(TAGS_TO_REMOVE)
+    # Remove picture if any, padding, seektable
+    f.remove_blocks([flac.BLOCK_PADDING, flac.BLOCK_PICTURE, flac.BLOCK_SEEKTABLE])
+    f.save(use_padding=use_padding)
+    return 0
 
 
 if __name__ == "__main__":
@@ -69,25 +39,25 @@ if __name__ == "__main__":
     parser.add_argument("input", type=Path, help="Path to directory or single FLAC file")
     parser.add_argument("-v", "--verbose", dest="verbose", action="store_true", help="Verbose mode")
     parser.add_argument("-b", "--only-blocks", dest="only_blocks", action="store_true", help="Only remove PADDING, PICTURE and SEEKTABLE blocks")
+    parser.add_argument("-d", "--dont-use-padding", dest="dont_use_padding", action="store_true", help="Drop the padding instead of keeping the freed space as padding, the whole file is then rewritten, default: false")
     parser.add_argument("-l", "--list-tags", dest="list_tags", action="store_true", help="Get a list of all tags across all files")
     args = parser.parse_args()
     LOGGER = logger.Logger(args.verbose)
 
     # Sanity checks
-    common.ensure_exist(["metaflac"])
     if args.input.exists() is False:
         common.abort(parser.format_help())
 
-    # Get files list
-    files = common.walk_directory(args.input.resolve(), lambda x: x.suffix == ".flac")
-    queue = common.as_queue(files)
-    LOGGER.log(f"{common.COLOR_WHITE}[+] {len(files)} file{'s' if len(files) != 1 else ''} to consider")
+    # Files are processed as soon as the scan finds them
+    files = (x.path for x in common.scan_directory(args.input.resolve(), lambda x: x.path.suffix == ".flac"))
 
     if args.list_tags is True:
-        tags = []
-        common.parallel(list_tags, (queue, tags,))
+        results, _ = common.run_jobs(list_tags, files)
+        common.print_failures(results)
+        tags = [tag for res in results if res.value is not None for tag in res.value]
         print(f"----\n{sorted(set(tags))}\n----")
     else:
         # Clean
-        metaflac_cmd = remove_tags_cmd()
-        common.parallel(clean_flac, (queue, metaflac_cmd, args.only_blocks,))
+        results, _ = common.run_jobs(clean_flac, files, (args.only_blocks, args.dont_use_padding is False,))
+        common.print_failures(results)
+    LOGGER.log(f"{common.COLOR_WHITE}[+] {len(results)} file{'s' if len(results) != 1 else ''} processed")
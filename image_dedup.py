@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+Find near duplicate images (re-encoded, resized or slightly edited copies) with perceptual hashes
+and report them, or hardlink the duplicates to the best copy of each group
+"""
+
+import argparse
+import os
+import shlex
+from pathlib import Path
+from typing import Dict
+from PIL import Image  # pip3 install Pillow
+from utils import common, imagehash, logger, optimcache, sniff
+
+LOGGER: logger.Logger
+
+
+def pixels(path: Path) -> int:
+    """Number of pixels of the image at `path`, 0 if unreadable"""
+    try:
+        with Image.open(path) as img:
+            return img.width * img.height
+    except OSError:
+        return 0
+
+
+def rank(path: Path) -> tuple:
+    """Order of the copies to keep: the largest image, then the smallest file"""
+    return -pixels(path), path.stat().st_size, str(path)
+
+
+def hardlink(original: Path, duplicate: Path):
+    """Atomically replace `duplicate` by a hardlink to `original`"""
+    tmp = duplicate.with_name(f".{duplicate.name}.link")
+    os.link(original, tmp)
+    os.replace(tmp, duplicate)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input", type=Path, help="Path to directory")
+    parser.add_argument("-v", "--verbose", dest="verbose", action="store_true", help="Verbose mode, default: false")
+    parser.add_argument("-a", "--algorithm", dest="algorithm", type=str, choices=[imagehash.ALGO_DHASH, imagehash.ALGO_PHASH], default=imagehash.ALGO_PHASH, help="Perceptual hash, default: phash")
+    parser.add_argument("-d", "--distance", dest="distance", type=int, default=6, help="Maximum Hamming distance (out of 64 bits) between duplicates, default: 6")
+    parser.add_argument("-p", "--plan", dest="plan", action="store_true", help="Print the hardlink commands instead of the report, default: false")
+    parser.add_argument("-l", "--link", dest="link", action="store_true", help="Replace the duplicates by hardlinks to the copy kept, default: false")
+    parser.add_argument("-s", "--link-similar", dest="link_similar", action="store_true", help="With --link or --plan, also replace the duplicates which are not byte identical to the copy kept, default: false")
+    parser.add_argument("-n", "--no-cache", dest="no_cache", action="store_true", help="Hash all the images again instead of using the cached hashes, default: false")
+    parser.add_argument("-t", "--threads", dest="threads", type=int, default=0, help="Number of decoding processes, default: number of CPUs")
+    args = parser.parse_args()
+    LOGGER = logger.Logger(args.verbose)
+
+    files = [x.path for x in common.scan_directory(args.input.resolve(), sniff.filter_for([sniff.TYPE_JPEG, sniff.TYPE_PNG]))]
+    LOGGER.log(f"{common.COLOR_WHITE}[+] Hashing {len(files)} images…")
+    hashes, failures = imagehash.hash_files(files, args.no_cache is False, args.threads)
+    common.print_failures(failures)
+
+    values: Dict[Path, int] = {path: x[args.algorithm] for path, x in hashes.items()}
+    # Every duplicate is within the distance of the copy kept, the first of its group
+    groups = imagehash.duplicate_groups(values, args.distance, rank)
+    LOGGER.log(f"{common.COLOR_WHITE}[+] {len(groups)} group{'s' if len(groups) != 1 else ''} of duplicates")
+
+    total = 0
+    for group in groups:
+        original, duplicates = group[0], group[1:]
+        digest = None
+        if args.plan is True:
+            print(f"# {original}")
+        else:
+            print(f"{common.COLOR_GREEN}{original}{common.COLOR_WHITE}")
+        for dup in duplicates:
+            size = dup.stat().st_size
+            distance = imagehash.hamming(values[original], values[dup])
+            if args.plan is False:
+                print(f"  {common.COLOR_YELLOW}{dup}{common.COLOR_WHITE} (distance {distance}, {size} bytes)")
+            if original.stat().st_dev != dup.stat().st_dev:
+                LOGGER.log(f"{common.COLOR_WHITE}[!] {common.COLOR_YELLOW}{dup}{common.COLOR_RED} is on another filesystem, cannot hardlink{common.COLOR_WHITE}")
+                continue
+            if sniff.classify(dup) != sniff.classify(original):
+                # A hardlink would leave an image under the wrong extension
+                LOGGER.log(f"{common.COLOR_WHITE}[!] {common.COLOR_YELLOW}{dup}{common.COLOR_RED} is in another format, not linked{common.COLOR_WHITE}")
+                continue
+            if args.link_similar is False:
+                # Only similar, linking would lose its pixels
+                identical = size == original.stat().st_size
+                if identical is True:
+                    if digest is None:
+                        digest = optimcache.hash_file(original)
+                    identical = optimcache.hash_file(dup) == digest
+                if identical is False:
+                    LOGGER.log(f"{common.COLOR_WHITE}[!] {common.COLOR_YELLOW}{dup}{common.COLOR_RED} is not identical, not linked without --link-similar{common.COLOR_WHITE}")
+                    continue
+            total += size
+            if args.plan is True:
+                print(f"ln -f -- {shlex.quote(str(original))} {shlex.quote(str(dup))}")
+            if args.link is True:
+                hardlink(original, dup)
+    LOGGER.log(f"{common.COLOR_WHITE}[+] {common.COLOR_GREEN}{total} bytes ({total / 1048576:4.2f}Mb){common.COLOR_WHITE} {'freed' if args.link is True else 'can be freed'} by hardlinking the duplicates")
@@ -6,15 +6,13 @@ Optimize jpeg files
 """
 
 from __future__ import division
-import os
 import argparse
 import multiprocessing
+import shutil
 import threading
 from pathlib import Path
-from queue import Queue
-from shlex import quote
-from typing import List
-from utils import common, io, logger
+from typing import List, Tuple
+from utils import cbz, common, journal, jpeg, jxl, logger, metastrip, optimcache, optimstats, proc, resources, sniff
 
 LOGGER: logger.Logger
 O_SUBSAMPLE = str("subsample")
@@ -22,99 +20,257 @@ O_JPEGTRAN = str("jpegtran")
 O_GUETZLI = str("guetzli")
 
 
-def is_420_subsampled(path: Path) -> bool:
-    """Check if the jpeg file at `path` is 420"""
-    ch = common.system_call(f"identify -format %[jpeg:sampling-factor] {quote(str(path))}").decode("utf-8").strip().lower()
-    return '2x2,1x1,1x1' in ch
-
-
-def command_for_filter(program: str, infile: Path, outfile: Path, keep_metadata: bool) -> str:
-    """returns the command corresponding to `program`"""
+def command_for_filter(program: str, keep_metadata: bool) -> List[str]:
+    """returns the command corresponding to `program`, reading the jpeg on stdin and writing the result on stdout"""
     if program == O_SUBSAMPLE:
-        return f"magick {quote(str(infile))} -sampling-factor '2x2,1x1,1x1' {quote(str(outfile))}"
+        return ["magick", "jpg:-", "-sampling-factor", "2x2,1x1,1x1", "jpg:-"]
     if program == O_GUETZLI:
-        return f"guetzli --nomemlimit --quality 84{' --keep-exif' if keep_metadata is True else ''} {quote(str(infile))} {quote(str(outfile))}"
+        return ["guetzli", "--nomemlimit", "--quality", "84"] + (["--keep-exif"] if keep_metadata is True else []) + ["-", "-"]
     if program == O_JPEGTRAN:
-        return f"jpegtran -optimize -copy {'all' if keep_metadata is True else 'none'} -progressive -outfile {quote(str(outfile))} {quote(str(infile))}"
+        return ["jpegtran", "-optimize", "-copy", "all" if keep_metadata is True else "none", "-progressive"]
     return None
 
 
-def th_optimize(p_queue: Queue, all_programs: List[str], keep_metadata: bool):
-    """Optimization thread"""
-    while p_queue.empty() is False:
-        original_file: Path = p_queue.get()
-        last_processed_file = original_file
-        for prg in all_programs:
-            if prg == O_SUBSAMPLE and is_420_subsampled(original_file) is True:
-                # Already subsampled, skip to next filter
-                LOGGER.log(f"{common.COLOR_WHITE}(th_{threading.current_thread().name})[-] {common.COLOR_YELLOW}{original_file}{common.COLOR_WHITE} is already subsampled, skipping…")
-                continue
-
-            outfile = original_file.with_name(f"{original_file.stem}.{prg}.jpg")
-            cmd = command_for_filter(prg, last_processed_file, outfile, keep_metadata)
-            if cmd is None:
-                LOGGER.log(f"{common.COLOR_WHITE}(th_{threading.current_thread().name})[!] {common.COLOR_RED}ERROR: No command for {common.COLOR_YELLOW}{prg}{common.COLOR_WHITE}")
-                continue
-            LOGGER.log(f"{common.COLOR_WHITE}(th_{threading.current_thread().name})[$] {common.COLOR_PURPLE}{cmd}")
-            os.system(cmd)
-            if outfile.exists() is True:
-                if outfile.stat().st_size < last_processed_file.stat().st_size:
-                    LOGGER.log(f"{common.COLOR_WHITE}(th_{threading.current_thread().name})[-] {common.COLOR_BLUE}{prg} {common.COLOR_GREEN}successful{common.COLOR_WHITE} for {common.COLOR_YELLOW}{last_processed_file}")
-                    if last_processed_file.samefile(original_file) is False:
-                        LOGGER.log(f"{common.COLOR_WHITE}(th_{threading.current_thread().name})[-] Removing {common.COLOR_YELLOW}{last_processed_file}")
-                        last_processed_file.unlink()
-                    last_processed_file = outfile
-                else:
-                    # new file is same size or bigger than previous
-                    if prg == O_SUBSAMPLE:
-                        last_processed_file = outfile
-                    else:
-                        LOGGER.log(f"{common.COLOR_WHITE}(th_{threading.current_thread().name})[-] {common.COLOR_BLUE}{prg} {common.COLOR_RED}unsuccessful{common.COLOR_WHITE} for {common.COLOR_YELLOW}{last_processed_file}")
-                        outfile.unlink()
+def available_programs(subsample: bool, use_guetzli: bool, use_jpegtran: bool) -> List[str]:
+    """The requested programs found in $PATH, in the order they run"""
+    programs: List[str] = []
+    if subsample is True and common.which("magick") is not None:
+        programs.append(O_SUBSAMPLE)
+    if use_guetzli is True and common.which("guetzli") is not None:
+        programs.append(O_GUETZLI)
+    if use_jpegtran is True and common.which("jpegtran") is not None:
+        programs.append(O_JPEGTRAN)
+    return programs
+
+
+def cache_chain(all_programs: List[str], keep_metadata: bool) -> str:
+    """Programs and options applied to a file, part of the optimization cache key"""
+    return "\n".join(proc.describe(command_for_filter(prg, keep_metadata)) for prg in all_programs)
+
+
+def write_back(path: Path, data: bytes):
+    """Atomically replace the content of `path`"""
+    tmpfile = path.with_name(f".{path.name}.tmp")
+    with open(tmpfile, "wb") as f:
+        f.write(data)
+    shutil.copymode(path, tmpfile)
+    tmpfile.replace(path)
+
+
+def optimize_file(original_file: Path, infos: jpeg.JpegInfo, all_programs: List[str], keep_metadata: bool, jrnl: journal.Journal, gate: optimstats.Gate, budget: resources.Budget) -> bool:
+    """Pipe `original_file` through the programs one after the other, keeping each output smaller than its input, and write it back once if smaller.
+    Returns False if a program was skipped by the gate, timed out or the budget ran out before all the programs"""
+    original = original_file.read_bytes()
+    current = original
+    previous = gate.store.previous(original_file)
+    complete = True
+    for prg in all_programs:
+        if prg == O_SUBSAMPLE and (infos.is_420() is True or infos.is_grayscale() is True):
+            # Already subsampled (or no chroma), skip to next filter
+            LOGGER.log(f"{common.COLOR_WHITE}({threading.current_thread().name})[-] {common.COLOR_YELLOW}{original_file}{common.COLOR_WHITE} is already subsampled, skipping…")
+            continue
+
+        cmd = command_for_filter(prg, keep_metadata)
+        if cmd is None:
+            LOGGER.log(f"{common.COLOR_WHITE}({threading.current_thread().name})[!] {common.COLOR_RED}ERROR: No command for {common.COLOR_YELLOW}{prg}{common.COLOR_WHITE}")
+            continue
+        features = optimstats.jpeg_features(infos, len(current), previous)
+        if gate.allow(prg, features) is False:
+            LOGGER.log(f"{common.COLOR_WHITE}({threading.current_thread().name})[-] {common.COLOR_BLUE}{prg}{common.COLOR_WHITE} is not worth it for {common.COLOR_YELLOW}{original_file}{common.COLOR_WHITE}, skipping…")
+            # Not fully optimized, neither cached nor done so a run with another threshold still gets to it
+            complete = False
+            continue
+        if budget.exhausted() is True:
+            unreached(original_file, budget)
+            complete = False
+            break
+        LOGGER.log(f"{common.COLOR_WHITE}({threading.current_thread().name})[$] {common.COLOR_PURPLE}{proc.describe(cmd)} < {original_file}")
+        res = proc.run(cmd, stdin=current, timeout=budget.timeout(prg))
+        budget.charge(optimstats.cpu_seconds(res))
+        if res.timed_out is True:
+            LOGGER.log(f"{common.COLOR_WHITE}({threading.current_thread().name})[!] {common.COLOR_BLUE}{prg} {common.COLOR_RED}timed out{common.COLOR_WHITE} for {common.COLOR_YELLOW}{original_file}")
+            # Killed before the end, the file is not done
+            unreached(original_file, budget)
+            complete = False
+        # new data must at least be a jpeg, same size or bigger than previous is discarded (except for the subsampling)
+        valid = res.returncode == 0 and res.stdout.startswith(b"\xFF\xD8") is True
+        gate.store.record(original_file, prg, features, len(current) - len(res.stdout) if valid is True else 0, optimstats.cpu_seconds(res))
+        if valid is True and (len(res.stdout) < len(current) or prg == O_SUBSAMPLE):
+            LOGGER.log(f"{common.COLOR_WHITE}({threading.current_thread().name})[-] {common.COLOR_BLUE}{prg} {common.COLOR_GREEN}successful{common.COLOR_WHITE} for {common.COLOR_YELLOW}{original_file}")
+            current = res.stdout
+            try:
+                infos = jpeg.read_info_bytes(current)
+            except jpeg.JpegError:
+                pass
+        else:
+            LOGGER.log(f"{common.COLOR_WHITE}({threading.current_thread().name})[-] {common.COLOR_BLUE}{prg} {common.COLOR_RED}unsuccessful{common.COLOR_WHITE} for {common.COLOR_YELLOW}{original_file}")
+    if len(current) < len(original):
+        LOGGER.log(f"{common.COLOR_WHITE}({threading.current_thread().name})[-] Writing {common.COLOR_YELLOW}{original_file}")
+        jrnl.start(original_file, [original_file.with_name(f".{original_file.name}.tmp")])
+        write_back(original_file, current)
+    return complete
+
+
+def unreached(original_file: Path, budget: resources.Budget):
+    """`original_file` could not be fully optimized within the budget, the next run starts with it"""
+    LOGGER.log(f"{common.COLOR_WHITE}({threading.current_thread().name})[!] {common.COLOR_YELLOW}{original_file}{common.COLOR_RED} not finished within the budget{common.COLOR_WHITE}")
+    budget.unreached_file(original_file)
+
+
+def strip(original_file: Path, infos: jpeg.JpegInfo, options: metastrip.StripOptions, jrnl: journal.Journal) -> jpeg.JpegInfo:
+    """Remove the metadata segments of `original_file` without re-encoding, returns its new headers"""
+    jrnl.start(original_file, [original_file.with_name(f".{original_file.name}.tmp")])
+    saved = metastrip.strip_jpeg(original_file, infos, options)
+    if saved == 0:
+        return infos
+    LOGGER.log(f"{common.COLOR_WHITE}({threading.current_thread().name})[-] {common.COLOR_BLUE}{saved} bytes{common.COLOR_WHITE} of metadata stripped from {common.COLOR_YELLOW}{original_file}")
+    return jpeg.read_info(original_file)
+
+
+def to_jxl(original_file: Path, options: jxl.JxlOptions, jrnl: journal.Journal, budget: resources.Budget) -> Path:
+    """Transcode `original_file` to JPEG XL, returns the file kept, None if the budget ran out or cjxl timed out"""
+    if budget.exhausted() is True:
+        unreached(original_file, budget)
+        return None
+    jrnl.start(original_file, [original_file.with_name(f".{original_file.stem}.tmp.jxl")])
+    size = original_file.stat().st_size
+    res = jxl.transcode(original_file, True, options.effort, budget.timeout(jxl.BIN_CJXL))
+    budget.charge(res.cpu)
+    if res.timed_out is True:
+        LOGGER.log(f"{common.COLOR_WHITE}({threading.current_thread().name})[!] {common.COLOR_BLUE}jxl {common.COLOR_RED}timed out{common.COLOR_WHITE} for {common.COLOR_YELLOW}{original_file}")
+        unreached(original_file, budget)
+        return None
+    if res.kept is False:
+        LOGGER.log(f"{common.COLOR_WHITE}({threading.current_thread().name})[-] {common.COLOR_BLUE}jxl {common.COLOR_RED}unsuccessful{common.COLOR_WHITE} for {common.COLOR_YELLOW}{original_file}")
+        return original_file
+    encoded = original_file.with_suffix(".jxl")
+    LOGGER.log(f"{common.COLOR_WHITE}({threading.current_thread().name})[-] {common.COLOR_BLUE}jxl {common.COLOR_GREEN}successful{common.COLOR_WHITE}, {common.COLOR_YELLOW}{original_file}{common.COLOR_WHITE} replaced by {common.COLOR_YELLOW}{encoded}")
+    if options.index is not None:
+        options.index.add(original_file, encoded, res.digest, size, True)
+    return encoded
+
+
+def optimize(original_file: Path, all_programs: List[str], keep_metadata: bool, strip_options: metastrip.StripOptions, jxl_options: jxl.JxlOptions, jrnl: journal.Journal, cache: optimcache.OptimCache, gate: optimstats.Gate, budget: resources.Budget) -> Tuple[int, int]:
+    """Optimization job, returns the file size before and after"""
+    original_size = original_file.stat().st_size
+    if jrnl.is_done(original_file) is True:
+        LOGGER.log(f"{common.COLOR_WHITE}({threading.current_thread().name})[-] {common.COLOR_YELLOW}{original_file}{common.COLOR_WHITE} already optimized, skipping…")
+        return original_size, original_size
+    try:
+        infos = jpeg.read_info(original_file)
+    except (jpeg.JpegError, OSError) as e:
+        # None of the programs would be able to read it either
+        LOGGER.log(f"{common.COLOR_WHITE}({threading.current_thread().name})[!] {common.COLOR_YELLOW}{original_file}{common.COLOR_RED} is not a valid jpeg ({e}), skipping…{common.COLOR_WHITE}")
+        return original_size, original_size
+    if strip_options is not None:
+        infos = strip(original_file, infos, strip_options, jrnl)
+    complete = True
+    if all_programs and cache is None:
+        complete = optimize_file(original_file, infos, all_programs, keep_metadata, jrnl, gate, budget)
+    elif all_programs:
+        digest = optimcache.hash_file(original_file)
+        chain = cache_chain(all_programs, keep_metadata)
+        # Identical images are optimized once, the others wait for the result
+        with cache.computing(digest, chain):
+            output = cache.lookup(digest, chain)
+            if output == digest:
+                LOGGER.log(f"{common.COLOR_WHITE}({threading.current_thread().name})[-] {common.COLOR_YELLOW}{original_file}{common.COLOR_WHITE} already optimized (cache), skipping…")
+            elif output is not None and cache.restore(output, original_file) is True:
+                LOGGER.log(f"{common.COLOR_WHITE}({threading.current_thread().name})[-] {common.COLOR_YELLOW}{original_file}{common.COLOR_WHITE} copied from cache")
             else:
-                LOGGER.log(f"{common.COLOR_WHITE}(th_{threading.current_thread().name})[-] {common.COLOR_BLUE}{prg} {common.COLOR_RED}unsuccessful{common.COLOR_WHITE} for {common.COLOR_YELLOW}{last_processed_file}")
-        if last_processed_file.samefile(original_file) is False:
-            LOGGER.log(f"{common.COLOR_WHITE}(th_{threading.current_thread().name})[-] Renaming {common.COLOR_YELLOW}{last_processed_file}{common.COLOR_WHITE} to {common.COLOR_YELLOW}{original_file}")
-            original_file.unlink()
-            last_processed_file.rename(original_file)
-        p_queue.task_done()
+                complete = optimize_file(original_file, infos, all_programs, keep_metadata, jrnl, gate, budget)
+                if complete is True:
+                    cache.store(digest, chain, original_file)
+    final_file = original_file
+    if complete is True and jxl_options is not None:
+        final_file = to_jxl(original_file, jxl_options, jrnl, budget)
+        if final_file is None:
+            complete = False
+            final_file = original_file
+    if complete is False:
+        # Processed again by the next run
+        jrnl.pending(original_file)
+    else:
+        jrnl.done(original_file, final_file if final_file != original_file else None)
+    return original_size, final_file.stat().st_size
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("input", type=Path, help="Path to directory or single JPEG file")
+    parser.add_argument("input", type=Path, help="Path to directory, single JPEG file or CBZ/ZIP archive")
     parser.add_argument("-v", "--verbose", dest="verbose", action="store_true", help="Verbose mode")
     parser.add_argument("-s", "--subsample", dest="subsample", action='store_true', help="Subsample image to 420 if needed, default: false")
-    parser.add_argument("-g", "--guetzli", dest="use_guetzli", action='store_true', help="Use guetzli (very slow and huge memory consumption), default: false")
+    parser.add_argument("-g", "--guetzli", dest="use_guetzli", action='store_true', help="Use guetzli (very slow and huge memory consumption, started only when there is enough free memory), default: false")
     parser.add_argument("-j", "--jpegtran", dest="use_jpegtran", action="store_true", help="Use jpegtran, default: false")
     parser.add_argument("-m", "--keep-metadata", dest="keep_metadata", action='store_true', help="Keep metadata, default: false")
+    parser.add_argument("-x", "--strip", dest="strip", action="store_true", help="Remove the metadata segments (EXIF, XMP, comments…) without re-encoding, before the optimizers if any, default: false")
+    parser.add_argument("-i", "--keep-icc", dest="keep_icc", action="store_true", help="With --strip, keep the ICC profile, default: false")
+    parser.add_argument("--keep-orientation", dest="keep_orientation", action="store_true", help="With --strip, keep the EXIF orientation, default: false")
+    parser.add_argument("-J", "--jxl", dest="jxl", action="store_true", help="Transcode to lossless JPEG XL after the optimizers and replace the original if smaller, the round trip is verified, default: false")
+    parser.add_argument("--jxl-effort", dest="jxl_effort", type=int, default=jxl.DEFAULT_EFFORT, help=f"cjxl effort (1-10), default: {jxl.DEFAULT_EFFORT}")
+    parser.add_argument("--jxl-index", dest="jxl_index", type=Path, default=None, help="JSON index mapping the originals to their JXL, updated at the end of the run, default: none")
     parser.add_argument("-t", "--threads", dest="threads", type=int, default=0, help="Number of files to process simultaneously")
+    parser.add_argument("-r", "--redo", dest="redo", action="store_true", help="Optimize again the files an earlier run already optimized, default: false")
+    parser.add_argument("-n", "--no-cache", dest="no_cache", action="store_true", help="Do not use the optimization cache, default: false")
+    parser.add_argument("-e", "--efficiency", dest="efficiency", type=float, default=0, help="Skip the stages expected to save less than this many bytes per CPU second on a file, learned from previous runs, default: 0 (never skip)")
+    parser.add_argument("-k", "--timeout", dest="timeout", type=float, default=None, help="Kill an optimization program after this many seconds, default: no limit")
+    parser.add_argument("-l", "--stage-timeout", dest="stage_timeouts", action="append", metavar="PROGRAM=SECONDS", help="Time limit of a single program (ex: guetzli=600), overrides --timeout, can be repeated")
+    parser.add_argument("-w", "--wall-budget", dest="wall_budget", type=float, default=None, help="Do not start new programs after this many seconds, default: no limit")
+    parser.add_argument("-u", "--cpu-budget", dest="cpu_budget", type=float, default=None, help="Do not start new programs after this many CPU seconds, default: no limit")
     args = parser.parse_args()
     LOGGER = logger.Logger(args.verbose)
 
-    programs: List[str] = []
-    if args.subsample is True and common.which("identify") is not None and common.which("magick") is not None:
-        programs.append(O_SUBSAMPLE)
-    if args.use_guetzli is True and common.which("guetzli") is not None:
-        programs.append(O_GUETZLI)
-    if args.use_jpegtran is True and common.which("jpegtran") is not None:
-        programs.append(O_JPEGTRAN)
+    programs = available_programs(args.subsample, args.use_guetzli, args.use_jpegtran)
 
     # Sanity checks
-    if len(programs) == 0:
+    if args.jxl is True:
+        common.ensure_exist([jxl.BIN_CJXL, jxl.BIN_DJXL])
+    if len(programs) == 0 and args.strip is False and args.jxl is False:
         common.abort(f"{common.COLOR_WHITE}[!] {common.COLOR_RED}ERROR: No optimization programs specified or found, aborting…")
+    strip_options = metastrip.StripOptions(args.keep_icc, args.keep_orientation) if args.strip is True else None
+    jxl_options = jxl.JxlOptions(args.jxl_effort, jxl.Index(args.jxl_index.resolve()) if args.jxl_index is not None else None) if args.jxl is True else None
 
-    # Get files list
-    files = common.list_directory(args.input.resolve(), lambda x: io.match_signature(x, [b"\xFF\xD8\xFF\xE0", b"\xFF\xD8\xFF\xE1", b"\xFF\xD8\xFF\xE2", b"\xFF\xD8\xFF\xEE", b"\xFF\xD8\xFF\xDB"]), sort=True)
-    queue = common.as_queue(files)
-    total_original_bytes = sum(x.stat().st_size for x in files)
-    LOGGER.log(f"{common.COLOR_WHITE}[+] {len(files)} file{'s' if len(files) != 1 else ''} to optimize ({total_original_bytes / 1048576:4.2f}Mb)")
-    LOGGER.log(f"{common.COLOR_WHITE}[+] Using {common.COLOR_BLUE}{', '.join(programs)}")
+    LOGGER.log(f"{common.COLOR_WHITE}[+] Using {common.COLOR_BLUE}{', '.join((['strip'] if args.strip is True else []) + programs + (['jxl'] if args.jxl is True else []))}")
 
     # Optimize
+    # guetzli memory usage is handled by the admission control of the runner
     max_threads = multiprocessing.cpu_count() if args.threads <= 0 or args.threads > multiprocessing.cpu_count() else args.threads
-    if args.use_guetzli is True and args.threads <= 0:
-        max_threads = int(max_threads / 2)
-    t = common.parallel(fct=th_optimize, args=(queue, programs, args.keep_metadata,), max_threads=max_threads)
-    bytes_saved = total_original_bytes - sum(x.stat().st_size for x in files)
+    proc.configure(max_threads, args.timeout)
+    budget = resources.Budget(args.wall_budget, args.cpu_budget, resources.parse_timeouts(args.stage_timeouts), args.timeout)
+    # Resume an interrupted run
+    params = [programs, args.keep_metadata, strip_options, args.jxl_effort if args.jxl is True else None]
+    jrnl = journal.Journal("jpeg_optim", params, args.redo)
+    jrnl.recover()
+    cache = optimcache.OptimCache() if args.no_cache is False else None
+    gate = optimstats.Gate(optimstats.StatsStore("jpeg_optim"), args.efficiency)
+    path = args.input.resolve()
+    if cbz.is_archive(path) is True:
+        # Members are optimized without extracting the archive, the archive is journaled as a whole
+        if jxl_options is not None:
+            common.abort(f"{common.COLOR_WHITE}[!] {common.COLOR_RED}ERROR: --jxl cannot be used on an archive, aborting…")
+        results, t = [], 0
+        if jrnl.is_done(path) is False:
+            results, t = cbz.optimize_journaled(path, optimize, (programs, args.keep_metadata, strip_options, None, journal.NullJournal(), cache, gate, budget,), [sniff.TYPE_JPEG], (".jpg", ".jpeg"), jrnl, budget, max_threads)
+        else:
+            LOGGER.log(f"{common.COLOR_WHITE}[-] {common.COLOR_YELLOW}{path}{common.COLOR_WHITE} already optimized, skipping…")
+    else:
+        # A single directory, its files in order
+        files = sorted(x.path for x in common.scan_directory(path, sniff.filter_for([sniff.TYPE_JPEG]), recursive=False))
+        if budget.is_limited() is True:
+            # Files left by the previous run first, then the most profitable ones
+            files = optimstats.schedule(list(files), gate.store, programs, optimstats.jpeg_file_features, jrnl.unfinished())
+        results, t = common.run_jobs(optimize, files, (programs, args.keep_metadata, strip_options, jxl_options, jrnl, cache, gate, budget,), max_workers=max_threads)
+    common.print_failures(results)
+    sizes = [res.value for res in results if res.value is not None]
+    total_original_bytes = sum(x[0] for x in sizes)
+    LOGGER.log(f"{common.COLOR_WHITE}[+] {len(results)} file{'s' if len(results) != 1 else ''} processed ({total_original_bytes / 1048576:4.2f}Mb)")
+    bytes_saved = total_original_bytes - sum(x[1] for x in sizes)
     LOGGER.log(f"{common.COLOR_WHITE}[+] {common.COLOR_GREEN if bytes_saved > 0 else common.COLOR_RED}{bytes_saved} bytes saved ({bytes_saved / 1048576:4.2f}Mb) in {t:4.2f}s")
+    if jxl_options is not None and jxl_options.index is not None:
+        jxl_options.index.save()
+    if gate.threshold > 0:
+        LOGGER.log(f"{common.COLOR_WHITE}[+] {gate.summary()}")
+    if budget.unreached:
+        LOGGER.log(f"{common.COLOR_WHITE}[+] {common.COLOR_RED}{len(budget.unreached)} file{'s' if len(budget.unreached) != 1 else ''} not finished within the budget{common.COLOR_WHITE}, the next run starts with them")
+        for f in budget.unreached:
+            print(f)
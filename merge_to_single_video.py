@@ -2,13 +2,11 @@
 # coding: utf-8
 
 import argparse
-import subprocess
 import os
 from datetime import timedelta
-from shlex import quote
 from pathlib import Path
 from typing import List, Dict
-from utils import common
+from utils import common, proc
 
 
 G_FILES_LIST='videos_list.txt'
@@ -22,8 +20,10 @@ def generate_chapters_infos(files: List[Path]) -> List[Dict]:
     chap_number = 1
     chap_start_time = 0
     for vid_file in files:
-        command = f"ffprobe -v quiet -of csv=p=0 -show_entries format=duration {quote(str(vid_file))}"
-        duration_in_microseconds = int((subprocess.run(command, shell=True, capture_output=True, check=False).stdout.decode().strip().replace(".", "")))
+        res = proc.run(["ffprobe", "-v", "quiet", "-of", "csv=p=0", "-show_entries", "format=duration", vid_file])
+        if proc.check(res) is False:
+            common.abort(f"{common.COLOR_RED}[!] ERROR: Cannot read the duration of {common.COLOR_YELLOW}{vid_file}")
+        duration_in_microseconds = int(res.stdout.decode().strip().replace(".", ""))
         chap_end_time = chap_start_time + duration_in_microseconds
         chapters.append({"id": chap_number, "duration": duration_in_microseconds, "start": chap_start_time, "end": chap_end_time, "title": vid_file.stem})
         chap_start_time = chap_end_time + 1
@@ -109,9 +109,9 @@ if __name__ == '__main__':
 
     if args.merge is True:
         if output_format == "mkv":
-            ffmpeg_cmd = f"ffmpeg -y -f concat -safe 0 -i {quote(str(vlname))} -c copy merged.mkv"
-            os.system(ffmpeg_cmd)
-            os.system(f"mkvpropedit --chapters {quote(G_MKV_META_FILE)} merged.mkv")
+            ffmpeg_cmd = ["ffmpeg", "-y", "-f", "concat", "-safe", "0", "-i", vlname, "-c", "copy", "merged.mkv"]
+            if proc.check(proc.run(ffmpeg_cmd, capture=False)) is True:
+                proc.check(proc.run(["mkvpropedit", "--chapters", G_MKV_META_FILE, "merged.mkv"], capture=False))
         else:
-            ffmpeg_cmd = f"ffmpeg -y -f concat -safe 0 -i {quote(str(vlname))} -i {quote(G_FFM_META_FILE)} -map_metadata 1 -c copy merged.mp4"
-            os.system(ffmpeg_cmd)
+            ffmpeg_cmd = ["ffmpeg", "-y", "-f", "concat", "-safe", "0", "-i", vlname, "-i", G_FFM_META_FILE, "-map_metadata", "1", "-c", "copy", "merged.mp4"]
+            proc.check(proc.run(ffmpeg_cmd, capture=False))
@@ -8,12 +8,10 @@ Merge separate video and audio files into a single .mkv file
 ex: merge_video_subs.py -src /path/to/movies/
 """
 
-import os
 import argparse
 from pathlib import Path
-from shlex import quote
 from typing import List
-from utils import av, common
+from utils import av, common, proc
 
 
 def merge_audios(audios: List[Path], vids: List[Path], lang: str, name: str, delete: bool):
@@ -22,9 +20,9 @@ def merge_audios(audios: List[Path], vids: List[Path], lang: str, name: str, del
         audio = audios[idx]
         vid = vids[idx]
         outfile = vid.with_name(str(vid.stem) + ".2.mkv")
-        mkvmerge = f'mkvmerge -o {quote(str(outfile))} {quote(str(vid))} --language 0:{lang} --track-name 0:{quote(name)} {quote(str(audio))}'
-        os.system(mkvmerge)
-        if delete is True:
+        mkvmerge = ["mkvmerge", "-o", outfile, vid, "--language", f"0:{lang}", "--track-name", f"0:{name}", audio]
+        # The originals are only removed once the merge succeeded
+        if proc.check(proc.run(mkvmerge, capture=False)) is True and delete is True:
             audio.unlink()
             vid.unlink()
             outfile.rename(vid)
@@ -36,9 +34,8 @@ def merge2(audios: List[Path], vids: List[Path], delete: bool):
         audio = audios[idx]
         vid = vids[idx]
         outfile = vid.with_name(str(vid.stem) + ".2.mp4")
-        ffmpeg = f'ffmpeg -i {quote(str(vid))} -i {quote(str(audio))} -c:v copy -c:a copy {quote(str(outfile))}'
-        os.system(ffmpeg)
-        if delete is True:
+        ffmpeg = ["ffmpeg", "-i", vid, "-i", audio, "-c:v", "copy", "-c:a", "copy", outfile]
+        if proc.check(proc.run(ffmpeg, capture=False)) is True and delete is True:
             audio.unlink()
             vid.unlink()
             outfile.rename(vid)
@@ -8,12 +8,10 @@ Merge separate videos and subtitles files into a single .mkv file
 ex: merge_video_subs.py --src /path/to/movies/
 """
 
-import os
 import argparse
 from pathlib import Path
-from shlex import quote
 from typing import List
-from utils import av, common
+from utils import av, common, proc
 
 
 def merge_subs(subs: List[Path], vids: List[Path], lang: str, name: str, delete: bool):
@@ -23,9 +21,9 @@ def merge_subs(subs: List[Path], vids: List[Path], lang: str, name: str, delete:
         sub = subs[idx]
         vid = vids[idx]
         outfile = vid.with_name(str(vid.stem) + ".subbed.mkv")
-        mkvmerge = f'mkvmerge -o {quote(str(outfile))} {quote(str(vid))} --language 0:{lang} --track-name 0:{quote(name)} --forced-track 0:{flag_forced} {quote(str(sub))}'
-        os.system(mkvmerge)
-        if delete is True:
+        mkvmerge = ["mkvmerge", "-o", outfile, vid, "--language", f"0:{lang}", "--track-name", f"0:{name}", "--forced-track", f"0:{flag_forced}", sub]
+        # The originals are only removed once the merge succeeded
+        if proc.check(proc.run(mkvmerge, capture=False)) is True and delete is True:
             sub.unlink()
             vid.unlink()
             outfile.rename(vid)
@@ -7,12 +7,10 @@ Add chapters to mkv
 ex: mkv_add_chapters.py --src /path/to/movies/
 """
 
-import os
 import argparse
 from pathlib import Path
-from shlex import quote
 from typing import List
-from utils import common
+from utils import common, proc
 
 
 def merge_chapters(chaps: List[Path], vids: List[Path], delete: bool):
@@ -20,9 +18,8 @@ def merge_chapters(chaps: List[Path], vids: List[Path], delete: bool):
     for idx, _ in enumerate(chaps):
         chap = chaps[idx]
         vid = vids[idx]
-        mkvmerge = f'mkvpropedit --chapters {quote(str(chap))} {quote(str(vid))}'
-        os.system(mkvmerge)
-        if delete is True:
+        mkvmerge = ["mkvpropedit", "--chapters", chap, vid]
+        if proc.check(proc.run(mkvmerge, capture=False)) is True and delete is True:
             chap.unlink()
 
 
@@ -6,11 +6,9 @@ Add attachments to mkv files
 [!] mkvtoolnix must be installed and in your $PATH
 """
 
-import os
 import argparse
 from pathlib import Path
-from shlex import quote
-from utils import common
+from utils import common, proc
 
 
 def add_attachment(mkv: Path, p_attachment: Path):
@@ -25,10 +23,10 @@ def add_attachment(mkv: Path, p_attachment: Path):
         mime = 'image/jpeg'
 
     if mime is not None:
-        cmd = f'mkvpropedit {quote(str(mkv))} --attachment-mime-type {mime} --add-attachment {quote(str(p_attachment))}'
+        cmd = ["mkvpropedit", mkv, "--attachment-mime-type", mime, "--add-attachment", p_attachment]
     else:
-        cmd = f'mkvpropedit {quote(str(mkv))} --add-attachment {quote(str(p_attachment))}'
-    os.system(cmd)
+        cmd = ["mkvpropedit", mkv, "--add-attachment", p_attachment]
+    proc.check(proc.run(cmd, capture=False))
 
 
 if __name__ == "__main__":
@@ -6,12 +6,10 @@ Clear attachments from mkv files
 [!] mkvtoolnix must be installed and in your $PATH
 """
 
-import os
 import argparse
 from pathlib import Path
-from shlex import quote
 from typing import List
-from utils import common
+from utils import common, proc
 from utils import mkvfile
 
 if __name__ == "__main__":
@@ -43,4 +41,4 @@ if __name__ == "__main__":
         # Strip images
         toremove: List[mkvfile.MkvAttachment] = list(filter(lambda x: x.content_type in types, mkv.attachments))
         for attachment in toremove:
-            os.system(f"mkvpropedit {quote(str(f))} --delete-attachment mime-type:{attachment.content_type}")
+            proc.check(proc.run(["mkvpropedit", f, "--delete-attachment", f"mime-type:{attachment.content_type}"], capture=False))
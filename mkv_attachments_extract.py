@@ -7,19 +7,17 @@ Extract all fonts in a given .mkv file or directory of .mkv files
 ex: mkv_attachments_extract.py -src /path/to/file.mkv
 """
 
-import os
 import argparse
 from pathlib import Path
-from shlex import quote
 from typing import List
-from utils import common
+from utils import common, proc
 from utils import mkvfile
 
 
 def extract_attachment(path: Path, p_attachment: mkvfile.MkvAttachment):
     """Extractor function"""
-    cmd = f"mkvextract attachments {quote(str(path))} {p_attachment.id}:{quote(p_attachment.file_name.lower())}"
-    os.system(cmd)
+    cmd = ["mkvextract", "attachments", path, f"{p_attachment.id}:{p_attachment.file_name.lower()}"]
+    proc.check(proc.run(cmd, capture=False))
 
 
 if __name__ == "__main__":
@@ -6,11 +6,9 @@ Fix attachments mime types in mkv files
 [!] mkvtoolnix must be installed and in your $PATH
 """
 
-import os
 import argparse
 from pathlib import Path
-from shlex import quote
-from utils import common
+from utils import common, proc
 from utils import mkvfile
 
 
@@ -23,8 +21,8 @@ def fix_attachment(p_mkv: Path, p_attachment: mkvfile.MkvAttachment):
         mime = 'application/vnd.ms-opentype'
 
     if mime is not None:
-        cmd = f'mkvpropedit {quote(str(p_mkv))} --attachment-mime-type {mime} --update-attachment {p_attachment.id}'
-        os.system(cmd)
+        cmd = ["mkvpropedit", p_mkv, "--attachment-mime-type", mime, "--update-attachment", str(p_attachment.id)]
+        proc.check(proc.run(cmd, capture=False))
 
 
 if __name__ == "__main__":
@@ -5,37 +5,36 @@
 """
 
 import argparse
-from queue import Queue
 from pathlib import Path
-from utils import common
+from utils import common, probecache
 from utils import mkvfile
 
 
-def check_subs(p_queue: Queue):
+def check_subs(original_file: Path):
     """check"""
-    while p_queue.empty() is False:
-        original_file: Path = p_queue.get()
-        try:
-            mkv = mkvfile.MkvFile(original_file)
-            for track in mkv.tracks:
-                if track.codec == "substationalpha":
-                    print(f"{original_file}")
-        except:
-            print(f"ERROR PARSING :::: {original_file}")
-        p_queue.task_done()
+    try:
+        mkv = mkvfile.MkvFile(original_file, exact_codecs=False)
+        for track in mkv.tracks:
+            if track.codec == "substationalpha":
+                print(f"{original_file}")
+    except:
+        print(f"ERROR PARSING :::: {original_file}")
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("input", type=Path, help="Path to directory or single MKV file")
+    parser.add_argument("--no-cache", dest="no_cache", action="store_true", help="Do not use the probe cache")
     args = parser.parse_args()
 
+    if args.no_cache is True:
+        probecache.disable()
+
     # Sanity checks
     common.ensure_exist(["mkvmerge"])
     if args.input.exists() is False:
         common.abort(parser.format_help())
 
     files = common.list_directory(args.input.resolve(), lambda x: x.suffix == ".mkv", True)
-    queue = common.as_queue(files)
 
-    common.parallel(check_subs, (queue,))
+    common.run_jobs(check_subs, files)
@@ -7,13 +7,11 @@ Extract tracks in a given .mkv file
 ex: mkv_explode.py /path/to/file.mkv
 """
 
-import os
 import argparse
 from pathlib import Path
-from shlex import quote
 from typing import List
 from utils import mkvfile
-from utils import common, logger
+from utils import common, logger, proc
 
 LOGGER: logger.Logger
 
@@ -66,7 +64,7 @@ if __name__ == "__main__":
             continue
 
         if track.type == "video":
-            commands[track] = f"{track.id}:{quote(str(mkv.path))}.{track.id}.vid{track.file_extension}"
+            commands[track] = f"{track.id}:{str(mkv.path)}.{track.id}.vid{track.file_extension}"
         else:
             if track.is_commentary():
                 LOGGER.log(f"{common.COLOR_WHITE}[+] Track {track.id}: Commentary, skipping…")
@@ -77,13 +75,13 @@ if __name__ == "__main__":
 
             if track.type == "audio":
                 if track.lang in audio_langs:
-                    commands[track] = f"{track.id}:{quote(str(mkv.path))}.{track.id}.{track.lang}{track.file_extension}"
+                    commands[track] = f"{track.id}:{str(mkv.path)}.{track.id}.{track.lang}{track.file_extension}"
             elif track.type == "subtitles":
                 if track.lang in subtitles_langs and track.codec in subtitles_types:
                     force = ""
                     if track.forced is True:
                         force = "-forced"
-                    commands[track] = f"{track.id}:{quote(str(mkv.path))}.{track.id}.{track.lang}{force}{track.file_extension}"
+                    commands[track] = f"{track.id}:{str(mkv.path)}.{track.id}.{track.lang}{force}{track.file_extension}"
 
     # Find best quality audio track
     for lang in audio_langs:
@@ -101,11 +99,12 @@ if __name__ == "__main__":
                     del commands[track]
             # print("[+] Best track is {}".format(bestTrack))
 
-    mkvextract = f"mkvextract tracks {quote(str(mkv.path))} "
+    mkvextract = ["mkvextract", "tracks", mkv.path]
     for track, arg in commands.items():
-        mkvextract += f"{arg} "
-    LOGGER.log(f"{common.COLOR_PURPLE}{mkvextract}{common.COLOR_WHITE}")
-    os.system(mkvextract)
+        mkvextract.append(arg)
+    LOGGER.log(f"{common.COLOR_PURPLE}{proc.describe(mkvextract)}{common.COLOR_WHITE}")
+    proc.check(proc.run(mkvextract, capture=False))
 
     if mkv.chaptered and args.chapters is True:
-        os.system(f"mkvextract chapters {quote(str(mkv.path))} > {quote(str(args.input))}.chap.xml")
+        with open(f"{str(args.input)}.chap.xml", "wb") as chapters_file:
+            proc.check(proc.run(["mkvextract", "chapters", mkv.path], capture=False, on_stdout=chapters_file.write))
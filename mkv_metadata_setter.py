@@ -7,12 +7,10 @@ Tag a .mkv file or directory of .mkv files
 ex: mkv_metadata_setter.py -src /path/to/file.mkv -vn "Video track" -an "Audio track" -sn "Sub track"
 """
 
-import os
 import argparse
 from pathlib import Path
-from shlex import quote
 from typing import List
-from utils import common
+from utils import common, probecache, proc
 from utils import mkvfile
 
 if __name__ == "__main__":
@@ -25,8 +23,12 @@ if __name__ == "__main__":
     parser.add_argument("-y", "--sub-lang", dest="sub_lang", type=str, default="eng", help="Lang of the subtitles tracks, comma separated")
     parser.add_argument("-z", "--video-lang", dest="video_lang", type=str, default="und", help="Lang of the video track")
     parser.add_argument("-r", "--repl", dest="repl", type=str, default="", help="Pattern to replace for the Title")
+    parser.add_argument("--no-cache", dest="no_cache", action="store_true", help="Do not use the probe cache")
     args = parser.parse_args()
 
+    if args.no_cache is True:
+        probecache.disable()
+
     # Sanity checks
     common.ensure_exist(["mkvpropedit", "mediainfo"])
     if args.input.exists() is False:
@@ -37,11 +39,11 @@ if __name__ == "__main__":
 
     for f in files:
         mkv = mkvfile.MkvFile(f)
-        cmd = f'mkvpropedit {quote(str(f))}'
+        cmd = ["mkvpropedit", f]
         # Handle video track
         vtrack: mkvfile.MkvTrack = list(filter(lambda x: x.type == "video", mkv.tracks))[0]
         vn = f'{args.video_lang.upper()} — {mkv.video_codec_desc()}{" — " + args.video_name if args.video_name is not None else ""}'
-        cmd += f' --edit track:v1 --set language={args.video_lang} --set name={quote(vn)}'
+        cmd += ["--edit", "track:v1", "--set", f"language={args.video_lang}", "--set", f"name={vn}"]
         # Handle audio tracks
         atracks: List[mkvfile.MkvTrack] = list(filter(lambda x: x.type == "audio", mkv.tracks))
         audio_langs = args.audio_lang.split(",")
@@ -63,7 +65,7 @@ if __name__ == "__main__":
                 t = audio_names[tid - 1]
                 if len(t) > 0:
                     an += f' — {t}'
-            cmd += f' --edit track:a{tid} --set language={al} --set name={quote(an)}'
+            cmd += ["--edit", f"track:a{tid}", "--set", f"language={al}", "--set", f"name={an}"]
             tid += 1
         # Handle subtitles tracks
         stracks = list(filter(lambda x: x.type == "subtitles", mkv.tracks))
@@ -81,8 +83,8 @@ if __name__ == "__main__":
                 s = sub_names[tid - 1]
                 forced = "forced" in s.lower()
                 sn += f' — {s}'
-            cmd += f' --edit track:s{tid} --set language={sl} --set name={quote(sn)} --set flag-forced={1 if forced is True else 0}'
+            cmd += ["--edit", f"track:s{tid}", "--set", f"language={sl}", "--set", f"name={sn}", "--set", f"flag-forced={1 if forced is True else 0}"]
             tid += 1
         title = f.stem.replace(args.repl, "")
-        cmd += f' --edit info --set title={quote(title)}'
-        os.system(cmd)
+        cmd += ["--edit", "info", "--set", f"title={title}"]
+        proc.check(proc.run(cmd, capture=False))
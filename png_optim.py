@@ -6,93 +6,343 @@ Optimize png files
 """
 
 from __future__ import division
-import os
 import argparse
+import time
+from functools import partial
 from pathlib import Path
-from queue import Queue
-from shlex import quote
-from typing import List
-from utils import common, io, logger
+from typing import List, Tuple
+from utils import cbz, common, journal, jxl, logger, metastrip, optimcache, optimstats, png, pngreduce, proc, resources, sniff
 
 LOGGER: logger.Logger
 F_OPTIPNG = str("optipng")
 F_PNGQUANT = str("pngquant")
 F_ZOPFLI = str("zopfli")
+# In portfolio mode, a racer expected to save this many times more than its average still would not win
+RACE_MARGIN = 1.5
+# Without prediction, a racer still running this many times longer than the winner took is killed
+RACE_SLOWDOWN = 4.0
 
 
-def command_for_filter(program: str, infile: Path, outfile: Path) -> str:
+def command_for_filter(program: str, infile: Path, outfile: Path) -> List[str]:
     """returns the command corresponding to `filt`"""
     if program == F_PNGQUANT:
-        return f"pngquant -f --speed 1 --quality 65-80 --strip --skip-if-larger -o {quote(str(outfile))} {quote(str(infile))}"
+        return ["pngquant", "-f", "--speed", "1", "--quality", "65-80", "--strip", "--skip-if-larger", "-o", outfile, infile]
     if program == F_ZOPFLI:
-        return f"zopflipng --iterations=50 --filters=01234mepb --lossy_transparent {quote(str(infile))} {quote(str(outfile))} > /dev/null"
+        return ["zopflipng", "--iterations=50", "--filters=01234mepb", "--lossy_transparent", infile, outfile]
     if program == F_OPTIPNG:
-        return f"optipng -quiet -o7 -preserve -out {quote(str(outfile))} {quote(str(infile))}"
+        return ["optipng", "-quiet", "-o7", "-preserve", "-out", outfile, infile]
     return None
 
 
-def th_optimize(p_queue: Queue, all_programs: List[str]):
-    """Optimization thread"""
-    while p_queue.empty() is False:
-        infile: Path = p_queue.get()
-        last_file = infile
-        for prg in all_programs:
-            outfile = infile.with_name(f"{infile.stem}.{prg}.png")
-            cmd = command_for_filter(prg, last_file, outfile)
-            if cmd is None:
-                LOGGER.log(f"{common.COLOR_WHITE}[!] {common.COLOR_RED}ERROR: No command for {common.COLOR_YELLOW}{prg}{common.COLOR_WHITE}")
-                continue
-            LOGGER.log(f"{common.COLOR_WHITE}[$] {common.COLOR_PURPLE}{cmd}")
-            os.system(cmd)
-            if outfile.exists() is True:
-                if outfile.stat().st_size < last_file.stat().st_size:
-                    LOGGER.log(f"{common.COLOR_WHITE}[-] {common.COLOR_BLUE}{prg} {common.COLOR_GREEN}successful{common.COLOR_WHITE} for {common.COLOR_YELLOW}{last_file}")
-                    if last_file.samefile(infile) is False:
-                        LOGGER.log(f"{common.COLOR_WHITE}[-] Removing {common.COLOR_YELLOW}{last_file}")
-                        last_file.unlink()
-                    last_file = outfile
-                else:
-                    LOGGER.log(f"{common.COLOR_WHITE}[-] {common.COLOR_BLUE}{prg} {common.COLOR_RED}unsuccessful{common.COLOR_WHITE} for {common.COLOR_YELLOW}{last_file}")
-                    outfile.unlink()
+def available_programs(use_pngquant: bool, use_zopfli: bool, use_optipng: bool) -> List[str]:
+    """The requested programs found in $PATH, in the order they run"""
+    programs: List[str] = []
+    if use_pngquant is True and common.which("pngquant") is not None:
+        programs.append(F_PNGQUANT)
+    if use_zopfli is True and common.which("zopflipng") is not None:
+        programs.append(F_ZOPFLI)
+    if use_optipng is True and common.which("optipng") is not None:
+        programs.append(F_OPTIPNG)
+    return programs
+
+
+def cache_chain(all_programs: List[str], portfolio: bool, chain_winner: bool) -> str:
+    """Programs and options applied to a file, part of the optimization cache key"""
+    mode = "chain" if portfolio is False else ("portfolio+chain" if chain_winner is True else "portfolio")
+    return "\n".join([mode] + [proc.describe(command_for_filter(prg, "{in}", "{out}")) for prg in all_programs])
+
+
+def unreached(infile: Path, budget: resources.Budget):
+    """`infile` could not be fully optimized within the budget, the next run starts with it"""
+    LOGGER.log(f"{common.COLOR_WHITE}[!] {common.COLOR_YELLOW}{infile}{common.COLOR_RED} not finished within the budget{common.COLOR_WHITE}")
+    budget.unreached_file(infile)
+
+
+def optimize_file(infile: Path, all_programs: List[str], jrnl: journal.Journal, gate: optimstats.Gate, budget: resources.Budget) -> bool:
+    """Run the programs one after the other on `infile`, keeping each output smaller than its input.
+    Returns False if a program was skipped by the gate, timed out or the budget ran out before all the programs"""
+    jrnl.start(infile, [infile.with_name(f"{infile.stem}.{prg}.png") for prg in all_programs])
+    last_file = infile
+    previous = gate.store.previous(infile)
+    complete = True
+    for prg in all_programs:
+        outfile = infile.with_name(f"{infile.stem}.{prg}.png")
+        cmd = command_for_filter(prg, last_file, outfile)
+        if cmd is None:
+            LOGGER.log(f"{common.COLOR_WHITE}[!] {common.COLOR_RED}ERROR: No command for {common.COLOR_YELLOW}{prg}{common.COLOR_WHITE}")
+            continue
+        features = optimstats.png_features(last_file, previous)
+        if gate.allow(prg, features) is False:
+            LOGGER.log(f"{common.COLOR_WHITE}[-] {common.COLOR_BLUE}{prg}{common.COLOR_WHITE} is not worth it for {common.COLOR_YELLOW}{infile}{common.COLOR_WHITE}, skipping…")
+            # Not fully optimized, neither cached nor done so a run with another threshold still gets to it
+            complete = False
+            continue
+        if budget.exhausted() is True:
+            unreached(infile, budget)
+            complete = False
+            break
+        LOGGER.log(f"{common.COLOR_WHITE}[$] {common.COLOR_PURPLE}{proc.describe(cmd)}")
+        res = proc.run(cmd, timeout=budget.timeout(prg), capture=False)
+        budget.charge(optimstats.cpu_seconds(res))
+        if res.timed_out is True:
+            LOGGER.log(f"{common.COLOR_WHITE}[!] {common.COLOR_BLUE}{prg} {common.COLOR_RED}timed out{common.COLOR_WHITE} for {common.COLOR_YELLOW}{last_file}")
+            # Killed before the end, the file is not done
+            unreached(infile, budget)
+            complete = False
+        valid = res.returncode == 0 and outfile.exists() is True
+        gate.store.record(infile, prg, features, last_file.stat().st_size - outfile.stat().st_size if valid is True else 0, optimstats.cpu_seconds(res))
+        if valid is True:
+            if outfile.stat().st_size < last_file.stat().st_size:
+                LOGGER.log(f"{common.COLOR_WHITE}[-] {common.COLOR_BLUE}{prg} {common.COLOR_GREEN}successful{common.COLOR_WHITE} for {common.COLOR_YELLOW}{last_file}")
+                if last_file.samefile(infile) is False:
+                    LOGGER.log(f"{common.COLOR_WHITE}[-] Removing {common.COLOR_YELLOW}{last_file}")
+                    last_file.unlink()
+                last_file = outfile
             else:
                 LOGGER.log(f"{common.COLOR_WHITE}[-] {common.COLOR_BLUE}{prg} {common.COLOR_RED}unsuccessful{common.COLOR_WHITE} for {common.COLOR_YELLOW}{last_file}")
-        if last_file.samefile(infile) is False:
-            LOGGER.log(f"{common.COLOR_WHITE}[-] Renaming {common.COLOR_YELLOW}{last_file}{common.COLOR_WHITE} to {common.COLOR_YELLOW}{infile}")
-            infile.unlink()
-            last_file.rename(infile)
-        p_queue.task_done()
+                outfile.unlink()
+        else:
+            LOGGER.log(f"{common.COLOR_WHITE}[-] {common.COLOR_BLUE}{prg} {common.COLOR_RED}unsuccessful{common.COLOR_WHITE} for {common.COLOR_YELLOW}{last_file}")
+            if outfile.exists() is True:
+                outfile.unlink()
+    if last_file.samefile(infile) is False:
+        LOGGER.log(f"{common.COLOR_WHITE}[-] Renaming {common.COLOR_YELLOW}{last_file}{common.COLOR_WHITE} to {common.COLOR_YELLOW}{infile}")
+        last_file.replace(infile)
+    return complete
+
+
+def optimize_portfolio(infile: Path, all_programs: List[str], jrnl: journal.Journal, gate: optimstats.Gate, budget: resources.Budget, chain_winner: bool = False) -> bool:
+    """Race the programs on `infile` and keep the smallest output, then optionally run the others on the winner.
+    Returns False if a program was skipped by the gate, timed out or the budget ran out before all the programs"""
+    if budget.exhausted() is True:
+        unreached(infile, budget)
+        return False
+    features = optimstats.png_features(infile, gate.store.previous(infile))
+    allowed = gate.filter(all_programs, features)
+    # Not fully optimized if the gate dropped a racer, neither cached nor done so a run with another threshold still gets to it
+    complete = len(allowed) == len(all_programs)
+    all_programs = allowed
+    if not all_programs:
+        LOGGER.log(f"{common.COLOR_WHITE}[-] No optimizer is worth it for {common.COLOR_YELLOW}{infile}{common.COLOR_WHITE}, skipping…")
+        return complete
+    outfiles = [infile.with_name(f"{infile.stem}.{prg}.png") for prg in all_programs]
+    cmds = [command_for_filter(prg, infile, outfile) for prg, outfile in zip(all_programs, outfiles)]
+    jrnl.start(infile, outfiles)
+    best = {"size": infile.stat().st_size, "index": None, "elapsed": None}
+
+    def on_done(i: int, res: proc.CommandResult):
+        if res.returncode == 0 and outfiles[i].exists() is True and outfiles[i].stat().st_size < best["size"]:
+            best["size"] = outfiles[i].stat().st_size
+            best["index"] = i
+            best["elapsed"] = res.elapsed
+
+    # Outputs are only written at the end, a racer is judged on what the finished ones reached:
+    # it is killed once the best output is smaller than what it is expected to reach,
+    # or with no prediction yet, once it has run much longer than the winner
+    predictions = [gate.store.predict(prg, features) if features is not None else None for prg in all_programs]
+    t_start = time.time()
+
+    def should_cancel(i: int) -> bool:
+        if best["index"] is None:
+            return False
+        if predictions[i] is None:
+            return time.time() - t_start > best["elapsed"] * RACE_SLOWDOWN
+        return best["size"] < features.size - predictions[i].bytes_saved * RACE_MARGIN
+
+    for cmd in cmds:
+        LOGGER.log(f"{common.COLOR_WHITE}[$] {common.COLOR_PURPLE}{proc.describe(cmd)}")
+    results = proc.race(cmds, should_cancel, on_done, timeout=[budget.timeout(prg) for prg in all_programs], capture=False)
+    timed_out = False
+    for i, res in enumerate(results):
+        if res is not None:
+            budget.charge(optimstats.cpu_seconds(res))
+            valid = res.returncode == 0 and outfiles[i].exists() is True
+            gate.store.record(infile, all_programs[i], features, features.size - outfiles[i].stat().st_size if valid is True and features is not None else 0, optimstats.cpu_seconds(res))
+        if i == best["index"]:
+            LOGGER.log(f"{common.COLOR_WHITE}[-] {common.COLOR_BLUE}{all_programs[i]} {common.COLOR_GREEN}won{common.COLOR_WHITE} for {common.COLOR_YELLOW}{infile}")
+            continue
+        if res is None:
+            LOGGER.log(f"{common.COLOR_WHITE}[-] {common.COLOR_BLUE}{all_programs[i]} {common.COLOR_RED}cancelled{common.COLOR_WHITE} for {common.COLOR_YELLOW}{infile}")
+        elif res.timed_out is True:
+            LOGGER.log(f"{common.COLOR_WHITE}[!] {common.COLOR_BLUE}{all_programs[i]} {common.COLOR_RED}timed out{common.COLOR_WHITE} for {common.COLOR_YELLOW}{infile}")
+            timed_out = True
+        else:
+            LOGGER.log(f"{common.COLOR_WHITE}[-] {common.COLOR_BLUE}{all_programs[i]} {common.COLOR_RED}unsuccessful{common.COLOR_WHITE} for {common.COLOR_YELLOW}{infile}")
+        if outfiles[i].exists() is True:
+            outfiles[i].unlink()
+    if timed_out is True:
+        # A racer killed before the end might have won, the file is not done
+        unreached(infile, budget)
+        complete = False
+    if best["index"] is None:
+        return complete
+    LOGGER.log(f"{common.COLOR_WHITE}[-] Renaming {common.COLOR_YELLOW}{outfiles[best['index']]}{common.COLOR_WHITE} to {common.COLOR_YELLOW}{infile}")
+    outfiles[best["index"]].replace(infile)
+    if chain_winner is True:
+        return optimize_file(infile, [prg for i, prg in enumerate(all_programs) if i != best["index"]], jrnl, gate, budget) and complete
+    return complete
+
+
+def strip(infile: Path, options: metastrip.StripOptions, jrnl: journal.Journal):
+    """Remove the text, time and EXIF chunks of `infile` without re-encoding"""
+    try:
+        infos = png.read_info(infile)
+    except png.PngError as e:
+        LOGGER.log(f"{common.COLOR_WHITE}[!] {common.COLOR_YELLOW}{infile}{common.COLOR_RED} is not a valid png ({e}), not stripped{common.COLOR_WHITE}")
+        return
+    jrnl.start(infile, [infile.with_name(f".{infile.name}.tmp")])
+    saved = metastrip.strip_png(infile, infos, options)
+    if saved > 0:
+        LOGGER.log(f"{common.COLOR_WHITE}[-] {common.COLOR_BLUE}{saved} bytes{common.COLOR_WHITE} of metadata stripped from {common.COLOR_YELLOW}{infile}")
+
+
+def reduce(infile: Path, jrnl: journal.Journal):
+    """Lossless color type and bit depth reduction of `infile`, so the optimizers start from a smaller image"""
+    jrnl.start(infile, [infile.with_name(f".{infile.name}.tmp")])
+    saved = pngreduce.reduce_file(infile)
+    if saved > 0:
+        LOGGER.log(f"{common.COLOR_WHITE}[-] {common.COLOR_BLUE}reduce {common.COLOR_GREEN}successful{common.COLOR_WHITE} for {common.COLOR_YELLOW}{infile}{common.COLOR_WHITE} ({saved} bytes)")
+
+
+def to_jxl(infile: Path, options: jxl.JxlOptions, jrnl: journal.Journal, budget: resources.Budget) -> Path:
+    """Transcode `infile` to JPEG XL, returns the file kept, None if the budget ran out or cjxl timed out"""
+    if budget.exhausted() is True:
+        unreached(infile, budget)
+        return None
+    jrnl.start(infile, [infile.with_name(f".{infile.stem}.tmp.jxl")])
+    size = infile.stat().st_size
+    res = jxl.transcode(infile, False, options.effort, budget.timeout(jxl.BIN_CJXL))
+    budget.charge(res.cpu)
+    if res.timed_out is True:
+        LOGGER.log(f"{common.COLOR_WHITE}[!] {common.COLOR_BLUE}jxl {common.COLOR_RED}timed out{common.COLOR_WHITE} for {common.COLOR_YELLOW}{infile}")
+        unreached(infile, budget)
+        return None
+    if res.kept is False:
+        LOGGER.log(f"{common.COLOR_WHITE}[-] {common.COLOR_BLUE}jxl {common.COLOR_RED}unsuccessful{common.COLOR_WHITE} for {common.COLOR_YELLOW}{infile}")
+        return infile
+    encoded = infile.with_suffix(".jxl")
+    LOGGER.log(f"{common.COLOR_WHITE}[-] {common.COLOR_BLUE}jxl {common.COLOR_GREEN}successful{common.COLOR_WHITE}, {common.COLOR_YELLOW}{infile}{common.COLOR_WHITE} replaced by {common.COLOR_YELLOW}{encoded}")
+    if options.index is not None:
+        options.index.add(infile, encoded, res.digest, size, False)
+    return encoded
+
+
+def optimize(infile: Path, all_programs: List[str], portfolio: bool, chain_winner: bool, strip_options: metastrip.StripOptions, use_reduce: bool, jxl_options: jxl.JxlOptions, jrnl: journal.Journal, cache: optimcache.OptimCache, gate: optimstats.Gate, budget: resources.Budget) -> Tuple[int, int]:
+    """Optimization job, returns the file size before and after"""
+    original_size = infile.stat().st_size
+    if jrnl.is_done(infile) is True:
+        LOGGER.log(f"{common.COLOR_WHITE}[-] {common.COLOR_YELLOW}{infile}{common.COLOR_WHITE} already optimized, skipping…")
+        return original_size, original_size
+    if strip_options is not None:
+        strip(infile, strip_options, jrnl)
+    if use_reduce is True:
+        reduce(infile, jrnl)
+    run = optimize_file if portfolio is False else partial(optimize_portfolio, chain_winner=chain_winner)
+    complete = True
+    if all_programs and cache is None:
+        complete = run(infile, all_programs, jrnl, gate, budget)
+    elif all_programs:
+        digest = optimcache.hash_file(infile)
+        chain = cache_chain(all_programs, portfolio, chain_winner)
+        # Identical images are optimized once, the others wait for the result
+        with cache.computing(digest, chain):
+            output = cache.lookup(digest, chain)
+            if output == digest:
+                LOGGER.log(f"{common.COLOR_WHITE}[-] {common.COLOR_YELLOW}{infile}{common.COLOR_WHITE} already optimized (cache), skipping…")
+            elif output is not None and cache.restore(output, infile) is True:
+                LOGGER.log(f"{common.COLOR_WHITE}[-] {common.COLOR_YELLOW}{infile}{common.COLOR_WHITE} copied from cache")
+            else:
+                complete = run(infile, all_programs, jrnl, gate, budget)
+                if complete is True:
+                    cache.store(digest, chain, infile)
+    final_file = infile
+    if complete is True and jxl_options is not None:
+        final_file = to_jxl(infile, jxl_options, jrnl, budget)
+        if final_file is None:
+            complete = False
+            final_file = infile
+    if complete is False:
+        # Processed again by the next run
+        jrnl.pending(infile)
+    else:
+        jrnl.done(infile, final_file if final_file != infile else None)
+    return original_size, final_file.stat().st_size
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("input", type=Path, help="Path to directory or single PNG file")
+    parser.add_argument("input", type=Path, help="Path to directory, single PNG file or CBZ/ZIP archive")
     parser.add_argument("-v", "--verbose", dest="verbose", action="store_true", help="Verbose mode, default: false")
     parser.add_argument("-q", "--quant", dest="use_pngquant", action="store_true", help="Use pngquant, default: false")
     parser.add_argument("-z", "--zopfli", dest="use_zopfli", action="store_true", help="Use zopfli (very slow), default: false")
     parser.add_argument("-o", "--optipng", dest="use_optipng", action="store_true", default=True, help="Use optipng, default: true")
+    parser.add_argument("-p", "--portfolio", dest="portfolio", action="store_true", help="Run the optimizers concurrently on each file and keep the smallest output, default: false")
+    parser.add_argument("-c", "--chain-winner", dest="chain_winner", action="store_true", help="With --portfolio, run the other optimizers on the winning output, default: false")
+    parser.add_argument("-x", "--strip", dest="strip", action="store_true", help="Remove the text, time and EXIF chunks without re-encoding, before the optimizers if any, default: false")
+    parser.add_argument("-i", "--keep-icc", dest="keep_icc", action="store_true", help="With --strip, keep the ICC profile, default: false")
+    parser.add_argument("--keep-orientation", dest="keep_orientation", action="store_true", help="With --strip, keep the EXIF orientation, default: false")
+    parser.add_argument("-R", "--reduce", dest="reduce", action="store_true", help="Losslessly reduce the color type and bit depth (opaque alpha, grey, palette, 16 bits) before the optimizers, default: false")
+    parser.add_argument("-J", "--jxl", dest="jxl", action="store_true", help="Transcode to lossless JPEG XL after the optimizers and replace the original if smaller, the round trip is verified, default: false")
+    parser.add_argument("--jxl-effort", dest="jxl_effort", type=int, default=jxl.DEFAULT_EFFORT, help=f"cjxl effort (1-10), default: {jxl.DEFAULT_EFFORT}")
+    parser.add_argument("--jxl-index", dest="jxl_index", type=Path, default=None, help="JSON index mapping the originals to their JXL, updated at the end of the run, default: none")
+    parser.add_argument("-r", "--redo", dest="redo", action="store_true", help="Optimize again the files an earlier run already optimized, default: false")
+    parser.add_argument("-n", "--no-cache", dest="no_cache", action="store_true", help="Do not use the optimization cache, default: false")
+    parser.add_argument("-e", "--efficiency", dest="efficiency", type=float, default=0, help="Skip the optimizers expected to save less than this many bytes per CPU second on a file, learned from previous runs, default: 0 (never skip)")
+    parser.add_argument("-k", "--timeout", dest="timeout", type=float, default=None, help="Kill an optimization program after this many seconds, default: no limit")
+    parser.add_argument("-l", "--stage-timeout", dest="stage_timeouts", action="append", metavar="PROGRAM=SECONDS", help="Time limit of a single program (ex: zopfli=300), overrides --timeout, can be repeated")
+    parser.add_argument("-w", "--wall-budget", dest="wall_budget", type=float, default=None, help="Do not start new programs after this many seconds, default: no limit")
+    parser.add_argument("-u", "--cpu-budget", dest="cpu_budget", type=float, default=None, help="Do not start new programs after this many CPU seconds, default: no limit")
     args = parser.parse_args()
     LOGGER = logger.Logger(args.verbose)
 
-    programs: List[str] = []
-    if args.use_pngquant is True and common.which("pngquant") is not None:
-        programs.append(F_PNGQUANT)
-    if args.use_zopfli is True and common.which("zopflipng") is not None:
-        programs.append(F_ZOPFLI)
-    if args.use_optipng is True and common.which("optipng") is not None:
-        programs.append(F_OPTIPNG)
+    programs = available_programs(args.use_pngquant, args.use_zopfli, args.use_optipng)
 
     # Sanity checks
-    if len(programs) == 0:
+    if args.jxl is True:
+        common.ensure_exist([jxl.BIN_CJXL, jxl.BIN_DJXL])
+    if len(programs) == 0 and args.strip is False and args.reduce is False and args.jxl is False:
         common.abort(f"{common.COLOR_WHITE}[!] {common.COLOR_RED}ERROR: No optimization programs specified or found, aborting…")
+    strip_options = metastrip.StripOptions(args.keep_icc, args.keep_orientation) if args.strip is True else None
+    jxl_options = jxl.JxlOptions(args.jxl_effort, jxl.Index(args.jxl_index.resolve()) if args.jxl_index is not None else None) if args.jxl is True else None
 
-    # Get files list
-    files = common.walk_directory(args.input.resolve(), lambda x: io.match_signature(x, [b"\x89\x50\x4E\x47\x0D\x0A\x1A\x0A"]))
-    queue = common.as_queue(files)
-    total_original_bytes = sum(x.stat().st_size for x in files)
-    LOGGER.log(f"{common.COLOR_WHITE}[+] {len(files)} file{'s' if len(files) != 1 else ''} to optimize ({total_original_bytes / 1048576:4.2f}Mb)")
-    LOGGER.log(f"{common.COLOR_WHITE}[+] Using {common.COLOR_BLUE}{', '.join(programs)}")
+    LOGGER.log(f"{common.COLOR_WHITE}[+] Using {common.COLOR_BLUE}{', '.join((['strip'] if args.strip is True else []) + (['reduce'] if args.reduce is True else []) + programs + (['jxl'] if args.jxl is True else []))}")
 
-    # Optimize
-    t = common.parallel(th_optimize, (queue, programs, ))
-    bytes_saved = total_original_bytes - sum(x.stat().st_size for x in files)
+    proc.configure(timeout=args.timeout)
+    budget = resources.Budget(args.wall_budget, args.cpu_budget, resources.parse_timeouts(args.stage_timeouts), args.timeout)
+    # Resume an interrupted run
+    params = [cache_chain(programs, args.portfolio, args.chain_winner), strip_options, args.reduce, args.jxl_effort if args.jxl is True else None]
+    jrnl = journal.Journal("png_optim", params, args.redo)
+    jrnl.recover()
+    cache = optimcache.OptimCache() if args.no_cache is False else None
+    gate = optimstats.Gate(optimstats.StatsStore("png_optim"), args.efficiency)
+    path = args.input.resolve()
+    if cbz.is_archive(path) is True:
+        # Members are optimized without extracting the archive, the archive is journaled as a whole
+        if jxl_options is not None:
+            common.abort(f"{common.COLOR_WHITE}[!] {common.COLOR_RED}ERROR: --jxl cannot be used on an archive, aborting…")
+        results, t = [], 0
+        if jrnl.is_done(path) is False:
+            results, t = cbz.optimize_journaled(path, optimize, (programs, args.portfolio, args.chain_winner, strip_options, args.reduce, None, journal.NullJournal(), cache, gate, budget,), [sniff.TYPE_PNG], (".png",), jrnl, budget)
+        else:
+            LOGGER.log(f"{common.COLOR_WHITE}[-] {common.COLOR_YELLOW}{path}{common.COLOR_WHITE} already optimized, skipping…")
+    else:
+        # Optimize files as soon as the scan finds them
+        files = (x.path for x in common.scan_directory(path, sniff.filter_for([sniff.TYPE_PNG])))
+        if budget.is_limited() is True:
+            # Files left by the previous run first, then the most profitable ones
+            files = optimstats.schedule(list(files), gate.store, programs, optimstats.png_features, jrnl.unfinished())
+        results, t = common.run_jobs(optimize, files, (programs, args.portfolio, args.chain_winner, strip_options, args.reduce, jxl_options, jrnl, cache, gate, budget,))
+    common.print_failures(results)
+    sizes = [res.value for res in results if res.value is not None]
+    total_original_bytes = sum(x[0] for x in sizes)
+    LOGGER.log(f"{common.COLOR_WHITE}[+] {len(results)} file{'s' if len(results) != 1 else ''} processed ({total_original_bytes / 1048576:4.2f}Mb)")
+    bytes_saved = total_original_bytes - sum(x[1] for x in sizes)
     LOGGER.log(f"{common.COLOR_WHITE}[+] {common.COLOR_GREEN if bytes_saved > 0 else common.COLOR_RED}{bytes_saved} bytes saved ({bytes_saved / 1048576:4.2f}Mb) in {t:4.2f}s")
+    if jxl_options is not None and jxl_options.index is not None:
+        jxl_options.index.save()
+    if gate.threshold > 0:
+        LOGGER.log(f"{common.COLOR_WHITE}[+] {gate.summary()}")
+    if budget.unreached:
+        LOGGER.log(f"{common.COLOR_WHITE}[+] {common.COLOR_RED}{len(budget.unreached)} file{'s' if len(budget.unreached) != 1 else ''} not finished within the budget{common.COLOR_WHITE}, the next run starts with them")
+        for f in budget.unreached:
+            print(f)
@@ -8,6 +8,7 @@ bla bla
 import os
 import argparse
 import sys
+from utils import proc
 
 
 def list_directory(p_path, p_sorted=False):
@@ -52,13 +53,13 @@ if __name__ == "__main__":
     for idx, val in enumerate(src_files):
         src_file = src_files[idx]
         dst_file = dst_files[idx]
-        sushi = 'sushi --no-grouping --window ' + args.win
+        sushi = ['sushi', '--no-grouping', '--window', args.win]
         if args.no_cleanup is True:
-            sushi += ' --no-cleanup '
-        sushi += ' --src "' + src_file + '"'
+            sushi.append('--no-cleanup')
+        sushi += ['--src', src_file]
         if args.srcscript is not None:
-            sushi += ' --src-script ' + args.srcscript
+            sushi += ['--src-script', args.srcscript]
         if args.srcaudio is not None:
-            sushi += ' --src-audio ' + args.srcaudio
-        sushi += ' --dst "' + dst_file + '"'
-        os.system(sushi)
+            sushi += ['--src-audio', args.srcaudio]
+        sushi += ['--dst', dst_file]
+        proc.check(proc.run(sushi, capture=False))
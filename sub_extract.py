@@ -3,70 +3,64 @@
 
 """
 Extract all subtitles streams of a given movie or directory of movies
-[!] ffmpeg must be installed and in your $PATH
+[!] ffmpeg and ffprobe must be installed and in your $PATH
 ex: extract_subs.py /path/to/movies/
 """
 
-import os
-import re
 import argparse
 from pathlib import Path
-from queue import Queue
-from collections import namedtuple
-from shlex import quote
-from utils import av, common, logger
+from utils import av, common, logger, probecache, proc
 
 LOGGER: logger.Logger
 
-SubtitlesStreamInfo = namedtuple('SubtitlesStreamInfo', ['id', 'infos', 'extension', 'title'])
+SUBTITLES_EXTENSIONS_MAP = {
+    'ass': '.ass',
+    'dvb_subtitle': '.sub',
+    'hdmv_pgs_subtitle': '.sup',
+    'ssa': '.ass',
+    'subrip': '.srt',
+    'webvtt': '.vtt',
+}
 
 
-def get_subs_streams(infos: str) -> str:
-    """Parse `ffmpeg -i` output to grab only subtitles streams"""
-    maps = {
-        'ssa': '.ass',
-        'ass': '.ass',
-        'subrip': '.srt',
-        'pgs': '.pgs'
-    }
+def extension_for_subtitles_stream(stream: av.Stream) -> str:
+    """Returns the extension for a given ffprobe subtitles stream"""
+    return SUBTITLES_EXTENSIONS_MAP.get(stream.codec_name, f".{stream.codec_name}")
 
-    def sanitize_type(x: str) -> str:
-        """clean extension"""
-        return maps[x] if x in maps else x
 
-    streams = re.findall(r'Stream #0:(\d+).*?Subtitle:\s*((\w*)\s*?.*?)\r?\n(?:\s*Metadata:\s*\r?\n\s*title\s*:\s*(.*?)\r?\n)?', infos)
-    return [SubtitlesStreamInfo(int(x[0]), x[1].strip(), sanitize_type(x[2].replace(",", "").strip()), x[3].strip()) for x in streams]
-
-
-def extract_subtitles(p_queue: Queue):
-    """Extract thread"""
-    while p_queue.empty() is False:
-        infile: Path = p_queue.get()
-        infos = av.get_file_infos(infile)
-        streams = get_subs_streams(infos)
-        for sub_stream in streams:
-            outfile = f'{str(infile)}.{sub_stream.id}{sub_stream.extension}'
-            cmd = f'ffmpeg -i {quote(str(infile))} -v quiet -map 0:{sub_stream.id} -c copy {quote(outfile)}'
-            LOGGER.log(f"{common.COLOR_WHITE}[+] Extracting track {sub_stream.id} from {common.COLOR_YELLOW}{infile} with {common.COLOR_PURPLE}{cmd}{common.COLOR_WHITE}")
-            os.system(cmd)
-        p_queue.task_done()
+def extract_subtitles(infile: Path) -> int:
+    """Extract job, returns the first non-zero ffmpeg exit status"""
+    infos = av.probe(infile)
+    status = 0
+    for sub_stream in infos.streams_of_type("subtitle"):
+        outfile = f'{str(infile)}.{sub_stream.index}{extension_for_subtitles_stream(sub_stream)}'
+        cmd = ["ffmpeg", "-i", infile, "-v", "quiet", "-map", f"0:{sub_stream.index}", "-c", "copy", outfile]
+        LOGGER.log(f"{common.COLOR_WHITE}[+] Extracting track {sub_stream.index} from {common.COLOR_YELLOW}{infile} with {common.COLOR_PURPLE}{proc.describe(cmd)}{common.COLOR_WHITE}")
+        res = proc.run(cmd, capture=False)
+        if status == 0:
+            status = res.returncode
+    return status
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("input", type=Path, help="Path to directory or single video file")
     parser.add_argument("-v", "--verbose", dest="verbose", action="store_true", help="Verbose mode")
+    parser.add_argument("--no-cache", dest="no_cache", action="store_true", help="Do not use the probe cache")
     args = parser.parse_args()
     LOGGER = logger.Logger(args.verbose)
 
+    if args.no_cache is True:
+        probecache.disable()
+
     # Sanity checks
-    common.ensure_exist(["ffmpeg"])
+    common.ensure_exist(["ffmpeg", "ffprobe"])
     if args.input.exists() is None:
         common.abort(parser.format_help())
 
     # Get a list of files
     files = common.list_directory(args.input.resolve())
-    queue = common.as_queue(files)
 
     # Extract
-    common.parallel(extract_subtitles, (queue,))
+    results, _ = common.run_jobs(extract_subtitles, files)
+    common.print_failures(results)
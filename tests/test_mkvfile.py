@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+utils.mkvfile tests
+"""
+
+from pathlib import Path
+from utils import mkvfile
+
+
+def _size(value: int) -> bytes:
+    """8 bytes EBML size"""
+    return bytes([0x01]) + value.to_bytes(7, "big")
+
+
+def _element(eid: int, payload: bytes) -> bytes:
+    return eid.to_bytes((eid.bit_length() + 7) // 8, "big") + _size(len(payload)) + payload
+
+
+def _uint(eid: int, value: int) -> bytes:
+    return _element(eid, value.to_bytes(8, "big"))
+
+
+def _matroska(level1: list) -> bytes:
+    """EBML header and a segment made of the `level1` elements"""
+    header = _element(mkvfile.EBML_ID_HEADER, _element(mkvfile.EBML_ID_DOCTYPE, b"matroska"))
+    return header + _element(mkvfile.EBML_ID_SEGMENT, b"".join(level1))
+
+
+TRACKS = _element(mkvfile.EBML_ID_TRACKS, _element(mkvfile.EBML_ID_TRACKENTRY, _uint(mkvfile.EBML_ID_TRACKUID, 1) + _uint(mkvfile.EBML_ID_TRACKTYPE, 1) + _element(mkvfile.EBML_ID_CODECID, b"V_AV1")))
+CLUSTER = _element(mkvfile.EBML_ID_CLUSTER, b"\0" * 64)
+CHAPTERS = _element(mkvfile.EBML_ID_CHAPTERS, _element(mkvfile.EBML_ID_EDITIONENTRY, _element(mkvfile.EBML_ID_CHAPTERATOM, b"") * 2))
+
+
+def _seekhead(entries: list) -> bytes:
+    """SeekHead of (id, position in the segment)"""
+    seeks = b"".join(_element(mkvfile.EBML_ID_SEEK, _element(mkvfile.EBML_ID_SEEKID, eid.to_bytes(4, "big")) + _uint(mkvfile.EBML_ID_SEEKPOSITION, pos)) for eid, pos in entries)
+    return _element(mkvfile.EBML_ID_SEEKHEAD, seeks)
+
+
+def test_chapters_after_clusters_without_seekhead(tmp_path: Path):
+    """Chapters stored after the clusters are found without a SeekHead"""
+    path = tmp_path / "a.mkv"
+    path.write_bytes(_matroska([TRACKS, CLUSTER, CLUSTER, CHAPTERS]))
+    assert mkvfile.read_ebml_infos(path)["chapters"] == [{"num_entries": 2}]
+
+
+def test_chapters_after_clusters_not_in_seekhead(tmp_path: Path):
+    """Chapters stored after the clusters are found when the SeekHead does not list them"""
+    # The SeekHead size does not depend on the positions it holds
+    seekhead_size = len(_seekhead([(mkvfile.EBML_ID_TRACKS, 0)]))
+    path = tmp_path / "a.mkv"
+    path.write_bytes(_matroska([_seekhead([(mkvfile.EBML_ID_TRACKS, seekhead_size)]), TRACKS, CLUSTER, CHAPTERS]))
+    infos = mkvfile.read_ebml_infos(path)
+    assert len(infos["tracks"]) == 1
+    assert infos["chapters"] == [{"num_entries": 2}]
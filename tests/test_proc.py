@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+utils.proc tests
+"""
+
+import signal
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+SCRIPT = """
+import sys
+from utils import proc
+proc.run(["sh", "-c", f"echo $$ > {sys.argv[1]}; exec sleep 30"], capture=False)
+"""
+
+
+def _is_running(pid: int) -> bool:
+    """Check if `pid` exists and is not a zombie"""
+    try:
+        with open(f"/proc/{pid}/stat", "r", encoding="utf-8") as f:
+            return f.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except FileNotFoundError:
+        return False
+
+
+def test_interrupt_kills_commands(tmp_path: Path):
+    """Ctrl-C on a script kills the command it is waiting for"""
+    pid_file = tmp_path / "pid"
+    script = subprocess.Popen([sys.executable, "-c", SCRIPT, str(pid_file)], cwd=ROOT, stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.time() + 10
+        while (pid_file.exists() is False or pid_file.read_text().strip() == "") and time.time() < deadline:
+            time.sleep(0.05)
+        pid = int(pid_file.read_text())
+        assert _is_running(pid) is True
+        script.send_signal(signal.SIGINT)
+        script.wait(10)
+        deadline = time.time() + 5
+        while _is_running(pid) is True and time.time() < deadline:
+            time.sleep(0.05)
+        assert _is_running(pid) is False
+    finally:
+        script.kill()
+        script.wait()
@@ -9,19 +9,23 @@ Optimize a directory of manga scans :
 - Compress directory
 """
 
-import os
 import argparse
-import imghdr
-import time
+import subprocess
+import tarfile
+import threading
 from pathlib import Path
-from queue import Queue
-from shlex import quote
+from typing import List
 
 import numpy
 from PIL import Image  # pip3 install Pillow
-import pyopencl as cl
+try:
+    import pyopencl as cl  # pip3 install pyopencl
+except ImportError:
+    cl = None
 
-from utils import common
+import jpeg_optim
+import png_optim
+from utils import cbz, common, journal, logger, optimcache, optimstats, pipeline, proc, resources, sniff
 
 CL_KERNEL = """
 __kernel void isGrey(read_only image2d_t src, __global unsigned int* color)
@@ -31,104 +35,281 @@ __kernel void isGrey(read_only image2d_t src, __global unsigned int* color)
     uint4 pix = read_imageui(src, sampler, pos);
     if (pix.x != pix.y || pix.x != pix.z || pix.y != pix.z)
     {
-        *color += 1;
+        atomic_inc(color);
     }
 }
 """
+# A page is checked by bands of rows, stopping at the first one holding a color
+BLOCK_ROWS = 32
+FMT_PNG = str(".png")
+FMT_JPG = str(".jpg")
+PAGE_SUFFIXES = (".png", ".jpg", ".jpeg", ".gif", ".bmp", ".tif", ".tiff")
+# Modes decoded on a single channel
+GREY_MODES = ("1", "L", "LA", "I", "I;16")
+ARCHIVE_CBZ = str("cbz")
+ARCHIVE_TXZ = str("txz")
 
 
-def cl_is_grey(p_rgb, p_cl_context: cl.Context, p_cl_queue: cl.CommandQueue, p_cl_program: cl.Program) -> bool:
+def cl_is_grey(pixels: numpy.ndarray, p_cl_context, p_cl_queue, p_cl_program) -> bool:
     """Check if an image is grey using OpenCL"""
-    pixels = numpy.array(p_rgb)
-    dev_buf = cl.image_from_array(p_cl_context, pixels, 4)
+    if pixels.ndim == 2:
+        return True
+    rgba = numpy.dstack([pixels, numpy.full(pixels.shape[:2], 255, numpy.uint8)])
+    dev_buf = cl.image_from_array(p_cl_context, rgba, 4)
 
     color = numpy.uint32(0)
     dev_color = cl.Buffer(p_cl_context, cl.mem_flags.COPY_HOST_PTR, hostbuf=color)
 
-    p_cl_program.isGrey(p_cl_queue, (pixels.shape[0], pixels.shape[1]), None, dev_buf, dev_color)
+    # One work item per pixel, (x, y)
+    p_cl_program.isGrey(p_cl_queue, (rgba.shape[1], rgba.shape[0]), None, dev_buf, dev_color)
 
     nb_colors = numpy.empty_like(color)
     cl.enqueue_copy(p_cl_queue, nb_colors, dev_color)
     return bool(nb_colors == 0)
 
 
-def save_to_format(p_queue: Queue, fmt: str):
-    """PNG export thread"""
-    while p_queue.empty() is False:
-        original_file: Path = p_queue.get()
-        img2 = Image.open(original_file).convert('RGB')
-        png_path = original_file.with_suffix(fmt)
-        img2.save(png_path, quality=100, optimize=False, progressive=False, icc_profile=None)
-        original_file.unlink()
-        p_queue.task_done()
+def np_is_grey(pixels: numpy.ndarray, tolerance: int = 0) -> bool:
+    """Check if all the pixels are grey, up to a difference of `tolerance` between the channels"""
+    if pixels.ndim == 2:
+        return True
+    for row in range(0, pixels.shape[0], BLOCK_ROWS):
+        block = pixels[row:row + BLOCK_ROWS]
+        if tolerance == 0:
+            if not (numpy.array_equal(block[:, :, 0], block[:, :, 1]) and numpy.array_equal(block[:, :, 1], block[:, :, 2])):
+                return False
+        elif (block.max(axis=2).astype(numpy.int16) - block.min(axis=2)).max() > tolerance:
+            return False
+    return True
+
+
+class Page:
+    """A page classified from its header when possible, its pixels are decoded only if they must be checked or converted, then freed as soon as it is written"""
+
+    def __init__(self, path: Path, is_png: bool, mode: str, palette: List[int]):
+        self.path = path
+        self.is_png = is_png
+        self.mode = mode
+        self.palette = palette
+        self.pixels: numpy.ndarray = None
+
+    @classmethod
+    def probe(cls, path: Path) -> "Page":
+        """Read the header of the image at `path`"""
+        with Image.open(path) as img:
+            palette = img.getpalette() if img.mode == "P" else None
+            return cls(path, sniff.classify(path) == sniff.TYPE_PNG, img.mode, palette)
+
+    def header_grey(self, tolerance: int = 0) -> bool:
+        """True if the mode or the palette of the page is grey, None if the pixels must be checked"""
+        if self.mode in GREY_MODES:
+            return True
+        if self.palette is not None:
+            # Unused entries may be colors, then the pixels tell
+            colors = numpy.array(self.palette, numpy.int16).reshape(-1, 3)
+            if (colors.max(axis=1) - colors.min(axis=1)).max() <= tolerance:
+                return True
+        return None
+
+    def draft_grey(self, tolerance: int = 0) -> bool:
+        """False if a JPEG decoded at 1/8 scale already shows colors, None if the pixels must be checked"""
+        if self.is_png is True:
+            return None
+        with Image.open(self.path) as img:
+            img.draft("RGB", (max(img.width // 8, 1), max(img.height // 8, 1)))
+            pixels = numpy.asarray(img.convert("RGB"))
+        return False if np_is_grey(pixels, tolerance) is False else None
+
+    def decode(self) -> numpy.ndarray:
+        """Decode the pixels, grayscale images stay on a single channel"""
+        if self.pixels is None:
+            with Image.open(self.path) as img:
+                self.pixels = numpy.asarray(img.convert("L" if img.mode in GREY_MODES else "RGB"))
+        return self.pixels
+
+    def target(self, grey: bool) -> str:
+        """Format the page must be converted to, None if it is already right"""
+        if grey is True and self.is_png is False:
+            return FMT_PNG
+        if grey is False and self.is_png is True:
+            return FMT_JPG
+        return None
+
+    def save(self, fmt: str) -> Path:
+        """Write the page as `fmt` and remove the original, returns the new path"""
+        img = Image.fromarray(self.decode())
+        if fmt == FMT_PNG and img.mode != "L":
+            img = img.convert("L")
+        dst = self.path.with_suffix(fmt)
+        img.save(dst, quality=100, optimize=False, progressive=False, icc_profile=None)
+        self.path.unlink()
+        return dst
+
+    def release(self):
+        """Free the pixels"""
+        self.pixels = None
+
+
+class SolidArchive:
+    """Solid tar stream of the directory `root`, compressed by a multithreaded xz as the files are added"""
+
+    def __init__(self, root: Path, dst: Path):
+        self.root = root
+        self.added = set()
+        self._lock = threading.Lock()
+        self._out = open(dst, "wb")
+        self._xz = subprocess.Popen(["xz", "-T", "0", "-9"], stdin=subprocess.PIPE, stdout=self._out)
+        self._tar = tarfile.open(fileobj=self._xz.stdin, mode="w|", format=tarfile.PAX_FORMAT)
+
+    def add(self, path: Path, slot: Path = None) -> Path:
+        """Append the file at `path`, in place of the file `slot` of the directory (itself by default)"""
+        with self._lock:
+            self._tar.add(path, arcname=str(Path(self.root.name) / path.relative_to(self.root)), recursive=False)
+            self.added.add(slot if slot is not None else path)
+        return path
+
+    def close(self) -> int:
+        """Finish the archive, returns the xz exit status"""
+        with self._lock:
+            self._tar.close()
+            self._xz.stdin.close()
+            status = self._xz.wait()
+            self._out.close()
+        return status
+
+
+class Volume:
+    """A manga directory, its files are listed once and its archive is written as its pages come out of the optimizers"""
+
+    def __init__(self, root: Path, archive_format: str):
+        self.root = root
+        files = common.walk_directory(root)
+        self.pages = sorted((x for x in files if x.suffix.lower() in PAGE_SUFFIXES), key=common.natural_key)
+        self.others = sorted((x for x in files if x.suffix.lower() not in PAGE_SUFFIXES), key=common.natural_key)
+        self.output = root.with_name(f"{root.name}.{archive_format}")
+        self.archive = SolidArchive(root, self.output) if archive_format == ARCHIVE_TXZ else cbz.CbzWriter(root, self.output, self.pages + self.others)
+
+    def close(self) -> int:
+        """Add the other files and the pages which failed as they are, then finish the archive"""
+        for f in self.others + self.pages:
+            if f not in self.archive.added and f.exists() is True:
+                self.archive.add(f)
+        return self.archive.close()
+
+
+class Workflow:
+    """classify → convert → optimize → archive stages of the pages"""
+
+    def __init__(self, tolerance: int, volumes: List[Volume], use_opencl: bool = False):
+        self.tolerance = tolerance
+        self.volumes = {page: volume for volume in volumes for page in volume.pages}
+        self.converted = {FMT_PNG: 0, FMT_JPG: 0}
+        self._lock = threading.Lock()
+        self._cl = None
+        if use_opencl is True:
+            cl_ctx = cl.create_some_context()
+            self._cl = (cl_ctx, cl.CommandQueue(cl_ctx), cl.Program(cl_ctx, CL_KERNEL).build())
+        # Same settings as `png_optim.py -q -z -n` and `jpeg_optim.py -s -g`
+        self.png_programs = png_optim.available_programs(True, True, True)
+        self.png_jrnl = journal.Journal("png_optim", [png_optim.cache_chain(self.png_programs, False, False), None, False, None])
+        self.png_gate = optimstats.Gate(optimstats.StatsStore("png_optim"), 0)
+        self.jpeg_programs = jpeg_optim.available_programs(True, True, False)
+        self.jpeg_jrnl = journal.Journal("jpeg_optim", [self.jpeg_programs, False, None, None])
+        self.jpeg_gate = optimstats.Gate(optimstats.StatsStore("jpeg_optim"), 0)
+        self.png_jrnl.recover()
+        self.jpeg_jrnl.recover()
+        self.jpeg_cache = optimcache.OptimCache()
+        self.budget = resources.Budget()
+
+    def classify(self, path: Path) -> tuple:
+        """Find the format the page needs, from its header or a reduced decode when they are enough"""
+        volume = self.volumes[path]
+        page = Page.probe(path)
+        grey = page.header_grey(self.tolerance)
+        if grey is None:
+            grey = page.draft_grey(self.tolerance)
+        if grey is None:
+            if self._cl is not None:
+                # A single OpenCL queue
+                with self._lock:
+                    grey = cl_is_grey(page.decode(), *self._cl)
+            else:
+                grey = np_is_grey(page.decode(), self.tolerance)
+        fmt = page.target(grey)
+        if fmt is None:
+            # Kept as is, the pixels are not needed anymore
+            page.release()
+        return volume, page, fmt
+
+    def convert(self, value: tuple) -> tuple:
+        """Write the page in its format if needed (decoding it unless the classification did), its pixels are freed"""
+        volume, page, fmt = value
+        try:
+            if fmt is None:
+                return volume, page.path, page.path
+            dst = page.save(fmt)
+            with self._lock:
+                self.converted[fmt] += 1
+            return volume, page.path, dst
+        finally:
+            page.release()
+
+    def optimize(self, value: tuple) -> tuple:
+        """Run the PNG or JPEG optimizers on the page"""
+        _, _, path = value
+        if path.suffix == FMT_PNG and self.png_programs:
+            png_optim.optimize(path, self.png_programs, False, False, None, False, None, self.png_jrnl, None, self.png_gate, self.budget)
+        elif path.suffix in (FMT_JPG, ".jpeg") and self.jpeg_programs:
+            jpeg_optim.optimize(path, self.jpeg_programs, False, None, None, self.jpeg_jrnl, self.jpeg_cache, self.jpeg_gate, self.budget)
+        return value
+
+    @staticmethod
+    def archive(value: tuple) -> Path:
+        """Append the page to the archive of its volume in place of the original page, the volumes are written in parallel"""
+        volume, original, path = value
+        return volume.archive.add(path, original)
+
+    def stages(self) -> List[tuple]:
+        """Stages of the pipeline"""
+        return [("classify", self.classify), ("convert", self.convert), ("optimize", self.optimize), ("archive", self.archive)]
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("input", type=Path, help="Path to manga directory")
+    parser.add_argument("input", type=Path, nargs="+", help="Path to manga directories, one per volume")
+    parser.add_argument("-a", "--archive", dest="archive", type=str, choices=[ARCHIVE_CBZ, ARCHIVE_TXZ], default=ARCHIVE_CBZ, help="Output, cbz: pages stored uncompressed with a ComicInfo.xml, txz: solid tar.xz for archival, default: cbz")
+    parser.add_argument("-c", "--opencl", dest="opencl", action="store_true", help="Detect grey pages on the GPU with OpenCL (needs pyopencl) instead of NumPy, default: false")
+    parser.add_argument("-v", "--verbose", dest="verbose", action="store_true", help="Verbose mode, default: false")
+    parser.add_argument("-j", "--jobs", dest="jobs", type=int, default=0, help="Number of pages processed simultaneously, default: number of CPUs")
+    parser.add_argument("-t", "--tolerance", dest="tolerance", type=int, default=0, help="Largest channel difference of a grey pixel (JPEG artifacts), default: 0")
     args = parser.parse_args()
 
     # Sanity checks
-    path = args.input.resolve()
-    if path.exists() is False or path.is_dir() is False:
+    paths = [x.resolve() for x in args.input]
+    if any(x.exists() is False or x.is_dir() is False for x in paths):
         common.abort(parser.format_help())
+    if args.opencl is True and cl is None:
+        common.abort(f"{common.COLOR_RED}[!] ERROR: pyopencl is not installed")
+
+    # Each directory is listed once, its archive is written as its pages come out of the optimizers
+    volumes = [Volume(x, args.archive) for x in paths]
+    all_pages = [page for volume in volumes for page in volume.pages]
+    print(f"{common.COLOR_WHITE}[+] {len(all_pages)} file(s) to process in {len(volumes)} volume(s)…")
 
-    # Get files list
-    all_files = common.list_directory(path, lambda x: x.suffix in [".png", ".jpg", ".jpeg", ".gif", ".bmp", ".tif", ".tiff"])
-    print(f"{common.COLOR_WHITE}[+] {len(all_files)} file(s) to analyze…")
-
-    # Analyze files
-    q_grey_conv = Queue()
-    q_color_conv = Queue()
-    t_start = time.time()
-    cl_ctx = cl.create_some_context()
-    cl_queue = cl.CommandQueue(cl_ctx)
-    cl_program = cl.Program(cl_ctx, CL_KERNEL).build()
-    for f in all_files:
-        img = Image.open(f).convert('RGBA')
-        is_grey = cl_is_grey(img, cl_ctx, cl_queue, cl_program)
-        if is_grey is True and imghdr.what(f) != "png":
-            q_grey_conv.put(f)
-        elif is_grey is False and imghdr.what(f) == "png":
-            q_color_conv.put(f)
-    t_end = time.time()
-    grey_count = q_grey_conv.qsize()
-    color_count = q_color_conv.qsize()
-    print(f"{common.COLOR_GREEN} ↳ Done in {t_end - t_start:4.2f}s :")
-    print(f"{common.COLOR_PURPLE}\t→ {grey_count} grayscaled file(s) need to be converted")
-    print(f"{common.COLOR_PURPLE}\t→ {color_count} colorized file(s) need to be converted")
-
-    # Convert grayscaled images to png
-    if grey_count > 0:
-        print(f"{common.COLOR_WHITE}[+] Converting {grey_count} grayscaled files…")
-        t = common.parallel(save_to_format, (q_grey_conv, ".png", ))
-        print(f"{common.COLOR_GREEN} ↳ Done in {t:4.2f}s")
-
-    # Convert colorized images to jpg
-    if color_count > 0:
-        print(f"{common.COLOR_WHITE}[+] Converting {color_count} colorized files…")
-        t = common.parallel(save_to_format, (q_color_conv, ".jpg", ))
-        print(f"{common.COLOR_GREEN} ↳ Done in {t:4.2f}s")
-
-    # Optimize png
-    png_files = common.list_directory(path, lambda x: x.suffix == ".png")
-    print(f"{common.COLOR_WHITE}[+] Optimizing {len(png_files)} PNG files…")
-    t_start = time.time()
-    os.system(f"png_optim.py -v -q -z -n {quote(str(path))}")
-    t_end = time.time()
-    print(f"{common.COLOR_GREEN} ↳ Done in {t_end - t_start:4.2f}s")
-
-    # Optimize jpg
-    jpg_files = common.list_directory(path, lambda x: x.suffix in [".jpg", ".jpeg"])
-    print(f"{common.COLOR_WHITE}[+] Optimizing {len(jpg_files)} JPEG files…")
-    t_start = time.time()
-    os.system(f"jpeg_optim.py -v -s -g {quote(str(path))}")
-    t_end = time.time()
-    print(f"{common.COLOR_GREEN} ↳ Done in {t_end - t_start:4.2f}s")
-
-    # txz
-    print(f"{common.COLOR_WHITE}[+] Compressing {path}")
-    t_start = time.time()
-    os.system(f'XZ_OPT="-T 0 -9" tar -Jcf {quote(str(path) + ".txz")} {quote(str(path))}')
-    t_end = time.time()
-    print(f"{common.COLOR_GREEN} ↳ Done in {t_end - t_start:4.2f}s")
+    # Each page goes through all the stages as soon as possible, all of them share one pool
+    LOGGER = logger.Logger(args.verbose)
+    png_optim.LOGGER = LOGGER
+    jpeg_optim.LOGGER = LOGGER
+    proc.configure(args.jobs)
+    workflow = Workflow(args.tolerance, volumes, args.opencl)
+    pipe = pipeline.Pipeline(workflow.stages(), args.jobs)
+    results, t = pipe.run(all_pages)
+    common.print_failures(results)
+    for volume in volumes:
+        if volume.close() != 0:
+            common.abort(f"{common.COLOR_RED}[!] ERROR: Failed to write {volume.output}")
+        print(f"{common.COLOR_WHITE}[+] {volume.output}")
+    print(f"{common.COLOR_GREEN} ↳ Done in {t:4.2f}s :")
+    print(f"{common.COLOR_PURPLE}\t→ {workflow.converted[FMT_PNG]} grayscaled file(s) converted")
+    print(f"{common.COLOR_PURPLE}\t→ {workflow.converted[FMT_JPG]} colorized file(s) converted")
+    for line in pipe.report():
+        print(f"{common.COLOR_PURPLE}\t→ {line}")
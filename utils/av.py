@@ -5,10 +5,10 @@
 A/V Types
 """
 
-from typing import List
+import json
+from typing import List, Optional
 from pathlib import Path
-from shlex import quote
-from utils import common
+from utils import probecache, proc
 
 AUDIO_EXTENSIONS: List[str] = [
     str('.aac'),
@@ -53,8 +53,54 @@ SUBTITLE_EXTENSIONS: List[str] = [
 ]
 
 
-def get_file_infos(filepath: Path) -> str:
-    """ffmpeg -i `filepath`"""
-    data = common.system_call(
-        f"ffmpeg -hide_banner -i {quote(str(filepath))}", True).decode("utf-8")
-    return data
+class Stream:
+    """A stream of a media file as reported by ffprobe"""
+    __slots__ = ("index", "codec_type", "codec_name", "profile", "sample_rate", "channels", "bits_per_sample", "language", "title", "default", "forced")
+
+    def __init__(self, data: dict):
+        self.index = int(data["index"])
+        self.codec_type = str(data.get("codec_type", ""))
+        self.codec_name = str(data.get("codec_name", ""))
+        self.profile: Optional[str] = data.get("profile")
+        self.sample_rate = int(data["sample_rate"]) if "sample_rate" in data else None
+        self.channels = int(data["channels"]) if "channels" in data else None
+        bits = data.get("bits_per_raw_sample", data.get("bits_per_sample", 0))
+        self.bits_per_sample = int(bits) if bits else None
+        tags = {k.lower(): v for k, v in data.get("tags", {}).items()}
+        self.language: Optional[str] = tags.get("language")
+        self.title: Optional[str] = tags.get("title")
+        disposition = data.get("disposition", {})
+        self.default = bool(disposition.get("default", 0))
+        self.forced = bool(disposition.get("forced", 0))
+
+    def __str__(self):
+        return "{}:{}|{}".format(self.index, self.codec_name, self.language)
+
+    def __repr__(self):
+        return "{}:{}|{}".format(self.index, self.codec_name, self.language)
+
+
+class MediaInfo:
+    """Container and streams of a media file"""
+    __slots__ = ("path", "format_name", "duration", "bit_rate", "streams")
+
+    def __init__(self, path: Path, data: dict):
+        self.path = path
+        fmt = data.get("format", {})
+        self.format_name = str(fmt.get("format_name", ""))
+        self.duration = float(fmt["duration"]) if "duration" in fmt else None
+        self.bit_rate = int(fmt["bit_rate"]) if "bit_rate" in fmt else None
+        self.streams: List[Stream] = [Stream(x) for x in data.get("streams", [])]
+
+    def streams_of_type(self, codec_type: str) -> List[Stream]:
+        """Streams of `codec_type` (audio, video, subtitle…)"""
+        return [x for x in self.streams if x.codec_type == codec_type]
+
+
+def probe(filepath: Path) -> MediaInfo:
+    """ffprobe `filepath` (single cached call for the container and all streams)"""
+    def run_ffprobe() -> str:
+        res = proc.run(["ffprobe", "-v", "quiet", "-print_format", "json", "-show_streams", "-show_format", filepath])
+        return res.stdout.decode("utf-8", errors="replace") if res.returncode == 0 else None
+    data = probecache.cached("ffprobe", filepath, run_ffprobe)
+    return MediaInfo(filepath, json.loads(data) if data is not None else {})
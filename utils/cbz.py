@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+CBZ (comic book ZIP) archives
+- Output: pages are already compressed JPEG/PNG, they are stored without compression as they are added
+so readers can open them directly, a ComicInfo.xml describing the pages is written last.
+- Optimization in place: the images are extracted one by one to a scratch directory (in memory when
+possible) and optimized in parallel, the new archive is written in a single pass in the original order.
+"""
+
+import copy
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import zipfile
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+from xml.etree import ElementTree
+from PIL import Image  # pip3 install Pillow
+from utils import common, io, journal, resources, sniff
+
+COMIC_INFO = str("ComicInfo.xml")
+# Entries which are compressed anyway
+STORED_SUFFIXES = (".jpg", ".jpeg", ".png", ".gif", ".webp", ".jxl", ".avif")
+ARCHIVE_SUFFIXES = (".cbz", ".zip")
+# Fixed part of a local file header, the name and extra field lengths are at its end
+LOCAL_HEADER_SIZE = 30
+# General purpose flags: encrypted, sizes in a data descriptor after the data
+FLAG_ENCRYPTED = 0x01
+FLAG_DATA_DESCRIPTOR = 0x08
+# Members optimized ahead of the first one not yet written, per worker
+REORDER_WINDOW = 4
+# Name of the directories of the members being optimized
+SCRATCH_PREFIX = str(".archive.")
+
+
+def comic_info(title: str, pages: List[Tuple[str, int, Tuple[int, int]]]) -> bytes:
+    """ComicInfo.xml of the volume `title`, `pages` are (name, size in bytes, (width, height)) in reading order"""
+    root = ElementTree.Element("ComicInfo")
+    ElementTree.SubElement(root, "Title").text = title
+    ElementTree.SubElement(root, "PageCount").text = str(len(pages))
+    node = ElementTree.SubElement(root, "Pages")
+    for index, (_, size, dimensions) in enumerate(pages):
+        attrs = {"Image": str(index), "ImageSize": str(size)}
+        if dimensions is not None:
+            attrs["ImageWidth"], attrs["ImageHeight"] = str(dimensions[0]), str(dimensions[1])
+        if index == 0:
+            attrs["Type"] = "FrontCover"
+        ElementTree.SubElement(node, "Page", attrs)
+    ElementTree.indent(root)
+    return ElementTree.tostring(root, encoding="utf-8", xml_declaration=True)
+
+
+def _dimensions(path: Path) -> Tuple[int, int]:
+    """Size of the image at `path` from its header, None if unreadable"""
+    try:
+        with Image.open(path) as img:
+            return img.size
+    except OSError:
+        return None
+
+
+class CbzWriter:
+    """CBZ of the directory `root` written to `dst` as the files are added, safe to share between threads.
+    The `files` expected are written in that order, a file added before the ones preceding it waits on disk until they are."""
+
+    def __init__(self, root: Path, dst: Path, files: List[Path], compression: int = zipfile.ZIP_STORED):
+        self.root = root
+        self.compression = compression
+        self.files = files
+        self.added = set()
+        self._slots = {x: i for i, x in enumerate(files)}
+        self._ready: Dict[int, Tuple[Path, Tuple[int, int]]] = {}
+        self._next = 0
+        self._pages: List[Tuple[str, int, Tuple[int, int]]] = []
+        self._has_info = False
+        self._lock = threading.Lock()
+        self._zip = zipfile.ZipFile(dst, "w", allowZip64=True)
+
+    def add(self, path: Path, slot: Path = None) -> Path:
+        """Add the file at `path` in place of the expected file `slot` (itself by default), images are stored as is and listed in the ComicInfo.xml"""
+        slot = slot if slot is not None else path
+        dimensions = _dimensions(path) if path.suffix.lower() in STORED_SUFFIXES else None
+        with self._lock:
+            self._ready[self._slots[slot]] = (path, dimensions)
+            self.added.add(slot)
+            self._flush(False)
+        return path
+
+    def _flush(self, final: bool):
+        """Write the files added in order, up to the first one missing unless `final`"""
+        while self._next < len(self.files):
+            entry = self._ready.pop(self._next, None)
+            if entry is None and final is False:
+                break
+            if entry is not None:
+                self._write(*entry)
+            self._next += 1
+
+    def _write(self, path: Path, dimensions: Tuple[int, int]):
+        name = path.relative_to(self.root).as_posix()
+        is_page = path.suffix.lower() in STORED_SUFFIXES
+        self._zip.write(path, name, compress_type=self.compression if is_page is True else zipfile.ZIP_DEFLATED)
+        if is_page is True:
+            self._pages.append((name, path.stat().st_size, dimensions))
+        elif name == COMIC_INFO:
+            self._has_info = True
+
+    def close(self) -> int:
+        """Write the files left (the missing ones are skipped), the ComicInfo.xml (unless the directory had one) and the central directory, returns 0"""
+        with self._lock:
+            self._flush(True)
+            if self._has_info is False:
+                self._zip.writestr(COMIC_INFO, comic_info(self.root.name, self._pages), compress_type=zipfile.ZIP_DEFLATED)
+            self._zip.close()
+        return 0
+
+
+def is_archive(path: Path) -> bool:
+    """Check if `path` is a CBZ/ZIP file"""
+    return path.is_file() is True and path.suffix.lower() in ARCHIVE_SUFFIXES and zipfile.is_zipfile(path)
+
+
+def scratch_dir(near: Path) -> Path:
+    """Private directory for the members being optimized, in memory when /dev/shm is available"""
+    shm = Path("/dev/shm")
+    parent = shm if shm.is_dir() is True and os.access(shm, os.W_OK) is True else near.parent
+    return Path(tempfile.mkdtemp(prefix=SCRATCH_PREFIX, dir=parent))
+
+
+def is_scratch(path: Path) -> bool:
+    """Check if `path` is a member being optimized"""
+    return Path(path).parent.name.startswith(SCRATCH_PREFIX)
+
+
+def raw_copy(src, dst: zipfile.ZipFile, info: zipfile.ZipInfo):
+    """Append the member `info` of the archive file object `src` to `dst` without decompressing it"""
+    header = os.pread(src.fileno(), LOCAL_HEADER_SIZE, info.header_offset)
+    name_size, extra_size = struct.unpack("<HH", header[26:30])
+    zinfo = copy.copy(info)
+    # The sizes and CRC are known, they go in the local header
+    zinfo.flag_bits &= ~FLAG_DATA_DESCRIPTOR
+    zinfo.header_offset = dst.fp.tell()
+    zip64 = zinfo.file_size > zipfile.ZIP64_LIMIT or zinfo.compress_size > zipfile.ZIP64_LIMIT
+    dst.fp.write(zinfo.FileHeader(zip64))
+    io.copy_range(src, dst.fp, info.header_offset + LOCAL_HEADER_SIZE + name_size + extra_size, info.compress_size)
+    # zipfile has no API to add already compressed data, its bookkeeping is updated the same way `write` does
+    dst.filelist.append(zinfo)
+    dst.NameToInfo[zinfo.filename] = zinfo
+    dst.start_dir = dst.fp.tell()
+
+
+def _write_member(dst: zipfile.ZipFile, info: zipfile.ZipInfo, path: Path):
+    """Append the file at `path` as the member `info`, same name, timestamp, attributes and compression"""
+    zinfo = zipfile.ZipInfo(info.filename, info.date_time)
+    zinfo.compress_type = info.compress_type
+    zinfo.external_attr = info.external_attr
+    zinfo.create_system = info.create_system
+    zinfo.comment = info.comment
+    zinfo.file_size = path.stat().st_size
+    with open(path, "rb") as f, dst.open(zinfo, "w") as w:
+        shutil.copyfileobj(f, w, 1048576)
+
+
+def _optimize_member(item: Tuple[int, zipfile.ZipInfo], src: zipfile.ZipFile, scratch: Path, fct: Callable, args: tuple, types: List[str]) -> Path:
+    """Extract a member and optimize it with `fct(file, *args)`, returns the optimized file, None if it is not smaller"""
+    index, info = item
+    tmpfile = scratch / f"{index:06d}{Path(info.filename).suffix.lower()}"
+    with src.open(info) as member, open(tmpfile, "wb") as f:
+        shutil.copyfileobj(member, f, 1048576)
+    if sniff.classify(tmpfile) in types:
+        fct(tmpfile, *args)
+        if tmpfile.exists() is True and tmpfile.stat().st_size < info.file_size:
+            return tmpfile
+    if tmpfile.exists() is True:
+        tmpfile.unlink()
+    return None
+
+
+def optimize_archive(path: Path, fct: Callable, args: tuple, types: List[str], suffixes: Tuple[str, ...], max_workers: int = 0) -> Tuple[List[common.JobResult], float]:
+    """Optimize in place the members of the archive at `path` having one of `suffixes` and one of the sniffed `types`, with `fct(file, *args)`.
+    Members are optimized in parallel and written back in order as soon as the ones before them are, the unchanged ones are copied raw.
+    No member more than `REORDER_WINDOW` per worker past the first one not yet written is started, which bounds the scratch space.
+    Returns a result per optimized member (value: sizes before and after) and the elapsed time."""
+    t_start = time.time()
+    tmpfile = path.with_name(f".{path.name}.tmp")
+    scratch = scratch_dir(path)
+    results: List[common.JobResult] = []
+    changed = False
+    try:
+        with zipfile.ZipFile(path, "r") as src, open(path, "rb") as raw, zipfile.ZipFile(tmpfile, "w", allowZip64=True) as dst:
+            dst.comment = src.comment
+            members = src.infolist()
+            candidates = [(i, x) for i, x in enumerate(members) if x.is_dir() is False and (x.flag_bits & FLAG_ENCRYPTED) == 0 and Path(x.filename).suffix.lower() in suffixes]
+            indexes = {i for i, _ in candidates}
+            finished: Dict[int, common.JobResult] = {}
+            next_index = 0
+            window = common.pool_size(len(candidates), max_workers) * REORDER_WINDOW
+
+            def flush():
+                nonlocal next_index, changed
+                while next_index < len(members) and (next_index not in indexes or next_index in finished):
+                    info = members[next_index]
+                    res = finished.pop(next_index, None)
+                    if res is not None and res.status == 0 and res.value is not None:
+                        _write_member(dst, info, res.value)
+                        results.append(common.JobResult(f"{path}:{info.filename}", (info.file_size, res.value.stat().st_size), 0, None, res.elapsed))
+                        res.value.unlink()
+                        changed = True
+                    else:
+                        raw_copy(raw, dst, info)
+                        if res is not None:
+                            results.append(common.JobResult(f"{path}:{info.filename}", (info.file_size, info.file_size), res.status, res.error, res.elapsed))
+                    next_index += 1
+
+            for future in common.submit_jobs(_optimize_member, candidates, (src, scratch, fct, args, types), max_workers, ready=lambda x: x[0] < next_index + window):
+                res = future.result()
+                finished[res.item[0]] = res
+                flush()
+            flush()
+        if changed is True:
+            shutil.copymode(path, tmpfile)
+            tmpfile.replace(path)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+        if tmpfile.exists() is True:
+            tmpfile.unlink()
+    return results, time.time() - t_start
+
+
+def optimize_journaled(path: Path, fct: Callable, args: tuple, types: List[str], suffixes: Tuple[str, ...], jrnl: journal.Journal, budget: resources.Budget, max_workers: int = 0) -> Tuple[List[common.JobResult], float]:
+    """`optimize_archive` recorded as a whole in `jrnl`, done unless a member was not finished within `budget`.
+    The members are scratch files, `args` should give `fct` a `journal.NullJournal`."""
+    before = len(budget.unreached)
+    results, t = optimize_archive(path, fct, args, types, suffixes, max_workers)
+    if len(budget.unreached) > before:
+        # What is left to do is the archive, not its members
+        del budget.unreached[before:]
+        budget.unreached_file(path)
+        jrnl.pending(path)
+    else:
+        jrnl.done(path)
+    return results, t
@@ -10,11 +10,14 @@ import sys
 import subprocess
 import multiprocessing
 import platform
+import queue
+import re
+import threading
 import time
-from threading import Thread
-from queue import Queue
+from collections import namedtuple
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
 from pathlib import Path
-from typing import List
+from typing import Dict, Iterable, Iterator, List, Tuple
 
 COLOR_BLUE = '\033[94m'
 COLOR_GREEN = '\033[92m'
@@ -23,6 +26,8 @@ COLOR_RED = '\033[91m'
 COLOR_WHITE = '\033[0m'
 COLOR_YELLOW = '\033[93m'
 
+JobResult = namedtuple('JobResult', ['item', 'value', 'status', 'error', 'elapsed'])
+
 def str2bool(value: str) -> bool:
     """Convert `value` to a bool"""
     lpv = value.lower()
@@ -36,6 +41,10 @@ def clamp(n, lo, hi):
     """Clamp a value"""
     return max(lo, min(n, hi))
 
+def natural_key(path: Path) -> list:
+    """Sort key of `path` comparing the numbers by value, 9.jpg before 10.jpg"""
+    return [int(x) if x.isdigit() is True else x.lower() for x in re.split(r"(\d+)", str(path))]
+
 def list_directory(path: Path, filt: callable = None, sort: bool = False) -> List[Path]:
     """Returns the list of files at `path`"""
     ret: List[Path] = []
@@ -46,35 +55,140 @@ def list_directory(path: Path, filt: callable = None, sort: bool = False) -> Lis
             ret.append(path)
         return ret
 
-    for entry in os.listdir(path):
-        if entry.startswith('.') is True:
-            continue
-        p = path / entry
-        if filt is None or callable(filt) is False:
-            ret.append(p)
-        elif filt(p) is True:
-            ret.append(p)
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.name.startswith('.') is True:
+                continue
+            p = path / entry.name
+            if filt is None or callable(filt) is False:
+                ret.append(p)
+            elif filt(p) is True:
+                ret.append(p)
     return ret if sort is False else sorted(ret)
 
 
 def walk_directory(path: Path, filt: callable = None) -> List[Path]:
     """walk directory at `path`. (returns all files within subdirectories)"""
-    ret: List[Path] = []
+    if filt is None or callable(filt) is False:
+        return [entry.path for entry in scan_directory(path)]
+    return [entry.path for entry in scan_directory(path, lambda x: filt(x.path))]
+
+
+class ScanEntry:
+    """A file found by `scan_directory`, with the stat result gathered during the scan"""
+    __slots__ = ("path", "stat")
+
+    def __init__(self, path: Path, stat: os.stat_result):
+        self.path = path
+        self.stat = stat
+
+    def __str__(self):
+        return str(self.path)
+
+    def __repr__(self):
+        return str(self.path)
+
+    def __fspath__(self):
+        return str(self.path)
+
+
+SCAN_BATCH_SIZE = 256
+
+
+def scan_directory(path: Path, filt: callable = None, recursive: bool = True, max_workers: int = 0) -> Iterator[ScanEntry]:
+    """Yields the files at `path` as `ScanEntry` while the scan is still running.
+    Subdirectories are listed in parallel with `os.scandir`, `filt` receives a `ScanEntry` and runs in the scanning threads.
+    A file reached through several hardlinks is only yielded once, by the first path found.
+    Symlinks are held until the end of the scan, a file only reached through symlinks is yielded by the first of them in order.
+    A `path` which is not a directory is yielded as is, unless `filt` rejects it."""
     if path.is_dir() is False:
-        if filt is None or callable(filt) is False:
-            ret.append(path)
-        elif filt(path) is True:
-            ret.append(path)
-        return ret
+        try:
+            entry = ScanEntry(path, path.stat())
+            if filt is not None and filt(entry) is False:
+                return
+        except OSError:
+            # The job on the file reports the error
+            entry = ScanEntry(path, None)
+        yield entry
+        return
 
-    for root, _, files in os.walk(path):
-        for entry in files:
-            p = Path(root) / entry
-            if filt is None or callable(filt) is False:
-                ret.append(p)
-            elif filt(p) is True:
-                ret.append(p)
-    return ret
+    results = queue.Queue()
+    # Inodes yielded, and the symlinks to files resolved at the end
+    seen = set()
+    links: Dict[tuple, List[ScanEntry]] = {}
+    state = {"pending": 1, "stop": False}
+    lock = threading.Lock()
+    done = object()
+
+    def scan_one(directory: str):
+        batch: List[ScanEntry] = []
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if state["stop"] is True:
+                        break
+                    try:
+                        if entry.is_dir():
+                            if recursive is True and entry.is_symlink() is False:
+                                with lock:
+                                    state["pending"] += 1
+                                pool.submit(scan_one, entry.path)
+                            continue
+                        if entry.is_file() is False:
+                            continue
+                        st = entry.stat()
+                    except OSError:
+                        continue
+                    item = ScanEntry(Path(entry.path), st)
+                    key = (st.st_dev, st.st_ino)
+                    with lock:
+                        if entry.is_symlink() is True:
+                            links.setdefault(key, []).append(item)
+                            continue
+                        if key in seen:
+                            continue
+                        seen.add(key)
+                    try:
+                        if filt is not None and filt(item) is False:
+                            continue
+                    except OSError:
+                        continue
+                    batch.append(item)
+                    if len(batch) >= SCAN_BATCH_SIZE:
+                        results.put(batch)
+                        batch = []
+        except OSError:
+            pass
+        finally:
+            if batch:
+                results.put(batch)
+            with lock:
+                state["pending"] -= 1
+                finished = state["pending"] == 0
+            if finished is True:
+                results.put(done)
+
+    pool = ThreadPoolExecutor(max_workers=pool_size(None, max_workers) * 2, thread_name_prefix="scan")
+    try:
+        pool.submit(scan_one, str(path))
+        while True:
+            batch = results.get()
+            if batch is done:
+                break
+            yield from batch
+        for key, entries in sorted(links.items(), key=lambda x: min(str(y.path) for y in x[1])):
+            if key in seen:
+                continue
+            item = min(entries, key=lambda x: str(x.path))
+            try:
+                if filt is not None and filt(item) is False:
+                    continue
+            except OSError:
+                continue
+            yield item
+    finally:
+        state["stop"] = True
+        pool.shutdown(wait=False, cancel_futures=True)
 
 def is_executable(path: Path) -> bool:
     """Check if `path` is executable"""
@@ -95,23 +209,71 @@ def which(program: Path) -> Path:
 
     return None
 
-def as_queue(lst: list) -> Queue:
-    """returns `lst` as a Queue"""
-    q = Queue()
-    for x in lst:
-        q.put(x)
-    return q
+def pool_size(count: int = None, max_workers: int = 0) -> int:
+    """Number of workers needed for `count` jobs, capped to `max_workers` (or the number of CPUs if <= 0)"""
+    workers = multiprocessing.cpu_count() if max_workers <= 0 else max_workers
+    if count is not None:
+        workers = min(workers, count)
+    return max(workers, 1)
 
-def parallel(fct: callable, args: tuple, max_threads: int = multiprocessing.cpu_count()) -> float:
-    """Execute `fct` with `args` in parallel"""
+def run_job(fct: callable, item, args: tuple) -> JobResult:
+    """Execute `fct(item, *args)` and wrap the outcome, an int return value is considered as the exit status"""
     t_start = time.time()
-    queue = args[0]
-    for i in range(max_threads):
-        th = Thread(target=fct, args=args, name=str(i), daemon=True)
-        th.start()
-    queue.join()
+    try:
+        value = fct(item, *args)
+    except Exception as e:  # pylint: disable=broad-except
+        return JobResult(item, None, -1, e, time.time() - t_start)
+    status = value if isinstance(value, int) and not isinstance(value, bool) else 0
+    return JobResult(item, value, status, None, time.time() - t_start)
+
+def submit_jobs(fct: callable, items: Iterable, args: tuple = (), max_workers: int = 0, processes: bool = False, ready: callable = None) -> Iterator[Future]:
+    """Execute `fct(item, *args)` for each of `items` in a thread (or process) pool, yields the futures as they complete.
+    The pool is sized to the number of items when known and items are pulled on demand, so `items` can be a generator.
+    If `ready(item)` is False the item (and the ones after it) is held back until the consumer of a completed job makes it True."""
+    count = len(items) if hasattr(items, "__len__") else None
+    if count == 0:
+        return
+    workers = pool_size(count, max_workers)
+    if processes is True:
+        pool = ProcessPoolExecutor(max_workers=workers)
+    else:
+        pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="th")
+    with pool:
+        iterator = iter(items)
+        pending = set()
+        held = []
+        exhausted = False
+        while True:
+            # Keep every worker busy with one job in advance, without materializing `items`
+            while exhausted is False and len(pending) < workers * 2:
+                if len(held) == 0:
+                    try:
+                        held.append(next(iterator))
+                    except StopIteration:
+                        exhausted = True
+                        break
+                # Nothing left running to wait for, never hold back
+                if ready is not None and ready(held[0]) is False and len(pending) > 0:
+                    break
+                pending.add(pool.submit(run_job, fct, held.pop(), args))
+            if len(pending) == 0:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            yield from done
+
+def run_jobs(fct: callable, items: Iterable, args: tuple = (), max_workers: int = 0, processes: bool = False) -> Tuple[List[JobResult], float]:
+    """Execute `fct` for each of `items` in parallel, returns the results and the elapsed time"""
+    t_start = time.time()
+    results = [future.result() for future in submit_jobs(fct, items, args, max_workers, processes)]
     t_end = time.time()
-    return t_end - t_start
+    return results, t_end - t_start
+
+def print_failures(results: List[JobResult]):
+    """Display the jobs that raised or returned a non-zero exit status"""
+    for res in results:
+        if res.status != 0:
+            reason = res.error if res.error is not None else f"exit status {res.status}"
+            print(f"{COLOR_RED}[!] ERROR: {COLOR_YELLOW}{res.item}{COLOR_RED} failed ({reason}){COLOR_WHITE}")
 
 def abort(msg: str = None):
     """Exits the program and optionally display `msg`"""
@@ -120,20 +282,19 @@ def abort(msg: str = None):
     print(COLOR_WHITE)
     sys.exit(-1)
 
-def system_call(command: str, use_stderr: bool = False) -> str:
-    """Execute `command` and returns stdout or stderr depending on `use_stderr`"""
-    if use_stderr is True:
-        process = subprocess.Popen([command], stderr=subprocess.PIPE, shell=True)
-        return process.stderr.read()
-    process = subprocess.Popen([command], stdout=subprocess.PIPE, shell=True)
-    return process.stdout.read()
-
 def ensure_exist(programs: List[str]):
     """Exits if one of `programs` does not exist"""
     for p in programs:
         if which(Path(p)) is None:
             abort(f"{COLOR_RED}[!] {COLOR_WHITE}{p} {COLOR_RED}not found in $PATH")
 
+def cache_dir() -> Path:
+    """Per-user cache directory of these scripts ($XDG_CACHE_HOME/python-scripts), created if needed"""
+    base = os.environ.get("XDG_CACHE_HOME")
+    path = (Path(base) if base else Path.home() / ".cache") / "python-scripts"
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
 def copy_to_clipboard(data: str):
     """Copy data to the clipboard"""
     if platform.system() == 'Linux':
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+FLAC metadata blocks reader/writer
+Blocks are edited in memory and written back once: in place when the new metadata
+fits in the space of the old one (padding absorbs the difference), otherwise the audio
+frames are streamed to a temporary file which replaces the original.
+"""
+
+import os
+import shutil
+import struct
+import tempfile
+from collections import namedtuple
+from pathlib import Path
+from typing import Iterable, List, Tuple
+from utils import io
+
+BLOCK_STREAMINFO = 0
+BLOCK_PADDING = 1
+BLOCK_APPLICATION = 2
+BLOCK_SEEKTABLE = 3
+BLOCK_VORBIS_COMMENT = 4
+BLOCK_CUESHEET = 5
+BLOCK_PICTURE = 6
+
+BLOCK_NAMES = {
+    str("STREAMINFO"): BLOCK_STREAMINFO,
+    str("PADDING"): BLOCK_PADDING,
+    str("APPLICATION"): BLOCK_APPLICATION,
+    str("SEEKTABLE"): BLOCK_SEEKTABLE,
+    str("VORBIS_COMMENT"): BLOCK_VORBIS_COMMENT,
+    str("CUESHEET"): BLOCK_CUESHEET,
+    str("PICTURE"): BLOCK_PICTURE,
+}
+
+FLAC_MARKER = b"fLaC"
+# Largest block length storable in the 24 bits header field
+MAX_BLOCK_LENGTH = (1 << 24) - 1
+
+StreamInfo = namedtuple('StreamInfo', ['min_blocksize', 'max_blocksize', 'min_framesize', 'max_framesize', 'sample_rate', 'channels', 'bits_per_sample', 'total_samples', 'md5'])
+SeekPoint = namedtuple('SeekPoint', ['sample', 'offset', 'samples'])
+Picture = namedtuple('Picture', ['type', 'mime', 'description', 'width', 'height', 'depth', 'colors', 'data'])
+
+
+class FlacError(Exception):
+    """Raised for files which are not valid FLAC"""
+
+
+class MetadataBlock:
+    """A raw metadata block"""
+    __slots__ = ("type", "data")
+
+    def __init__(self, block_type: int, data: bytes):
+        self.type = block_type
+        self.data = data
+
+    def __repr__(self):
+        return f"{self.type}:{len(self.data)}"
+
+
+def parse_streaminfo(data: bytes) -> StreamInfo:
+    """STREAMINFO block content"""
+    if len(data) != 34:
+        raise FlacError("Invalid STREAMINFO")
+    min_bs, max_bs = struct.unpack(">HH", data[0:4])
+    min_fs = int.from_bytes(data[4:7], "big")
+    max_fs = int.from_bytes(data[7:10], "big")
+    packed = int.from_bytes(data[10:18], "big")
+    return StreamInfo(min_bs, max_bs, min_fs, max_fs, packed >> 44, ((packed >> 41) & 0x7) + 1, ((packed >> 36) & 0x1F) + 1, packed & 0xFFFFFFFFF, data[18:34])
+
+
+def parse_seektable(data: bytes) -> List[SeekPoint]:
+    """SEEKTABLE block content"""
+    return [SeekPoint(*struct.unpack_from(">QQH", data, pos)) for pos in range(0, len(data) - 17, 18)]
+
+
+def parse_picture(data: bytes) -> Picture:
+    """PICTURE block content"""
+    pos = 0
+
+    def read_u32() -> int:
+        nonlocal pos
+        value = struct.unpack_from(">I", data, pos)[0]
+        pos += 4
+        return value
+
+    def read_bytes(size: int) -> bytes:
+        nonlocal pos
+        if pos + size > len(data):
+            raise FlacError("Truncated PICTURE")
+        value = data[pos:pos + size]
+        pos += size
+        return value
+    try:
+        pic_type = read_u32()
+        mime = read_bytes(read_u32()).decode("ascii", errors="replace")
+        description = read_bytes(read_u32()).decode("utf-8", errors="replace")
+        width, height, depth, colors = read_u32(), read_u32(), read_u32(), read_u32()
+        return Picture(pic_type, mime, description, width, height, depth, colors, read_bytes(read_u32()))
+    except struct.error as e:
+        raise FlacError("Truncated PICTURE") from e
+
+
+def parse_vorbis_comment(data: bytes) -> Tuple[bytes, List[bytes]]:
+    """VORBIS_COMMENT block content as (vendor, raw comments), lengths are little endian"""
+    try:
+        size = struct.unpack_from("<I", data, 0)[0]
+        vendor = data[4:4 + size]
+        pos = 4 + size
+        count = struct.unpack_from("<I", data, pos)[0]
+        pos += 4
+        comments = []
+        for _ in range(count):
+            size = struct.unpack_from("<I", data, pos)[0]
+            pos += 4
+            comments.append(data[pos:pos + size])
+            pos += size
+    except struct.error as e:
+        raise FlacError("Truncated VORBIS_COMMENT") from e
+    if pos > len(data):
+        raise FlacError("Truncated VORBIS_COMMENT")
+    return vendor, comments
+
+
+def build_vorbis_comment(vendor: bytes, comments: List[bytes]) -> bytes:
+    """Serialize a VORBIS_COMMENT block content"""
+    parts = [struct.pack("<I", len(vendor)), vendor, struct.pack("<I", len(comments))]
+    for comment in comments:
+        parts.append(struct.pack("<I", len(comment)))
+        parts.append(comment)
+    return b"".join(parts)
+
+
+def _comment_name(comment: bytes) -> str:
+    """Field name of a raw `NAME=value` comment, field names are case insensitive ASCII"""
+    return comment.split(b"=", 1)[0].decode("ascii", errors="replace").upper()
+
+
+def _id3v2_size(header: bytes) -> int:
+    """Size of an ID3v2 tag prepended to the stream, 0 if none"""
+    if len(header) < 10 or header[0:3] != b"ID3":
+        return 0
+    size = 0
+    for b in header[6:10]:
+        size = (size << 7) | (b & 0x7F)
+    # Footer flag
+    return 10 + size + (10 if header[5] & 0x10 else 0)
+
+
+class FlacFile:
+    """Metadata of a FLAC file, edit the blocks then `save()`"""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.blocks: List[MetadataBlock] = []
+        self.modified = False
+        with open(path, "rb") as f:
+            self.prefix = _id3v2_size(f.read(10))
+            f.seek(self.prefix)
+            if f.read(4) != FLAC_MARKER:
+                raise FlacError(f"{path} is not a FLAC file")
+            last = False
+            while last is False:
+                header = f.read(4)
+                if len(header) != 4:
+                    raise FlacError(f"{path}: truncated metadata")
+                last = bool(header[0] & 0x80)
+                length = int.from_bytes(header[1:4], "big")
+                data = f.read(length)
+                if len(data) != length:
+                    raise FlacError(f"{path}: truncated metadata")
+                self.blocks.append(MetadataBlock(header[0] & 0x7F, data))
+            # First audio frame
+            self.audio_offset = f.tell()
+        if not self.blocks or self.blocks[0].type != BLOCK_STREAMINFO:
+            raise FlacError(f"{path}: STREAMINFO must be the first block")
+        self.metadata_length = self.audio_offset - self.prefix - len(FLAC_MARKER)
+
+    def streaminfo(self) -> StreamInfo:
+        """Parsed STREAMINFO"""
+        return parse_streaminfo(self.blocks[0].data)
+
+    def seektable(self) -> List[SeekPoint]:
+        """Parsed SEEKTABLE, empty if none"""
+        return [p for b in self.blocks if b.type == BLOCK_SEEKTABLE for p in parse_seektable(b.data)]
+
+    def pictures(self) -> List[Picture]:
+        """Parsed PICTURE blocks"""
+        return [parse_picture(b.data) for b in self.blocks if b.type == BLOCK_PICTURE]
+
+    def padding(self) -> int:
+        """Bytes of padding, headers included"""
+        return sum(4 + len(b.data) for b in self.blocks if b.type == BLOCK_PADDING)
+
+    def tags(self) -> List[Tuple[str, str]]:
+        """(name, value) of every comment"""
+        ret = []
+        for block in self.blocks:
+            if block.type == BLOCK_VORBIS_COMMENT:
+                for comment in parse_vorbis_comment(block.data)[1]:
+                    name, _, value = comment.decode("utf-8", errors="replace").partition("=")
+                    ret.append((name, value))
+        return ret
+
+    def remove_tags(self, names: Iterable[str]) -> int:
+        """Drop the comments whose field name is in `names` (case insensitive), returns the number removed"""
+        upper = set(x.upper() for x in names)
+        removed = 0
+        for block in self.blocks:
+            if block.type != BLOCK_VORBIS_COMMENT:
+                continue
+            vendor, comments = parse_vorbis_comment(block.data)
+            kept = [x for x in comments if _comment_name(x) not in upper]
+            if len(kept) != len(comments):
+                removed += len(comments) - len(kept)
+                block.data = build_vorbis_comment(vendor, kept)
+        if removed > 0:
+            self.modified = True
+        return removed
+
+    def remove_blocks(self, block_types: Iterable[int]) -> int:
+        """Drop every block of `block_types` (STREAMINFO is always kept), returns the number removed"""
+        types = set(block_types) - {BLOCK_STREAMINFO}
+        count = len(self.blocks)
+        self.blocks = [b for b in self.blocks if b.type not in types]
+        removed = count - len(self.blocks)
+        if removed > 0:
+            self.modified = True
+        return removed
+
+    def _serialize(self, blocks: List[MetadataBlock]) -> bytes:
+        """Blocks with their headers, the last one flagged"""
+        parts = []
+        for i, block in enumerate(blocks):
+            if len(block.data) > MAX_BLOCK_LENGTH:
+                raise FlacError(f"{self.path}: block too large")
+            flag = 0x80 if i == len(blocks) - 1 else 0
+            parts.append(bytes([flag | block.type]) + len(block.data).to_bytes(3, "big"))
+            parts.append(block.data)
+        return b"".join(parts)
+
+    def save(self, use_padding: bool = False) -> bool:
+        """Write the blocks back if modified, returns True if the file was rewritten in place.
+        With `use_padding` a PADDING block fills the freed space so the audio frames never move."""
+        if self.modified is False:
+            return False
+        blocks = [b for b in self.blocks if b.type != BLOCK_PADDING] if use_padding is True else self.blocks
+        metadata = self._serialize(blocks)
+        if use_padding is True:
+            free = self.metadata_length - len(metadata) - 4
+            if 0 <= free <= MAX_BLOCK_LENGTH:
+                metadata = self._serialize(blocks + [MetadataBlock(BLOCK_PADDING, bytes(free))])
+        if len(metadata) == self.metadata_length:
+            with open(self.path, "r+b") as f:
+                f.seek(self.prefix + len(FLAC_MARKER))
+                f.write(metadata)
+            self.modified = False
+            return True
+        self._rewrite(metadata)
+        self.modified = False
+        return False
+
+    def _rewrite(self, metadata: bytes):
+        """Single streamed copy: new metadata, then the audio frames, atomically replacing the file"""
+        path = Path(self.path)
+        fd, tmp = tempfile.mkstemp(prefix=f".{path.name}.", suffix=".tmp", dir=path.parent)
+        try:
+            with open(self.path, "rb") as src, os.fdopen(fd, "wb") as dst:
+                if self.prefix > 0:
+                    io.copy_range(src, dst, 0, self.prefix)
+                dst.write(FLAC_MARKER)
+                dst.write(metadata)
+                io.copy_range(src, dst, self.audio_offset)
+            shutil.copymode(self.path, tmp)
+            os.replace(tmp, self.path)
+        except BaseException:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+        self.audio_offset = self.prefix + len(FLAC_MARKER) + len(metadata)
+        self.metadata_length = len(metadata)
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+Perceptual hashes of images and near duplicate search
+Images are decoded once to small grayscale thumbnails, the dHash and pHash of a whole batch
+are computed at once with NumPy. 64 bits hashes are indexed in a BK-tree, which finds all
+the hashes within a Hamming distance without comparing every pair.
+"""
+
+import sqlite3
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+import numpy
+from PIL import Image  # pip3 install Pillow
+from utils import common, probecache
+
+ALGO_DHASH = str("dhash")
+ALGO_PHASH = str("phash")
+
+# dHash compares adjacent pixels of a 9x8 thumbnail, pHash keeps the 8x8 lowest frequencies of a 32x32 one
+DHASH_SIZE = (9, 8)
+PHASH_SIZE = (32, 32)
+PHASH_LOW = 8
+BATCH_SIZE = 256
+# JPEG are decoded at the smallest DCT scale above this size
+DRAFT_SIZE = (128, 128)
+
+_DCT: Optional[numpy.ndarray] = None
+
+
+def _dct_matrix(n: int) -> numpy.ndarray:
+    """Orthonormal DCT-II matrix, `m @ x @ m.T` is the 2D DCT of `x`"""
+    k = numpy.arange(n)[:, None]
+    m = numpy.cos(numpy.pi * (2 * numpy.arange(n)[None, :] + 1) * k / (2 * n)) * numpy.sqrt(2 / n)
+    m[0] /= numpy.sqrt(2)
+    return m
+
+
+def _pack(bits: numpy.ndarray) -> List[int]:
+    """(n, 64) booleans to n integers"""
+    return [int(x) for x in numpy.packbits(bits, axis=1).view(">u8").ravel()]
+
+
+def load_thumbnails(path: Path) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    """Grayscale dHash and pHash thumbnails of the image at `path`, decoded once"""
+    with Image.open(path) as img:
+        # Let the JPEG decoder skip most of the work
+        img.draft("L", DRAFT_SIZE)
+        grey = img.convert("L")
+    return (numpy.asarray(grey.resize(DHASH_SIZE, Image.LANCZOS), dtype=numpy.float32),
+            numpy.asarray(grey.resize(PHASH_SIZE, Image.LANCZOS), dtype=numpy.float32))
+
+
+def dhash_batch(thumbnails: numpy.ndarray) -> List[int]:
+    """dHash of (n, 8, 9) thumbnails: is each pixel brighter than its left neighbour"""
+    return _pack((thumbnails[:, :, 1:] > thumbnails[:, :, :-1]).reshape(len(thumbnails), -1))
+
+
+def phash_batch(thumbnails: numpy.ndarray) -> List[int]:
+    """pHash of (n, 32, 32) thumbnails: is each low frequency above their median (DC excluded)"""
+    global _DCT  # pylint: disable=global-statement
+    if _DCT is None:
+        _DCT = _dct_matrix(PHASH_SIZE[0])
+    coeffs = (_DCT @ thumbnails @ _DCT.T)[:, :PHASH_LOW, :PHASH_LOW].reshape(len(thumbnails), -1)
+    median = numpy.median(coeffs[:, 1:], axis=1)
+    return _pack(coeffs > median[:, None])
+
+
+def hamming(a: int, b: int) -> int:
+    """Number of differing bits"""
+    return bin(a ^ b).count("1")
+
+
+def _cached(path: Path) -> Optional[str]:
+    """Hashes of `path` stored in the probe cache (dhash:phash), None if unknown"""
+    try:
+        return probecache.default().get("imagehash", path)
+    except (sqlite3.Error, OSError):
+        return None
+
+
+def _store(path: Path, dhash: int, phash: int):
+    """Keep the hashes of `path` in the probe cache"""
+    try:
+        probecache.default().put("imagehash", path, f"{dhash:016x}:{phash:016x}")
+    except (sqlite3.Error, OSError):
+        pass
+
+
+def hash_files(paths: Iterable[Path], use_cache: bool = True, max_workers: int = 0) -> Tuple[Dict[Path, Dict[str, int]], List[common.JobResult]]:
+    """dHash and pHash of `paths`, returns them and the failed decodes.
+    Thumbnails are decoded in a process pool, hashed by batches, and the hashes kept in the probe cache"""
+    hashes: Dict[Path, Dict[str, int]] = {}
+    missing: List[Path] = []
+    for path in paths:
+        data = _cached(path) if use_cache is True else None
+        if data is not None:
+            dhash, phash = data.split(":")
+            hashes[path] = {ALGO_DHASH: int(dhash, 16), ALGO_PHASH: int(phash, 16)}
+        else:
+            missing.append(path)
+    failures = []
+    batch: List[common.JobResult] = []
+
+    def flush():
+        dhashes = dhash_batch(numpy.stack([x.value[0] for x in batch]))
+        phashes = phash_batch(numpy.stack([x.value[1] for x in batch]))
+        for res, dhash, phash in zip(batch, dhashes, phashes):
+            hashes[res.item] = {ALGO_DHASH: dhash, ALGO_PHASH: phash}
+            if use_cache is True:
+                _store(res.item, dhash, phash)
+        batch.clear()
+
+    # A single process pool for all the thumbnails
+    for future in common.submit_jobs(load_thumbnails, missing, max_workers=max_workers, processes=True):
+        res = future.result()
+        if res.status != 0:
+            failures.append(res)
+            continue
+        batch.append(res)
+        if len(batch) >= BATCH_SIZE:
+            flush()
+    if batch:
+        flush()
+    return hashes, failures
+
+
+class BKTree:
+    """Burkhard-Keller tree of 64 bits hashes under the Hamming distance, items sharing a hash share a node"""
+
+    def __init__(self):
+        # [hash, items, {distance: child}]
+        self.root = None
+        self.size = 0
+
+    def add(self, value: int, item):
+        """Index `item` under the hash `value`"""
+        self.size += 1
+        if self.root is None:
+            self.root = [value, [item], {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming(value, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, [item], {}]
+                return
+            node = child
+
+    def search(self, value: int, radius: int) -> List[Tuple[int, list]]:
+        """(distance, items) of the hashes within `radius` of `value`"""
+        ret = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming(value, node[0])
+            if distance <= radius:
+                ret.append((distance, node[1]))
+            # Triangle inequality: only the children at |d - radius|..d + radius can match
+            for d, child in node[2].items():
+                if distance - radius <= d <= distance + radius:
+                    stack.append(child)
+        return ret
+
+
+def duplicate_groups(hashes: Dict[Path, int], radius: int, rank: Callable[[Path], tuple] = None) -> List[List[Path]]:
+    """Groups of near duplicate paths, largest first. Each group starts with its original, the best path by `rank` (lowest first)
+    among the ones left, and holds the paths within `radius` of it: unlike connected components, a chain of close images
+    never puts two images farther than `radius` apart in the same group."""
+    tree = BKTree()
+    by_hash: Dict[int, List[Path]] = {}
+    for path, value in hashes.items():
+        by_hash.setdefault(value, []).append(path)
+    for value in by_hash:
+        tree.add(value, value)
+    # Only the paths with a neighbour can be in a group, they are the only ones ranked
+    neighbours = {value: [x for _, items in tree.search(value, radius) for x in items] for value in by_hash}
+    candidates = [path for value, paths in by_hash.items() if len(paths) > 1 or len(neighbours[value]) > 1 for path in paths]
+    candidates.sort(key=rank if rank is not None else str)
+    grouped = set()
+    groups: List[List[Path]] = []
+    for original in candidates:
+        if original in grouped:
+            continue
+        group = [original] + sorted(x for value in neighbours[hashes[original]] for x in by_hash[value] if x != original and x not in grouped)
+        if len(group) > 1:
+            grouped.update(group)
+            groups.append(group)
+    return sorted(groups, key=len, reverse=True)
@@ -9,6 +9,7 @@ import os
 import shutil
 from pathlib import Path
 from typing import List
+from utils import proc
 
 
 def cp_file(src: Path, dst: Path):
@@ -66,31 +67,52 @@ def chown(path: Path, usr: str, grp: str):
     shutil.chown(path, user=usr, group=grp)
 
 
-def tar_xz(src: Path, dst: Path):
-    """XZ_OPT=-9 tar -Jcf"""
-    os.system(f"XZ_OPT=-9 tar -Jcf {str(dst)} {str(src)}")
-
-
-def tar_gz(src: Path, dst: Path):
-    """tar cf - INPUT | gzip --best > OUTPUT.tar.gz"""
-    os.system(f"GZ_OPT=-9 tar -czf {str(dst)} {str(src)}")
+def tar_xz(src: Path, dst: Path) -> bool:
+    """XZ_OPT=-9 tar -Jcf, returns True on success"""
+    return proc.check(proc.run(["tar", "-Jcf", dst, src], capture=False, env={**os.environ, "XZ_OPT": "-9"}))
+
+
+def tar_gz(src: Path, dst: Path) -> bool:
+    """tar cf - INPUT | gzip --best > OUTPUT.tar.gz, returns True on success"""
+    return proc.check(proc.run(["tar", "-czf", dst, src], capture=False, env={**os.environ, "GZ_OPT": "-9"}))
+
+
+def copy_range(src, dst, offset: int, count: int = -1):
+    """Copy `count` bytes (everything if -1) of the file object `src` from `offset` to the current position of `dst`, in kernel when possible"""
+    if count < 0:
+        count = os.fstat(src.fileno()).st_size - offset
+    dst.flush()
+    out_fd = dst.fileno()
+    in_fd = src.fileno()
+    while count > 0:
+        try:
+            if hasattr(os, "copy_file_range"):
+                n = os.copy_file_range(in_fd, out_fd, count, offset)
+            else:
+                n = os.sendfile(out_fd, in_fd, offset, count)
+        except OSError:
+            # Cross filesystem or unsupported file types, plain copy
+            break
+        if n == 0:
+            break
+        offset += n
+        count -= n
+    # Resync the file objects with what the kernel copied
+    dst.seek(os.lseek(out_fd, 0, os.SEEK_CUR))
+    src.seek(offset)
+    while count > 0:
+        chunk = src.read(min(count, 1048576))
+        if not chunk:
+            break
+        dst.write(chunk)
+        count -= len(chunk)
+    dst.flush()
 
 
 def match_signature(path: Path, signatures: List[bytes]) -> bool:
-    """Check if `path` match a signature"""
-    def all_items_equal(lst: List) -> bool:
-        """Returns True if all items in `lst` are equal"""
-        return not lst or lst.count(lst[0]) == len(lst)
-    if path.is_dir():
+    """Check if `path` match a signature, the file is read once"""
+    if not signatures or path.is_dir():
         return False
-    if all_items_equal(list(map(len, signatures))) is True:
-        with open(path, "rb") as f:
-            b = f.read(len(signatures[0]))
-            return b in signatures
-    else:
-        for s in signatures:
-            with open(path, "rb") as f:
-                b = f.read(len(s))
-                if b == s:
-                    return True
-    return False
+    with open(path, "rb") as f:
+        b = f.read(max(map(len, signatures)))
+    return any(b.startswith(s) for s in signatures)
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+Job journal for long batch runs
+Each (operation, input, parameters) is recorded with its state (pending, running, done, failed),
+an interrupted run is resumed by skipping the jobs done on an unchanged input and removing
+the temporary outputs left by the jobs that were running when it died.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import List
+from utils import common, probecache
+
+STATE_PENDING = str("pending")
+STATE_RUNNING = str("running")
+STATE_DONE = str("done")
+STATE_FAILED = str("failed")
+
+# Finished entries not seen for this long are forgotten
+MAX_AGE = 180 * 86400
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    operation TEXT NOT NULL,
+    params TEXT NOT NULL,
+    path TEXT NOT NULL,
+    fingerprint TEXT,
+    state TEXT NOT NULL,
+    output TEXT,
+    temps TEXT NOT NULL DEFAULT '[]',
+    pid INTEGER,
+    error TEXT,
+    updated REAL NOT NULL,
+    PRIMARY KEY (operation, params, path)
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (operation, state);
+"""
+
+
+def fingerprint(path: Path) -> str:
+    """Identity of the content of `path`, None if it does not exist"""
+    try:
+        return ":".join(str(x) for x in probecache.file_key(path))
+    except OSError:
+        return None
+
+
+def _is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class Journal:
+    """Journal of the `operation` jobs run with `params` (any JSON serializable value), safe to share between threads.
+    With `redo` nothing is considered done, the jobs are still recorded."""
+
+    def __init__(self, operation: str, params, redo: bool = False, db_path: Path = None):
+        self.operation = operation
+        self.redo = redo
+        self.params = json.dumps(params, sort_keys=True, default=str)
+        self.db_path = db_path if db_path is not None else common.cache_dir() / "journal.sqlite"
+        self._local = threading.local()
+
+    def _connection(self) -> sqlite3.Connection:
+        """One connection per thread (and per process after a fork)"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(str(self.db_path), timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _set(self, path: Path, state: str, **fields):
+        columns = ["state", "updated"] + list(fields.keys())
+        values = [state, time.time()] + list(fields.values())
+        self._connection().execute(
+            f"INSERT INTO jobs (operation, params, path, {', '.join(columns)}) VALUES (?, ?, ?, {', '.join('?' * len(columns))}) "
+            f"ON CONFLICT (operation, params, path) DO UPDATE SET {', '.join(f'{c} = excluded.{c}' for c in columns)}",
+            (self.operation, self.params, os.path.abspath(path), *values))
+
+    def recover(self) -> int:
+        """Clean the jobs of dead runs: remove their temporary outputs and put them back to pending, returns the number of jobs recovered"""
+        conn = self._connection()
+        conn.execute("DELETE FROM jobs WHERE operation = ? AND state IN (?, ?) AND updated < ?", (self.operation, STATE_DONE, STATE_FAILED, time.time() - MAX_AGE))
+        rows = conn.execute("SELECT params, path, temps, pid FROM jobs WHERE operation = ? AND state = ?", (self.operation, STATE_RUNNING)).fetchall()
+        count = 0
+        for params, path, temps, pid in rows:
+            if pid is not None and pid != os.getpid() and _is_alive(pid) is True:
+                # Another run in progress
+                continue
+            for temp in json.loads(temps):
+                try:
+                    os.unlink(temp)
+                except FileNotFoundError:
+                    pass
+            conn.execute("UPDATE jobs SET state = ?, temps = '[]', pid = NULL, updated = ? WHERE operation = ? AND params = ? AND path = ?",
+                         (STATE_PENDING, time.time(), self.operation, params, path))
+            count += 1
+        return count
+
+    def state(self, path: Path) -> str:
+        """State of the job of `path`, None if unknown"""
+        row = self._connection().execute("SELECT state FROM jobs WHERE operation = ? AND params = ? AND path = ?",
+                                         (self.operation, self.params, os.path.abspath(path))).fetchone()
+        return row[0] if row is not None else None
+
+    def is_done(self, path: Path) -> bool:
+        """Check if the job of `path` is done and neither `path` nor its output changed since"""
+        if self.redo is True:
+            return False
+        row = self._connection().execute("SELECT state, fingerprint, output FROM jobs WHERE operation = ? AND params = ? AND path = ?",
+                                         (self.operation, self.params, os.path.abspath(path))).fetchone()
+        if row is None or row[0] != STATE_DONE or row[1] != fingerprint(path):
+            return False
+        return row[2] is None or os.path.exists(row[2])
+
+    def unfinished(self) -> List[str]:
+        """Absolute paths of the jobs recorded but not done"""
+        rows = self._connection().execute("SELECT path FROM jobs WHERE operation = ? AND params = ? AND state != ?", (self.operation, self.params, STATE_DONE)).fetchall()
+        return [x[0] for x in rows]
+
+    def pending(self, path: Path):
+        """The job of `path` was not run (or not to the end), it stays to do"""
+        self._set(path, STATE_PENDING, temps="[]", pid=None)
+
+    def start(self, path: Path, temps: List[Path] = None):
+        """The job of `path` is running, `temps` are the files to remove if the run dies"""
+        self._set(path, STATE_RUNNING, temps=json.dumps([os.path.abspath(x) for x in temps or []]), pid=os.getpid(), error=None)
+
+    def done(self, path: Path, output: Path = None):
+        """The job of `path` succeeded, `path` is fingerprinted as it is now"""
+        self._set(path, STATE_DONE, fingerprint=fingerprint(path), output=os.path.abspath(output) if output is not None else None, temps="[]", pid=None)
+
+    def failed(self, path: Path, error: str):
+        """The job of `path` failed, it will be retried"""
+        self._set(path, STATE_FAILED, temps="[]", pid=None, error=error)
+
+
+class NullJournal:
+    """Journal recording nothing, for jobs on temporary files which are never found again"""
+
+    def recover(self) -> int:
+        return 0
+
+    def state(self, path: Path) -> str:
+        return None
+
+    def is_done(self, path: Path) -> bool:
+        return False
+
+    def unfinished(self) -> List[str]:
+        return []
+
+    def pending(self, path: Path):
+        pass
+
+    def start(self, path: Path, temps: List[Path] = None):
+        pass
+
+    def done(self, path: Path, output: Path = None):
+        pass
+
+    def failed(self, path: Path, error: str):
+        pass
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+JPEG marker scanner
+Only the headers (SOI up to the first SOS) are read, the entropy coded data is never touched.
+"""
+
+import io
+import struct
+from collections import namedtuple
+from pathlib import Path
+from typing import BinaryIO, Dict, List, Tuple
+
+M_SOI = 0xD8
+M_EOI = 0xD9
+M_SOS = 0xDA
+M_DQT = 0xDB
+M_DRI = 0xDD
+M_DHT = 0xC4
+M_DAC = 0xCC
+M_JPG = 0xC8
+M_APP0 = 0xE0
+M_APP1 = 0xE1
+M_APP2 = 0xE2
+M_APP14 = 0xEE
+M_APP15 = 0xEF
+M_COM = 0xFE
+# Markers without a length field
+M_STANDALONE = set([0x01] + list(range(0xD0, 0xD8)))
+# Start of frame markers
+M_SOF = [m for m in range(0xC0, 0xD0) if m not in (M_DHT, M_JPG, M_DAC)]
+M_SOF_PROGRESSIVE = [0xC2, 0xC6, 0xCA, 0xCE]
+M_SOF_LOSSLESS = [0xC3, 0xC7, 0xCB, 0xCF]
+M_SOF_ARITHMETIC = [0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF]
+
+# Bytes of an APPn payload needed to identify its content
+APP_ID_SIZE = 14
+
+# IJG luminance quantization table at quality 50 (order does not matter, only the sum is used)
+STD_LUMINANCE_TABLE = [
+    16, 11, 10, 16, 24, 40, 51, 61,
+    12, 12, 14, 19, 26, 58, 60, 55,
+    14, 13, 16, 24, 40, 57, 69, 56,
+    14, 17, 22, 29, 51, 87, 80, 62,
+    18, 22, 37, 56, 68, 109, 103, 77,
+    24, 35, 55, 64, 81, 104, 113, 92,
+    49, 64, 78, 87, 103, 121, 120, 101,
+    72, 92, 95, 98, 112, 100, 103, 99,
+]
+
+# `offset` of the 0xFF byte of the marker, `size` of the whole segment (marker and length included)
+Segment = namedtuple('Segment', ['marker', 'offset', 'size'])
+Component = namedtuple('Component', ['id', 'h', 'v', 'tq'])
+
+
+class JpegError(Exception):
+    """Raised for files which are not valid JPEG"""
+
+
+class JpegInfo:
+    """What the JPEG headers tell about the image"""
+    __slots__ = ("width", "height", "precision", "components", "sof", "restart_interval", "quant_tables",
+                 "has_jfif", "has_exif", "has_xmp", "has_icc", "has_adobe", "has_comment", "segments", "sos_offset")
+
+    def __init__(self):
+        self.width = 0
+        self.height = 0
+        self.precision = 8
+        self.components: List[Component] = []
+        self.sof = None
+        self.restart_interval = 0
+        # table id -> 64 coefficients in zigzag order
+        self.quant_tables: Dict[int, List[int]] = {}
+        self.has_jfif = False
+        self.has_exif = False
+        self.has_xmp = False
+        self.has_icc = False
+        self.has_adobe = False
+        self.has_comment = False
+        self.segments: List[Segment] = []
+        self.sos_offset = 0
+
+    def __repr__(self):
+        return f"{self.width}x{self.height} {self.sampling_factors()} {'progressive' if self.is_progressive() else 'baseline'}"
+
+    def is_progressive(self) -> bool:
+        return self.sof in M_SOF_PROGRESSIVE
+
+    def is_baseline(self) -> bool:
+        return self.sof == 0xC0
+
+    def is_lossless(self) -> bool:
+        return self.sof in M_SOF_LOSSLESS
+
+    def is_arithmetic(self) -> bool:
+        return self.sof in M_SOF_ARITHMETIC
+
+    def has_restart_markers(self) -> bool:
+        return self.restart_interval > 0
+
+    def sampling_factors(self) -> str:
+        """Same format as ImageMagick, ex: 2x2,1x1,1x1"""
+        return ",".join(f"{c.h}x{c.v}" for c in self.components)
+
+    def is_grayscale(self) -> bool:
+        return len(self.components) == 1
+
+    def is_420(self) -> bool:
+        """YCbCr with the chroma halved in both directions"""
+        return [(c.h, c.v) for c in self.components] == [(2, 2), (1, 1), (1, 1)]
+
+    def estimate_quality(self) -> int:
+        """IJG quality (1-100) matching the scaling of the luminance table, None without quantization table"""
+        table = self.quant_tables.get(self.components[0].tq if self.components else 0)
+        if table is None:
+            return None
+        scale = sum(table) * 100 / sum(STD_LUMINANCE_TABLE)
+        quality = (200 - scale) / 2 if scale <= 100 else 5000 / scale
+        return int(round(min(max(quality, 1), 100)))
+
+
+def _read_exact(f: BinaryIO, size: int) -> bytes:
+    data = f.read(size)
+    if len(data) != size:
+        raise JpegError("Truncated JPEG")
+    return data
+
+
+def _parse_sof(info: JpegInfo, marker: int, data: bytes):
+    if len(data) < 6:
+        raise JpegError("Invalid SOF")
+    info.sof = marker
+    info.precision, info.height, info.width, count = struct.unpack_from(">BHHB", data, 0)
+    if len(data) < 6 + count * 3:
+        raise JpegError("Invalid SOF")
+    for i in range(count):
+        cid, hv, tq = struct.unpack_from(">BBB", data, 6 + i * 3)
+        info.components.append(Component(cid, hv >> 4, hv & 0xF, tq))
+
+
+def _parse_dqt(info: JpegInfo, data: bytes):
+    pos = 0
+    while pos < len(data):
+        pq, tq = data[pos] >> 4, data[pos] & 0xF
+        pos += 1
+        if pq == 0:
+            table = list(data[pos:pos + 64])
+            pos += 64
+        else:
+            table = list(struct.unpack_from(">64H", data, pos))
+            pos += 128
+        if len(table) != 64:
+            raise JpegError("Invalid DQT")
+        info.quant_tables[tq] = table
+
+
+def _parse_app(info: JpegInfo, marker: int, ident: bytes):
+    if marker == M_APP0 and ident.startswith(b"JFIF\0"):
+        info.has_jfif = True
+    elif marker == M_APP1 and ident.startswith(b"Exif\0"):
+        info.has_exif = True
+    elif marker == M_APP1 and ident.startswith(b"http://ns.adobe.com/xap/"):
+        info.has_xmp = True
+    elif marker == M_APP2 and ident.startswith(b"ICC_PROFILE\0"):
+        info.has_icc = True
+    elif marker == M_APP14 and ident.startswith(b"Adobe"):
+        info.has_adobe = True
+
+
+def _parse_headers(f: BinaryIO) -> JpegInfo:
+    start = f.tell()
+    if _read_exact(f, 2) != b"\xFF\xD8":
+        raise JpegError("Missing SOI")
+    info = JpegInfo()
+    info.segments.append(Segment(M_SOI, 0, 2))
+    while True:
+        offset = f.tell()
+        byte = _read_exact(f, 1)[0]
+        if byte != 0xFF:
+            raise JpegError(f"Invalid marker at {offset - start}")
+        # Any number of 0xFF fill bytes can precede a marker
+        marker = 0xFF
+        while marker == 0xFF:
+            marker = _read_exact(f, 1)[0]
+        if marker in M_STANDALONE:
+            continue
+        if marker == M_EOI:
+            raise JpegError("No image data")
+        length = struct.unpack(">H", _read_exact(f, 2))[0]
+        if length < 2:
+            raise JpegError(f"Invalid segment length at {offset - start}")
+        size = f.tell() - offset + length - 2
+        info.segments.append(Segment(marker, offset - start, size))
+        payload_size = length - 2
+        if marker == M_SOS:
+            info.sos_offset = offset - start
+            break
+        if marker in M_SOF:
+            _parse_sof(info, marker, _read_exact(f, payload_size))
+        elif marker == M_DQT:
+            _parse_dqt(info, _read_exact(f, payload_size))
+        elif marker == M_DRI:
+            info.restart_interval = struct.unpack(">H", _read_exact(f, payload_size)[0:2])[0]
+        elif M_APP0 <= marker <= M_APP15:
+            # Only the identifier, EXIF thumbnails and ICC profiles can be large
+            ident_size = min(payload_size, APP_ID_SIZE)
+            _parse_app(info, marker, _read_exact(f, ident_size))
+            f.seek(payload_size - ident_size, io.SEEK_CUR)
+        else:
+            if marker == M_COM:
+                info.has_comment = True
+            f.seek(payload_size, io.SEEK_CUR)
+    if info.sof is None:
+        raise JpegError("Missing SOF")
+    return info
+
+
+def parse(f: BinaryIO) -> JpegInfo:
+    """Scan the headers of the JPEG stream `f`, positioned on the SOI"""
+    try:
+        return _parse_headers(f)
+    except struct.error as e:
+        raise JpegError("Truncated segment") from e
+
+
+def read_info(path: Path) -> JpegInfo:
+    """Headers of the JPEG file at `path`"""
+    with open(path, "rb") as f:
+        return parse(f)
+
+
+def read_info_bytes(data: bytes) -> JpegInfo:
+    """Headers of an in-memory JPEG"""
+    return parse(io.BytesIO(data))
+
+
+def dimensions(path: Path) -> Tuple[int, int]:
+    """(width, height) of the JPEG file at `path`"""
+    info = read_info(path)
+    return info.width, info.height
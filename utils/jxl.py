@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+JPEG XL transcoding
+JPEG are recompressed losslessly (djxl rebuilds the original file bit for bit), PNG are encoded
+in lossless mode. The JXL replaces the original only once the round trip is verified and if it
+is smaller, an optional sidecar index maps the originals to their JXL.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+from collections import namedtuple
+from pathlib import Path
+from typing import Dict, List
+import numpy
+from PIL import Image  # pip3 install Pillow
+from utils import optimcache, optimstats, png, proc
+
+BIN_CJXL = str("cjxl")
+BIN_DJXL = str("djxl")
+DEFAULT_EFFORT = 7
+
+# Whether the JXL replaced the original, its size (None if the encoding failed), hash of the original, CPU seconds spent and whether cjxl was killed
+JxlResult = namedtuple('JxlResult', ['kept', 'size', 'digest', 'cpu', 'timed_out'])
+JxlOptions = namedtuple('JxlOptions', ['effort', 'index'])
+
+
+def encode_command(src: Path, dst: Path, is_jpeg: bool, effort: int) -> List[str]:
+    """cjxl command, files are processed in parallel so each one gets a single thread"""
+    mode = ["--lossless_jpeg=1"] if is_jpeg is True else ["--distance=0"]
+    return [BIN_CJXL, src, dst] + mode + [f"--effort={effort}", "--num_threads=1", "--quiet"]
+
+
+def _same_pixels(a: Path, b: Path) -> bool:
+    """Check if the PNG `a` and the image `b` decode to the same pixels, False if Pillow cannot compare them losslessly"""
+    try:
+        infos = png.read_info(a)
+    except (png.PngError, OSError):
+        return False
+    # Pillow only keeps the 16 bits of grey images, the others are truncated to 8 bits
+    if infos.bit_depth > 8 and infos.color_type != png.COLOR_GREY:
+        return False
+    with Image.open(a) as img_a, Image.open(b) as img_b:
+        if img_a.size != img_b.size:
+            return False
+        if img_a.mode != img_b.mode:
+            # djxl does not write palettes, any other conversion could hide a difference
+            if img_a.mode != "P":
+                return False
+            img_a, img_b = img_a.convert("RGBA"), img_b.convert("RGBA")
+        return numpy.array_equal(numpy.asarray(img_a), numpy.asarray(img_b))
+
+
+def verify(original: Path, digest: str, encoded: Path, is_jpeg: bool, timeout: float = None) -> bool:
+    """Decode `encoded` and check it gives back `original`: the same file for a JPEG, the same pixels for a PNG"""
+    with tempfile.TemporaryDirectory(prefix=".jxl.", dir=original.parent) as tmpdir:
+        decoded = Path(tmpdir) / ("decoded.jpg" if is_jpeg is True else "decoded.png")
+        res = proc.run([BIN_DJXL, encoded, decoded, "--num_threads=1", "--quiet"], timeout=timeout)
+        if res.returncode != 0 or decoded.exists() is False:
+            return False
+        if is_jpeg is True:
+            return optimcache.hash_file(decoded) == digest
+        return _same_pixels(original, decoded)
+
+
+def transcode(original: Path, is_jpeg: bool, effort: int = DEFAULT_EFFORT, timeout: float = None) -> JxlResult:
+    """Encode `original` next to it and replace it by the JXL if it is smaller and the round trip is exact"""
+    dst = original.with_suffix(".jxl")
+    tmpfile = original.with_name(f".{original.stem}.tmp.jxl")
+    digest = optimcache.hash_file(original)
+    res = proc.run(encode_command(original, tmpfile, is_jpeg, effort), timeout=timeout)
+    cpu = optimstats.cpu_seconds(res)
+    try:
+        if res.returncode != 0 or tmpfile.exists() is False or dst.exists() is True:
+            return JxlResult(False, None, digest, cpu, res.timed_out)
+        size = tmpfile.stat().st_size
+        if size >= original.stat().st_size or verify(original, digest, tmpfile, is_jpeg, timeout) is False:
+            return JxlResult(False, size, digest, cpu, False)
+        shutil.copymode(original, tmpfile)
+        tmpfile.replace(dst)
+        original.unlink()
+        return JxlResult(True, size, digest, cpu, False)
+    finally:
+        if tmpfile.exists() is True:
+            tmpfile.unlink()
+
+
+class Index:
+    """Sidecar JSON index of the transcoded files: original path (relative to the index) to its JXL, safe to share between threads"""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.entries: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+        if path.exists() is True:
+            with open(path, "r", encoding="utf-8") as f:
+                self.entries = json.load(f)
+
+    def _relative(self, path: Path) -> str:
+        return os.path.relpath(path, self.path.parent)
+
+    def add(self, original: Path, encoded: Path, digest: str, size: int, is_jpeg: bool):
+        """`original` (`size` bytes, hash `digest`) was replaced by `encoded`, rebuilt bit for bit if `is_jpeg`"""
+        with self._lock:
+            self.entries[self._relative(original)] = {"jxl": self._relative(encoded), "hash": digest, "size": size, "reconstructible": is_jpeg}
+
+    def save(self):
+        """Atomically write the index"""
+        with self._lock:
+            tmpfile = self.path.with_name(f".{self.path.name}.tmp")
+            with open(tmpfile, "w", encoding="utf-8") as f:
+                json.dump(self.entries, f, indent=1, sort_keys=True)
+            tmpfile.replace(self.path)
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+Metadata stripping without re-encoding
+JPEG APPn/COM segments and PNG text/time/EXIF chunks are dropped, everything else (and the
+whole compressed image data) is copied verbatim in kernel with `io.copy_range`.
+The ICC profile and the EXIF orientation can be kept, the latter in a minimal EXIF block.
+"""
+
+import os
+import shutil
+import struct
+import zlib
+from collections import namedtuple
+from pathlib import Path
+from typing import List, Union
+from utils import io, jpeg, png
+
+# Tag of the orientation in the EXIF IFD0
+EXIF_ORIENTATION = 0x0112
+EXIF_HEADER = b"Exif\0\0"
+PNG_STRIPPED = (b"tEXt", b"zTXt", b"iTXt", b"eXIf", b"tIME")
+
+StripOptions = namedtuple('StripOptions', ['keep_icc', 'keep_orientation'])
+
+# A part of the output: (offset, count) of the input or new bytes
+Part = Union[tuple, bytes]
+
+
+def exif_orientation(tiff: bytes) -> int:
+    """Orientation (1-8) in the EXIF TIFF structure `tiff`, 1 if missing or invalid"""
+    try:
+        order = {b"II": "<", b"MM": ">"}[tiff[0:2]]
+        ifd = struct.unpack(order + "I", tiff[4:8])[0]
+        count = struct.unpack(order + "H", tiff[ifd:ifd + 2])[0]
+        for i in range(count):
+            tag, kind, _, value = struct.unpack(order + "HHI4s", tiff[ifd + 2 + i * 12:ifd + 14 + i * 12])
+            if tag == EXIF_ORIENTATION and kind == 3:
+                return struct.unpack(order + "H", value[0:2])[0]
+    except (KeyError, struct.error):
+        pass
+    return 1
+
+
+def orientation_exif(orientation: int) -> bytes:
+    """Smallest EXIF TIFF structure holding `orientation`"""
+    return b"MM\0\x2A" + struct.pack(">IHHHIHHI", 8, 1, EXIF_ORIENTATION, 3, 1, orientation, 0, 0)
+
+
+def _coalesce(parts: List[Part]) -> List[Part]:
+    """Merge the contiguous ranges, to copy them in a single call"""
+    ret: List[Part] = []
+    for part in parts:
+        if isinstance(part, tuple) and ret and isinstance(ret[-1], tuple) and sum(ret[-1]) == part[0]:
+            ret[-1] = (ret[-1][0], ret[-1][1] + part[1])
+        else:
+            ret.append(part)
+    return ret
+
+
+def rewrite(path: Path, parts: List[Part]) -> int:
+    """Atomically replace `path` by the concatenation of `parts`, returns the new size"""
+    tmpfile = path.with_name(f".{path.name}.tmp")
+    with open(path, "rb") as src, open(tmpfile, "wb") as dst:
+        for part in _coalesce(parts):
+            if isinstance(part, tuple):
+                io.copy_range(src, dst, part[0], part[1])
+            else:
+                dst.write(part)
+        size = dst.tell()
+    shutil.copymode(path, tmpfile)
+    tmpfile.replace(path)
+    return size
+
+
+def jpeg_parts(path: Path, info: jpeg.JpegInfo, options: StripOptions) -> List[Part]:
+    """What remains of the JPEG at `path` once stripped, None if there is nothing to strip"""
+    parts: List[Part] = []
+    stripped = False
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        for segment in info.segments:
+            if segment.marker == jpeg.M_SOS:
+                break
+            if segment.marker == jpeg.M_COM:
+                stripped = True
+                continue
+            if jpeg.M_APP0 <= segment.marker <= jpeg.M_APP15:
+                ident = os.pread(fd, jpeg.APP_ID_SIZE, segment.offset + 4)
+                # JFIF and Adobe tell how to decode the colors
+                if (segment.marker == jpeg.M_APP0 and ident.startswith(b"JFIF\0")) or (segment.marker == jpeg.M_APP14 and ident.startswith(b"Adobe")):
+                    parts.append((segment.offset, segment.size))
+                    continue
+                if segment.marker == jpeg.M_APP2 and ident.startswith(b"ICC_PROFILE\0") and options.keep_icc is True:
+                    parts.append((segment.offset, segment.size))
+                    continue
+                stripped = True
+                if segment.marker == jpeg.M_APP1 and ident.startswith(EXIF_HEADER) and options.keep_orientation is True:
+                    orientation = exif_orientation(os.pread(fd, segment.size - 4 - len(EXIF_HEADER), segment.offset + 4 + len(EXIF_HEADER)))
+                    if orientation != 1:
+                        payload = EXIF_HEADER + orientation_exif(orientation)
+                        parts.append(struct.pack(">BBH", 0xFF, jpeg.M_APP1, len(payload) + 2) + payload)
+                continue
+            parts.append((segment.offset, segment.size))
+    finally:
+        os.close(fd)
+    if stripped is False:
+        return None
+    # Scans and trailer
+    parts.append((info.sos_offset, os.stat(path).st_size - info.sos_offset))
+    return parts
+
+
+def png_parts(path: Path, info: png.PngInfo, options: StripOptions) -> List[Part]:
+    """What remains of the PNG at `path` once stripped, None if there is nothing to strip"""
+    parts: List[Part] = [(0, len(png.PNG_SIGNATURE))]
+    stripped = False
+    for chunk in info.chunks:
+        if chunk.type in PNG_STRIPPED or (chunk.type == b"iCCP" and options.keep_icc is False):
+            stripped = True
+            if chunk.type == b"eXIf" and options.keep_orientation is True:
+                with open(path, "rb") as f:
+                    f.seek(chunk.offset + 8)
+                    orientation = exif_orientation(f.read(chunk.size))
+                if orientation != 1:
+                    data = b"eXIf" + orientation_exif(orientation)
+                    parts.append(struct.pack(">I", len(data) - 4) + data + struct.pack(">I", zlib.crc32(data)))
+            continue
+        parts.append((chunk.offset, chunk.size + 12))
+    return parts if stripped is True else None
+
+
+def strip_jpeg(path: Path, info: jpeg.JpegInfo, options: StripOptions) -> int:
+    """Strip the metadata of the JPEG at `path` in place, returns the bytes removed"""
+    parts = jpeg_parts(path, info, options)
+    if parts is None:
+        return 0
+    size = os.stat(path).st_size
+    return size - rewrite(path, parts)
+
+
+def strip_png(path: Path, info: png.PngInfo, options: StripOptions) -> int:
+    """Strip the metadata of the PNG at `path` in place, returns the bytes removed"""
+    parts = png_parts(path, info, options)
+    if parts is None:
+        return 0
+    size = os.stat(path).st_size
+    return size - rewrite(path, parts)
@@ -6,10 +6,11 @@ MKV file helper
 """
 
 import json
+import mmap
+import struct
 from pathlib import Path
 from typing import List, Dict
-from shlex import quote
-from utils import common
+from utils import probecache, proc
 
 # Video codecs
 CODEC_VIDEO_MPEG2 = str("mpeg-1/2")
@@ -114,6 +115,315 @@ CODEC_SUBTITLE_TYPE_MAP: Dict[str, str] = {
 }
 
 
+# Matroska elements read by the native EBML reader
+EBML_ID_HEADER = 0x1A45DFA3
+EBML_ID_DOCTYPE = 0x4282
+EBML_ID_SEGMENT = 0x18538067
+EBML_ID_SEEKHEAD = 0x114D9B74
+EBML_ID_SEEK = 0x4DBB
+EBML_ID_SEEKID = 0x53AB
+EBML_ID_SEEKPOSITION = 0x53AC
+EBML_ID_INFO = 0x1549A966
+EBML_ID_TIMESTAMPSCALE = 0x2AD7B1
+EBML_ID_DURATION = 0x4489
+EBML_ID_TITLE = 0x7BA9
+EBML_ID_TRACKS = 0x1654AE6B
+EBML_ID_TRACKENTRY = 0xAE
+EBML_ID_TRACKUID = 0x73C5
+EBML_ID_TRACKTYPE = 0x83
+EBML_ID_FLAGDEFAULT = 0x88
+EBML_ID_FLAGFORCED = 0x55AA
+EBML_ID_NAME = 0x536E
+EBML_ID_LANGUAGE = 0x22B59C
+EBML_ID_CODECID = 0x86
+EBML_ID_AUDIO = 0xE1
+EBML_ID_CHANNELS = 0x9F
+EBML_ID_BITDEPTH = 0x6264
+EBML_ID_CHAPTERS = 0x1043A770
+EBML_ID_EDITIONENTRY = 0x45B9
+EBML_ID_CHAPTERATOM = 0xB6
+EBML_ID_ATTACHMENTS = 0x1941A469
+EBML_ID_ATTACHEDFILE = 0x61A7
+EBML_ID_FILENAME = 0x466E
+EBML_ID_FILEMIMETYPE = 0x4660
+EBML_ID_FILEUID = 0x46AE
+EBML_ID_CLUSTER = 0x1F43B675
+EBML_UNKNOWN_SIZE = -1
+
+EBML_TRACK_TYPES: Dict[int, str] = {
+    1: str("video"),
+    2: str("audio"),
+    17: str("subtitles"),
+}
+
+# Matroska CodecID -> mkvmerge codec name
+EBML_CODEC_MAP: Dict[str, str] = {
+    str("V_MPEG1"): CODEC_VIDEO_MPEG2,
+    str("V_MPEG2"): CODEC_VIDEO_MPEG2,
+    str("V_MPEG4/ISO/SP"): CODEC_VIDEO_MPEG4,
+    str("V_MPEG4/ISO/ASP"): CODEC_VIDEO_MPEG4,
+    str("V_MPEG4/ISO/AP"): CODEC_VIDEO_MPEG4,
+    str("V_MPEG4/ISO/AVC"): CODEC_VIDEO_H264_2,
+    str("V_MPEGH/ISO/HEVC"): CODEC_VIDEO_H265_2,
+    str("V_AV1"): CODEC_VIDEO_AV1,
+    str("A_AAC"): CODEC_AUDIO_AAC,
+    str("A_AC3"): CODEC_AUDIO_AC3,
+    str("A_ALAC"): CODEC_AUDIO_ALAC,
+    str("A_DTS"): CODEC_AUDIO_DTS,
+    str("A_EAC3"): CODEC_AUDIO_EAC3,
+    str("A_FLAC"): CODEC_AUDIO_FLAC,
+    str("A_MPEG/L2"): CODEC_AUDIO_MP2,
+    str("A_MPEG/L3"): CODEC_AUDIO_MP3,
+    str("A_OPUS"): CODEC_AUDIO_OPUS,
+    str("A_TRUEHD"): CODEC_AUDIO_TRUEHD,
+    str("A_VORBIS"): CODEC_AUDIO_VORBIS,
+    str("A_WAVPACK4"): CODEC_AUDIO_WAVPACK4,
+    str("S_TEXT/UTF8"): CODEC_SUBTITLE_SRT,
+    str("S_TEXT/ASS"): CODEC_SUBTITLE_ASS,
+    str("S_TEXT/SSA"): CODEC_SUBTITLE_ASS,
+    str("S_ASS"): CODEC_SUBTITLE_ASS,
+    str("S_SSA"): CODEC_SUBTITLE_ASS,
+    str("S_HDMV/PGS"): CODEC_SUBTITLE_PGS,
+    str("S_VOBSUB"): CODEC_SUBTITLE_VOBSUB,
+}
+
+# The exact codec (DTS-HD MA, TrueHD Atmos…) is only known by parsing the frames
+EBML_AMBIGUOUS_CODECS = [
+    str("A_DTS"),
+    str("A_TRUEHD"),
+]
+
+
+class EbmlError(Exception):
+    """Raised when the native reader cannot handle a file"""
+
+
+def _ebml_vint(buf, pos: int, keep_marker: bool):
+    """Read a variable size integer at `pos`, returns (value, length)"""
+    first = buf[pos]
+    if first == 0:
+        raise EbmlError(f"Invalid vint at {pos}")
+    length = 9 - first.bit_length()
+    if pos + length > len(buf):
+        raise EbmlError(f"Truncated vint at {pos}")
+    value = int.from_bytes(buf[pos:pos + length], "big")
+    if keep_marker is False:
+        mask = (1 << (7 * length)) - 1
+        value &= mask
+        if value == mask:
+            value = EBML_UNKNOWN_SIZE
+    return value, length
+
+
+def _ebml_header(buf, pos: int):
+    """Read the element header at `pos`, returns (id, size, data position)"""
+    eid, id_len = _ebml_vint(buf, pos, True)
+    size, size_len = _ebml_vint(buf, pos + id_len, False)
+    return eid, size, pos + id_len + size_len
+
+
+def _ebml_children(buf, start: int, end: int):
+    """Iterate over the (id, data position, size) of the elements between `start` and `end`"""
+    pos = start
+    while pos < end:
+        eid, size, data = _ebml_header(buf, pos)
+        if size == EBML_UNKNOWN_SIZE or data + size > len(buf):
+            raise EbmlError(f"Unsupported element size at {pos}")
+        yield eid, data, size
+        pos = data + size
+
+
+def _ebml_uint(buf, pos: int, size: int) -> int:
+    return int.from_bytes(buf[pos:pos + size], "big")
+
+
+def _ebml_float(buf, pos: int, size: int) -> float:
+    if size == 4:
+        return struct.unpack(">f", buf[pos:pos + 4])[0]
+    if size == 8:
+        return struct.unpack(">d", buf[pos:pos + 8])[0]
+    return 0.0
+
+
+def _ebml_str(buf, pos: int, size: int) -> str:
+    return bytes(buf[pos:pos + size]).rstrip(b"\0").decode("utf-8", errors="replace")
+
+
+def _ebml_element(buf, pos: int, expected: int):
+    """Read the header of the element at `pos` and make sure it is `expected`, returns (data position, size)"""
+    eid, size, data = _ebml_header(buf, pos)
+    if eid != expected or size == EBML_UNKNOWN_SIZE or data + size > len(buf):
+        raise EbmlError(f"Element {expected:X} not found at {pos}")
+    return data, size
+
+
+def _ebml_level1_positions(buf, segment_data: int, segment_end: int) -> Dict[int, int]:
+    """Locate the top level elements: linear scan up to the first cluster, then follow the SeekHeads,
+    then the headers stored after the clusters which the SeekHeads may not list"""
+    positions: Dict[int, int] = {}
+    seekheads: List[int] = []
+    targets: List[int] = []
+    cluster = None
+    pos = segment_data
+    while pos < segment_end:
+        eid, size, data = _ebml_header(buf, pos)
+        if eid == EBML_ID_CLUSTER:
+            cluster = pos
+            break
+        if size == EBML_UNKNOWN_SIZE:
+            raise EbmlError(f"Unknown size element at {pos}")
+        positions.setdefault(eid, pos)
+        if eid == EBML_ID_SEEKHEAD:
+            seekheads.append(pos)
+        pos = data + size
+
+    visited = set()
+    while seekheads:
+        seekhead = seekheads.pop()
+        if seekhead in visited:
+            continue
+        visited.add(seekhead)
+        data, size = _ebml_element(buf, seekhead, EBML_ID_SEEKHEAD)
+        for sid, spos, ssize in _ebml_children(buf, data, data + size):
+            if sid != EBML_ID_SEEK:
+                continue
+            target_id = None
+            target_pos = None
+            for cid, cpos, csize in _ebml_children(buf, spos, spos + ssize):
+                if cid == EBML_ID_SEEKID:
+                    target_id = _ebml_uint(buf, cpos, csize)
+                elif cid == EBML_ID_SEEKPOSITION:
+                    target_pos = segment_data + _ebml_uint(buf, cpos, csize)
+            if target_id is None or target_pos is None or target_pos >= len(buf):
+                continue
+            targets.append(target_pos)
+            if target_id == EBML_ID_SEEKHEAD:
+                seekheads.append(target_pos)
+            else:
+                positions.setdefault(target_id, target_pos)
+
+    if cluster is not None:
+        # From the first element indexed past the clusters, or through the clusters (headers only) if none is
+        pos = min((x for x in targets if x > cluster), default=cluster)
+        while pos < segment_end:
+            eid, size, data = _ebml_header(buf, pos)
+            if size == EBML_UNKNOWN_SIZE:
+                raise EbmlError(f"Unknown size element at {pos}")
+            if eid != EBML_ID_CLUSTER:
+                positions.setdefault(eid, pos)
+            pos = data + size
+    return positions
+
+
+def _ebml_track(buf, data: int, size: int, track_id: int, exact_codecs: bool) -> Dict:
+    """TrackEntry as a mkvmerge -J track"""
+    track_type = None
+    codec_id = None
+    properties: Dict = {"forced_track": False, "default_track": True, "language": "eng"}
+    for eid, pos, esize in _ebml_children(buf, data, data + size):
+        if eid == EBML_ID_TRACKTYPE:
+            track_type = _ebml_uint(buf, pos, esize)
+        elif eid == EBML_ID_CODECID:
+            codec_id = _ebml_str(buf, pos, esize)
+        elif eid == EBML_ID_TRACKUID:
+            properties["uid"] = _ebml_uint(buf, pos, esize)
+        elif eid == EBML_ID_NAME:
+            properties["track_name"] = _ebml_str(buf, pos, esize)
+        elif eid == EBML_ID_FLAGFORCED:
+            properties["forced_track"] = bool(_ebml_uint(buf, pos, esize))
+        elif eid == EBML_ID_FLAGDEFAULT:
+            properties["default_track"] = bool(_ebml_uint(buf, pos, esize))
+        elif eid == EBML_ID_LANGUAGE:
+            properties["language"] = _ebml_str(buf, pos, esize)
+        elif eid == EBML_ID_AUDIO:
+            for aid, apos, asize in _ebml_children(buf, pos, pos + esize):
+                if aid == EBML_ID_CHANNELS:
+                    properties["audio_channels"] = _ebml_uint(buf, apos, asize)
+                elif aid == EBML_ID_BITDEPTH:
+                    properties["audio_bits_per_sample"] = _ebml_uint(buf, apos, asize)
+    if track_type not in EBML_TRACK_TYPES:
+        raise EbmlError(f"Unsupported track type {track_type}")
+    if codec_id not in EBML_CODEC_MAP or (exact_codecs is True and codec_id in EBML_AMBIGUOUS_CODECS):
+        raise EbmlError(f"Unsupported codec {codec_id}")
+    if track_type == 2 and "audio_channels" not in properties:
+        properties["audio_channels"] = 1
+    if "uid" not in properties:
+        raise EbmlError("Track without uid")
+    return {"id": track_id, "type": EBML_TRACK_TYPES[track_type], "codec": EBML_CODEC_MAP[codec_id], "properties": properties}
+
+
+def read_ebml_infos(path: Path, exact_codecs: bool = True) -> Dict:
+    """Read the tracks, chapters and attachments of a matroska file from its headers, without touching the clusters.
+    Returns the same structure as `mkvmerge -J`, raises EbmlError for anything it cannot handle.
+    DTS and TrueHD variants are only known by mkvmerge, unless `exact_codecs` is False they are not handled."""
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        # EBML header
+        data, size = _ebml_element(buf, 0, EBML_ID_HEADER)
+        doc_type = None
+        for eid, pos, esize in _ebml_children(buf, data, data + size):
+            if eid == EBML_ID_DOCTYPE:
+                doc_type = _ebml_str(buf, pos, esize)
+        if doc_type not in ("matroska", "webm"):
+            raise EbmlError(f"Unsupported doctype {doc_type}")
+
+        eid, segment_size, segment_data = _ebml_header(buf, data + size)
+        if eid != EBML_ID_SEGMENT:
+            raise EbmlError("Segment not found")
+        segment_end = len(buf) if segment_size == EBML_UNKNOWN_SIZE else min(segment_data + segment_size, len(buf))
+        positions = _ebml_level1_positions(buf, segment_data, segment_end)
+        if EBML_ID_TRACKS not in positions:
+            raise EbmlError("Tracks not found")
+
+        infos: Dict = {"file_name": str(path), "container": {"type": "Matroska", "properties": {}}, "tracks": [], "chapters": [], "attachments": []}
+
+        if EBML_ID_INFO in positions:
+            data, size = _ebml_element(buf, positions[EBML_ID_INFO], EBML_ID_INFO)
+            scale = 1000000
+            duration = None
+            for eid, pos, esize in _ebml_children(buf, data, data + size):
+                if eid == EBML_ID_TIMESTAMPSCALE:
+                    scale = _ebml_uint(buf, pos, esize)
+                elif eid == EBML_ID_DURATION:
+                    duration = _ebml_float(buf, pos, esize)
+                elif eid == EBML_ID_TITLE:
+                    infos["container"]["properties"]["title"] = _ebml_str(buf, pos, esize)
+            if duration is not None:
+                infos["container"]["properties"]["duration"] = int(duration * scale)
+
+        data, size = _ebml_element(buf, positions[EBML_ID_TRACKS], EBML_ID_TRACKS)
+        for eid, pos, esize in _ebml_children(buf, data, data + size):
+            if eid == EBML_ID_TRACKENTRY:
+                infos["tracks"].append(_ebml_track(buf, pos, esize, len(infos["tracks"]), exact_codecs))
+
+        if EBML_ID_CHAPTERS in positions:
+            data, size = _ebml_element(buf, positions[EBML_ID_CHAPTERS], EBML_ID_CHAPTERS)
+            count = 0
+            for eid, pos, esize in _ebml_children(buf, data, data + size):
+                if eid == EBML_ID_EDITIONENTRY:
+                    count += sum(1 for cid, _, _ in _ebml_children(buf, pos, pos + esize) if cid == EBML_ID_CHAPTERATOM)
+            if count > 0:
+                infos["chapters"].append({"num_entries": count})
+
+        if EBML_ID_ATTACHMENTS in positions:
+            data, size = _ebml_element(buf, positions[EBML_ID_ATTACHMENTS], EBML_ID_ATTACHMENTS)
+            for eid, pos, esize in _ebml_children(buf, data, data + size):
+                if eid != EBML_ID_ATTACHEDFILE:
+                    continue
+                attachment: Dict = {"id": len(infos["attachments"]) + 1, "file_name": "", "content_type": "", "properties": {}}
+                # FileData is skipped, only its header is read
+                for cid, cpos, csize in _ebml_children(buf, pos, pos + esize):
+                    if cid == EBML_ID_FILENAME:
+                        attachment["file_name"] = _ebml_str(buf, cpos, csize)
+                    elif cid == EBML_ID_FILEMIMETYPE:
+                        attachment["content_type"] = _ebml_str(buf, cpos, csize)
+                    elif cid == EBML_ID_FILEUID:
+                        attachment["properties"]["uid"] = _ebml_uint(buf, cpos, csize)
+                if "uid" not in attachment["properties"]:
+                    raise EbmlError("Attachment without uid")
+                infos["attachments"].append(attachment)
+        return infos
+
+
 class MkvTrack:
     """Represents a track within a mkv file"""
 
@@ -188,7 +498,7 @@ class MkvAttachment:
 class MkvFile:
     """Represents a mkv file"""
 
-    def __init__(self, path: Path):
+    def __init__(self, path: Path, exact_codecs: bool = True):
         self.is_valid = False
         self.chaptered = False
         self.tracks: List[MkvTrack] = []
@@ -196,7 +506,7 @@ class MkvFile:
         if path.exists() is True:
             self.path = path
             self.is_valid = True
-            infos = MkvFile.get_file_infos(path)
+            infos = MkvFile.get_file_infos(path, exact_codecs)
             self.chaptered = bool(
                 infos["chapters"] is not None and infos["chapters"])
             self.file_name = str(infos["file_name"])
@@ -224,10 +534,27 @@ class MkvFile:
 
     def video_codec_desc(self) -> str:
         """return smth like AVC High10@L4.1 24fps"""
-        return common.system_call(f'mediainfo --Inform="Video;%Format% %Format_Profile% %FrameRate%fps" {quote(str(self.path))}').decode("utf-8").strip()
+        def probe() -> str:
+            res = proc.run(["mediainfo", "--Inform=Video;%Format% %Format_Profile% %FrameRate%fps", self.path])
+            return res.stdout.decode("utf-8").strip() if res.returncode == 0 else None
+        return probecache.cached("mediainfo-video", self.path, probe) or ""
 
     @staticmethod
-    def get_file_infos(path: Path):
-        """Invoke mkvmerge to get infos"""
-        a = common.system_call(f'mkvmerge -J {quote(str(path))}')
-        return json.loads(a)
+    def get_file_infos(path: Path, exact_codecs: bool = True):
+        """Read the matroska headers to get infos, falls back to mkvmerge (cached) for what the native reader cannot handle"""
+        try:
+            return read_ebml_infos(path, exact_codecs)
+        except (EbmlError, OSError, ValueError, IndexError, struct.error):
+            pass
+
+        errors: List[bytes] = []
+
+        def probe() -> str:
+            res = proc.run(["mkvmerge", "-J", path])
+            if res.returncode in (0, 1):
+                return res.stdout.decode("utf-8")
+            # 2 is an error, the output is still json but must not be cached
+            errors.append(res.stdout)
+            return None
+        data = probecache.cached("mkvmerge", path, probe)
+        return json.loads(data if data is not None else errors[0])
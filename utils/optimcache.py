@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+Content addressed cache of image optimizations
+Results are keyed by the hash of the input content and the tool chain (programs and options),
+optimized files are stored once by hash so an identical image found elsewhere is copied instead
+of optimized again, and an already optimized file maps to itself (fixed point).
+Blobs are hard links to the optimized files when they are on the same filesystem, the scripts replace
+files instead of rewriting them so a blob keeps its content, which is checked anyway when it is restored.
+"""
+
+import hashlib
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Optional
+from utils import common
+
+try:
+    import xxhash  # pip3 install xxhash
+except ImportError:
+    xxhash = None
+
+DEFAULT_MAX_BYTES = 1024 * 1048576
+# Entries not used for this long are dropped
+MAX_AGE = 365 * 86400
+ACCESS_RESOLUTION = 86400
+READ_SIZE = 1048576
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    input TEXT NOT NULL,
+    chain TEXT NOT NULL,
+    output TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_access REAL NOT NULL,
+    PRIMARY KEY (input, chain)
+);
+CREATE INDEX IF NOT EXISTS results_last_access ON results (last_access);
+CREATE TABLE IF NOT EXISTS blobs (
+    hash TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS blobs_last_access ON blobs (last_access);
+"""
+
+
+def hash_file(path: Path) -> str:
+    """Fast content hash of `path`, xxh3-128 if available otherwise blake2b-128"""
+    h = xxhash.xxh3_128() if xxhash is not None else hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(READ_SIZE)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class OptimCache:
+    """SQLite index and blob directory, safe to share between threads and processes"""
+
+    def __init__(self, root: Path = None, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.root = root if root is not None else common.cache_dir() / "optim"
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._inflight: Dict[tuple, list] = {}
+        # Running total of the blobs, loaded on the first insertion
+        self._bytes: int = None
+
+    def _connection(self) -> sqlite3.Connection:
+        """One connection per thread (and per process after a fork)"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(str(self.root / "index.sqlite"), timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _blob_path(self, digest: str) -> Path:
+        return self.root / digest[:2] / digest
+
+    @contextmanager
+    def computing(self, digest: str, chain: str):
+        """Serialize the jobs optimizing the same content with the same chain, the others wait and then hit the cache"""
+        key = (digest, chain)
+        with self._lock:
+            entry = self._inflight.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._inflight[key]
+
+    def lookup(self, digest: str, chain: str) -> Optional[str]:
+        """Hash of the optimization result of `digest` by `chain`, None if unknown"""
+        conn = self._connection()
+        row = conn.execute("SELECT output, last_access FROM results WHERE input = ? AND chain = ?", (digest, chain)).fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        if now - row[1] > ACCESS_RESOLUTION:
+            conn.execute("UPDATE results SET last_access = ? WHERE input = ? AND chain = ?", (now, digest, chain))
+        return row[0]
+
+    def restore(self, digest: str, dst: Path) -> bool:
+        """Atomically replace `dst` by the stored blob `digest`, False if it was evicted"""
+        blob = self._blob_path(digest)
+        fd, tmp = tempfile.mkstemp(prefix=f".{dst.name}.", suffix=".tmp", dir=dst.parent)
+        os.close(fd)
+        try:
+            shutil.copyfile(blob, tmp)
+            # The file the blob is linked to was modified in place
+            if hash_file(Path(tmp)) != digest:
+                self._drop([digest])
+                raise OSError(f"{blob} is corrupted")
+            shutil.copymode(dst, tmp)
+            os.replace(tmp, dst)
+        except OSError:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            return False
+        self._connection().execute("UPDATE blobs SET last_access = ? WHERE hash = ?", (time.time(), digest))
+        return True
+
+    def store(self, digest: str, chain: str, result: Path) -> str:
+        """Record that `chain` turns `digest` into the file `result` (which is also a fixed point), returns the hash of `result`"""
+        conn = self._connection()
+        now = time.time()
+        size = result.stat().st_size
+        output = hash_file(result)
+        if output != digest:
+            blob = self._blob_path(output)
+            added = 0
+            if blob.exists() is False:
+                blob.parent.mkdir(exist_ok=True)
+                self._link(result, blob)
+                added = size
+            conn.execute("INSERT OR REPLACE INTO blobs (hash, size, last_access) VALUES (?, ?, ?)", (output, size, now))
+            self._account(added)
+        conn.executemany("INSERT OR REPLACE INTO results (input, chain, output, size, last_access) VALUES (?, ?, ?, ?, ?)",
+                         [(digest, chain, output, size, now), (output, chain, output, size, now)])
+        return output
+
+    def _link(self, src: Path, blob: Path):
+        """Atomically make `blob` a hard link to `src`, a copy if they are not on the same filesystem"""
+        tmp = blob.with_name(f".{blob.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            os.link(src, tmp)
+        except OSError:
+            shutil.copyfile(src, tmp)
+        os.replace(tmp, blob)
+
+    def _account(self, added: int):
+        """Add `added` bytes to the running total and evict once it goes past `max_bytes`, the first call checks the size as found on disk"""
+        with self._lock:
+            if self._bytes is None:
+                # Already includes the entry just inserted
+                self._bytes = self._connection().execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+            else:
+                self._bytes += added
+            over = self._bytes > self.max_bytes
+        if over is True:
+            self.evict()
+
+    def _drop(self, digests: List[str]):
+        """Delete the blobs `digests`"""
+        for digest in digests:
+            try:
+                self._blob_path(digest).unlink()
+            except FileNotFoundError:
+                pass
+        self._connection().executemany("DELETE FROM blobs WHERE hash = ?", [(x,) for x in digests])
+
+    def evict(self):
+        """Drop the old results and the least recently used blobs until they fit in 90% of `max_bytes`"""
+        conn = self._connection()
+        conn.execute("DELETE FROM results WHERE last_access < ?", (time.time() - MAX_AGE,))
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+        with self._lock:
+            self._bytes = total
+        if total <= self.max_bytes:
+            return
+        target = total - int(self.max_bytes * 0.9)
+        freed = 0
+        stale = []
+        for digest, size in conn.execute("SELECT hash, size FROM blobs ORDER BY last_access"):
+            stale.append(digest)
+            freed += size
+            if freed >= target:
+                break
+        self._drop(stale)
+        with self._lock:
+            self._bytes = total - freed
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+Statistics of image optimization stages and a cost/benefit gate learned from them
+Every stage run records the features of its input (dimensions, bytes per pixel, JPEG quality,
+palette size, previous optimizer) with the bytes it saved and the CPU time it took.
+Files are grouped in coarse buckets of similar features, a stage whose expected saving per
+CPU second in the bucket of a file is below a threshold is skipped.
+"""
+
+import math
+import os
+import random
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from pathlib import Path
+from typing import Callable, Iterable, List, Optional
+from utils import cbz, common, jpeg, png, proc, resources
+
+# Samples needed in a bucket before the gate trusts it
+MIN_SAMPLES = 5
+# Share of the gated stages which still run to keep learning
+EXPLORATION = 0.05
+# Samples and history older than this are dropped, when a store is first used and then every PRUNE_INTERVAL records
+MAX_AGE = 180 * 86400
+PRUNE_INTERVAL = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS samples (
+    tool TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    bucket TEXT NOT NULL,
+    megapixels REAL NOT NULL,
+    bytes_in INTEGER NOT NULL,
+    bytes_saved INTEGER NOT NULL,
+    cpu REAL NOT NULL,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS samples_bucket ON samples (tool, stage, bucket);
+CREATE TABLE IF NOT EXISTS history (
+    path TEXT PRIMARY KEY,
+    stage TEXT NOT NULL,
+    updated REAL NOT NULL DEFAULT 0
+);
+"""
+
+Features = namedtuple('Features', ['width', 'height', 'size', 'bpp', 'quality', 'palette', 'previous'])
+Prediction = namedtuple('Prediction', ['bytes_saved', 'cpu', 'samples'])
+
+
+def jpeg_features(infos: jpeg.JpegInfo, size: int, previous: str) -> Features:
+    """Features of a JPEG of `size` bytes from its headers"""
+    return Features(infos.width, infos.height, size, size * 8 / max(infos.width * infos.height, 1), infos.estimate_quality(), 0, previous)
+
+
+def jpeg_file_features(path: Path, previous: str) -> Features:
+    """Features of a JPEG file from its headers, None if it cannot be read"""
+    try:
+        return jpeg_features(jpeg.read_info(path), path.stat().st_size, previous)
+    except (jpeg.JpegError, OSError):
+        return None
+
+
+def png_features(path: Path, previous: str) -> Features:
+    """Features of a PNG file from its chunks, None if it cannot be read"""
+    try:
+        size = path.stat().st_size
+        infos = png.read_info(path)
+    except (png.PngError, OSError):
+        return None
+    palette = infos.palette_size if infos.palette_size > 0 else -infos.bits_per_pixel()
+    return Features(infos.width, infos.height, size, size * 8 / max(infos.width * infos.height, 1), None, palette, previous)
+
+
+def bucket(features: Features, stage: str) -> str:
+    """Coarse group of files expected to behave the same under `stage`"""
+    bpp = int(round(math.log2(max(features.bpp, 1 / 64))))
+    quality = features.quality // 10 if features.quality is not None else -1
+    # Palette images by size, truecolor ones by their bit depth (negative)
+    palette = int(math.log2(features.palette)) if features.palette > 0 else features.palette
+    return f"{bpp}:{quality}:{palette}:{int(features.previous == stage)}"
+
+
+def cpu_seconds(res: proc.CommandResult) -> float:
+    """CPU time of a command as measured, estimated from its wall time and the cores it is declared to keep busy if it was not"""
+    if res.cpu is not None:
+        return res.cpu
+    return res.elapsed * max(resources.cost_for(res.args).cpu, 1)
+
+
+class StatsStore:
+    """SQLite store of the stage outcomes, safe to share between threads"""
+
+    def __init__(self, tool: str, db_path: Path = None):
+        self.tool = tool
+        self.db_path = db_path if db_path is not None else common.cache_dir() / "optimstats.sqlite"
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._records = 0
+
+    def _connection(self) -> sqlite3.Connection:
+        """One connection per thread (and per process after a fork)"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(str(self.db_path), timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            if "updated" not in [x[1] for x in conn.execute("PRAGMA table_info(history)")]:
+                # Created before the history was pruned, its entries go at the next pruning
+                conn.execute("ALTER TABLE history ADD COLUMN updated REAL NOT NULL DEFAULT 0")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def previous(self, path: Path) -> str:
+        """Last stage which made `path` smaller, empty if none"""
+        row = self._connection().execute("SELECT stage FROM history WHERE path = ?", (os.path.abspath(path),)).fetchone()
+        return row[0] if row is not None else ""
+
+    def record(self, path: Path, stage: str, features: Features, bytes_saved: int, cpu: float):
+        """Store the outcome of `stage` on `path`"""
+        if features is None:
+            return
+        conn = self._connection()
+        conn.execute("INSERT INTO samples (tool, stage, bucket, megapixels, bytes_in, bytes_saved, cpu, created) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                     (self.tool, stage, bucket(features, stage), features.width * features.height / 1000000, features.size, max(bytes_saved, 0), cpu, time.time()))
+        # Scratch files of the archives are never seen again
+        if bytes_saved > 0 and cbz.is_scratch(path) is False:
+            conn.execute("INSERT OR REPLACE INTO history (path, stage, updated) VALUES (?, ?, ?)", (os.path.abspath(path), stage, time.time()))
+        with self._lock:
+            self._records += 1
+            prune = self._records % PRUNE_INTERVAL == 1
+        if prune is True:
+            self.prune()
+
+    def prune(self):
+        """Drop the samples and the history older than `MAX_AGE`"""
+        conn = self._connection()
+        limit = time.time() - MAX_AGE
+        conn.execute("DELETE FROM samples WHERE created < ?", (limit,))
+        conn.execute("DELETE FROM history WHERE updated < ?", (limit,))
+
+    def predict(self, stage: str, features: Features) -> Optional[Prediction]:
+        """Expected bytes saved and CPU seconds of `stage` on a file, None without enough samples"""
+        count, megapixels, bytes_in, saved, cpu = self._connection().execute(
+            "SELECT COUNT(*), SUM(megapixels), SUM(bytes_in), SUM(bytes_saved), SUM(cpu) FROM samples WHERE tool = ? AND stage = ? AND bucket = ?",
+            (self.tool, stage, bucket(features, stage))).fetchone()
+        if count < MIN_SAMPLES or not megapixels or not bytes_in:
+            return None
+        # Savings scale with the file size, CPU time with the number of pixels
+        return Prediction(saved / bytes_in * features.size, cpu / megapixels * features.width * features.height / 1000000, count)
+
+
+def schedule(paths: List[Path], store: "StatsStore", stages: List[str], features_of: Callable[[Path, str], Features], first: Iterable[str] = ()) -> List[Path]:
+    """Order `paths` by expected bytes saved per CPU second over `stages`, the ones in `first` (absolute paths) before all.
+    Files without prediction get the median rate of the others"""
+    first = set(first)
+    rates = {}
+    for path in paths:
+        features = features_of(path, store.previous(path))
+        predictions = [store.predict(x, features) for x in stages] if features is not None else []
+        predictions = [x for x in predictions if x is not None]
+        if predictions:
+            rates[path] = sum(x.bytes_saved for x in predictions) / max(sum(x.cpu for x in predictions), 0.001)
+    known = sorted(rates.values())
+    default = known[len(known) // 2] if known else 0
+    return sorted(paths, key=lambda x: (os.path.abspath(x) not in first, -rates.get(x, default)))
+
+
+class Gate:
+    """Skip the stages whose expected saving per CPU second is below `threshold` bytes, 0 never skips"""
+
+    def __init__(self, store: StatsStore, threshold: float):
+        self.store = store
+        self.threshold = threshold
+        self.skipped = 0
+        self.cpu_saved = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self, stage: str, features: Features) -> bool:
+        """Check if `stage` is worth running on a file with `features`"""
+        if self.threshold <= 0 or features is None:
+            return True
+        prediction = self.store.predict(stage, features)
+        if prediction is None or prediction.bytes_saved >= self.threshold * max(prediction.cpu, 0.001):
+            return True
+        if random.random() < EXPLORATION:
+            return True
+        with self._lock:
+            self.skipped += 1
+            self.cpu_saved += prediction.cpu
+        return False
+
+    def filter(self, stages: List[str], features: Features) -> List[str]:
+        """`stages` worth running"""
+        return [x for x in stages if self.allow(x, features) is True]
+
+    def summary(self) -> str:
+        """What the gate skipped"""
+        return f"{self.skipped} stage{'s' if self.skipped != 1 else ''} skipped by the gate, ~{self.cpu_saved:4.2f} CPU seconds saved"
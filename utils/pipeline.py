@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+Streaming stage pipeline
+Each item goes through the stages one after the other as soon as the previous stage is done with it,
+all the stages share one thread pool. Later stages are scheduled before new items are admitted,
+so only a few items are in flight at once and memory stays flat on long runs.
+"""
+
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Dict, Iterable, List, Tuple
+from utils import common
+
+
+class StageStats:
+    """Throughput of a stage"""
+    __slots__ = ("name", "count", "failures", "busy", "first_start", "last_end")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.count = 0
+        self.failures = 0
+        self.busy = 0.0
+        self.first_start = None
+        self.last_end = None
+
+    def add(self, t_start: float, t_end: float, failed: bool):
+        """Account one run of the stage"""
+        self.count += 1
+        self.failures += 1 if failed is True else 0
+        self.busy += t_end - t_start
+        self.first_start = t_start if self.first_start is None else min(self.first_start, t_start)
+        self.last_end = t_end if self.last_end is None else max(self.last_end, t_end)
+
+    def __str__(self):
+        span = (self.last_end - self.first_start) if self.count > 0 else 0
+        rate = self.count / span if span > 0 else 0
+        return f"{self.name}: {self.count} item{'s' if self.count != 1 else ''} in {span:4.2f}s ({rate:4.2f}/s, {self.busy:4.2f}s busy, {self.failures} failed)"
+
+
+class Pipeline:
+    """Linear stages (name, fct). `fct` receives the output of the previous stage (the item for the first one),
+    returning None stops the item there."""
+
+    def __init__(self, stages: List[Tuple[str, Callable]], max_workers: int = 0):
+        self.stages = stages
+        self.workers = common.pool_size(None, max_workers)
+        self.stats: Dict[str, StageStats] = {name: StageStats(name) for name, _ in stages}
+        self._stats_lock = threading.Lock()
+
+    def _run_stage(self, index: int, value):
+        name, fct = self.stages[index]
+        t_start = time.time()
+        failed = True
+        try:
+            value = fct(value)
+            failed = False
+            return value
+        finally:
+            t_end = time.time()
+            with self._stats_lock:
+                self.stats[name].add(t_start, t_end, failed)
+
+    def run(self, items: Iterable) -> Tuple[List[common.JobResult], float]:
+        """Stream `items` through the stages, returns the outcome of each item (value of the last stage it reached) and the elapsed time"""
+        t_start = time.time()
+        results: List[common.JobResult] = []
+        iterator = iter(items)
+        exhausted = False
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="stage") as pool:
+            # future → (stage index, item, time the item entered the pipeline)
+            pending = {}
+            while True:
+                while exhausted is False and len(pending) < self.workers * 2:
+                    try:
+                        item = next(iterator)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    pending[pool.submit(self._run_stage, 0, item)] = (0, item, time.time())
+                if len(pending) == 0:
+                    break
+                done, _ = wait(list(pending.keys()), return_when=FIRST_COMPLETED)
+                for future in done:
+                    index, item, t_item = pending.pop(future)
+                    try:
+                        value = future.result()
+                    except Exception as e:  # pylint: disable=broad-except
+                        results.append(common.JobResult(item, None, -1, e, time.time() - t_item))
+                        continue
+                    if value is None or index + 1 == len(self.stages):
+                        results.append(common.JobResult(item, value, 0, None, time.time() - t_item))
+                        continue
+                    pending[pool.submit(self._run_stage, index + 1, value)] = (index + 1, item, t_item)
+        return results, time.time() - t_start
+
+    def report(self) -> List[str]:
+        """Throughput of each stage"""
+        return [str(self.stats[name]) for name, _ in self.stages]
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+PNG chunk reader
+Chunks are listed from their headers, only the small ones describing the image are read.
+"""
+
+import struct
+from collections import namedtuple
+from pathlib import Path
+from typing import BinaryIO, Iterator, List
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1A\n"
+
+COLOR_GREY = 0
+COLOR_RGB = 2
+COLOR_PALETTE = 3
+COLOR_GREY_ALPHA = 4
+COLOR_RGBA = 6
+
+CHANNELS = {
+    COLOR_GREY: 1,
+    COLOR_RGB: 3,
+    COLOR_PALETTE: 1,
+    COLOR_GREY_ALPHA: 2,
+    COLOR_RGBA: 4,
+}
+
+# `offset` of the length field, `size` of the chunk data (length, type and crc excluded)
+Chunk = namedtuple('Chunk', ['type', 'offset', 'size'])
+
+
+class PngError(Exception):
+    """Raised for files which are not valid PNG"""
+
+
+class PngInfo:
+    """What the PNG chunks tell about the image"""
+    __slots__ = ("width", "height", "bit_depth", "color_type", "interlaced", "palette_size", "has_transparency", "chunks")
+
+    def __init__(self):
+        self.width = 0
+        self.height = 0
+        self.bit_depth = 8
+        self.color_type = COLOR_RGB
+        self.interlaced = False
+        self.palette_size = 0
+        self.has_transparency = False
+        self.chunks: List[Chunk] = []
+
+    def __repr__(self):
+        return f"{self.width}x{self.height} {self.bit_depth}bits color type {self.color_type}"
+
+    def bits_per_pixel(self) -> int:
+        """Uncompressed bits per pixel"""
+        return CHANNELS.get(self.color_type, 4) * self.bit_depth
+
+
+def iter_chunks(f: BinaryIO) -> Iterator[Chunk]:
+    """Chunks of the PNG stream `f` positioned after the signature, up to IEND"""
+    while True:
+        offset = f.tell()
+        header = f.read(8)
+        if len(header) != 8:
+            raise PngError("Truncated PNG")
+        size, ctype = struct.unpack(">I4s", header)
+        yield Chunk(ctype, offset, size)
+        if ctype == b"IEND":
+            return
+        # data and crc
+        f.seek(offset + 12 + size)
+
+
+def parse(f: BinaryIO) -> PngInfo:
+    """Read the chunks of the PNG stream `f`"""
+    if f.read(8) != PNG_SIGNATURE:
+        raise PngError("Missing PNG signature")
+    info = PngInfo()
+    for chunk in iter_chunks(f):
+        info.chunks.append(chunk)
+        if chunk.type == b"IHDR":
+            data = f.read(13)
+            if len(data) != 13:
+                raise PngError("Invalid IHDR")
+            info.width, info.height, info.bit_depth, info.color_type, _, _, interlace = struct.unpack(">IIBBBBB", data)
+            info.interlaced = interlace == 1
+        elif chunk.type == b"PLTE":
+            info.palette_size = chunk.size // 3
+        elif chunk.type == b"tRNS":
+            info.has_transparency = True
+    if not info.chunks or info.chunks[0].type != b"IHDR":
+        raise PngError("IHDR must be the first chunk")
+    return info
+
+
+def read_info(path: Path) -> PngInfo:
+    """Chunks of the PNG file at `path`"""
+    with open(path, "rb") as f:
+        return parse(f)
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+Lossless PNG reductions, detected with NumPy on the decoded pixels
+- RGBA / grey+alpha with an opaque alpha channel → RGB / grey
+- RGB(A) with R = G = B → grey(+alpha)
+- RGB(A) with 256 colors or less → palette (with tRNS), at the smallest bit depth
+- 16 bits grey holding 8 bits values → 8 bits grey
+The reduced image is only kept if smaller, the external optimizers then start from it.
+"""
+
+import shutil
+from pathlib import Path
+from typing import Optional, Tuple
+import numpy
+from PIL import Image, PngImagePlugin  # pip3 install Pillow
+from utils import png
+
+MAX_PALETTE = 256
+# Rows looked at before counting the colors of the whole image
+PALETTE_PROBE_ROWS = 64
+# Chunks carried over verbatim, files with other ancillary chunks (gAMA, sRGB, tRNS, APNG…) are left alone
+COPIED_CHUNKS = (b"tEXt", b"zTXt", b"iTXt", b"pHYs", b"eXIf")
+SAFE_CHUNKS = (b"IHDR", b"IDAT", b"IEND", b"iCCP") + COPIED_CHUNKS
+
+
+def _palette(pixels: numpy.ndarray) -> Optional[Tuple[numpy.ndarray, numpy.ndarray]]:
+    """(indices, RGBA colors) of (h, w, 4) `pixels` if they hold 256 colors or less, transparent colors first"""
+    packed = numpy.ascontiguousarray(pixels).view(numpy.uint32)[:, :, 0]
+    if len(numpy.unique(packed[:PALETTE_PROBE_ROWS])) > MAX_PALETTE:
+        return None
+    colors, inverse = numpy.unique(packed, return_inverse=True)
+    if len(colors) > MAX_PALETTE:
+        return None
+    colors = colors.view(numpy.uint8).reshape(-1, 4)
+    # tRNS only needs the entries up to the last transparent one
+    order = numpy.argsort(colors[:, 3], kind="stable")
+    rank = numpy.empty_like(order)
+    rank[order] = numpy.arange(len(order))
+    return rank[inverse.reshape(packed.shape)].astype(numpy.uint8), colors[order]
+
+
+def reduce_image(img: Image.Image, has_icc: bool) -> Optional[Tuple[Image.Image, dict]]:
+    """Losslessly reduced copy of `img` and its save options, None if it cannot be reduced"""
+    if img.mode in ("I;16", "I;16B", "I"):
+        pixels = numpy.asarray(img)
+        if numpy.all(pixels % 257 == 0):
+            return Image.fromarray((pixels // 257).astype(numpy.uint8), "L"), {}
+        return None
+    if img.mode not in ("RGB", "RGBA", "LA"):
+        return None
+    pixels = numpy.asarray(img)
+    mode = img.mode
+    reduced = False
+    if mode in ("RGBA", "LA") and numpy.all(pixels[:, :, -1] == 255):
+        pixels = pixels[:, :, 0] if mode == "LA" else pixels[:, :, :3]
+        mode = mode[:-1]
+        reduced = True
+    if mode in ("RGB", "RGBA"):
+        # An RGB profile does not apply to grey images
+        if has_icc is False and numpy.array_equal(pixels[:, :, 0], pixels[:, :, 1]) and numpy.array_equal(pixels[:, :, 0], pixels[:, :, 2]):
+            pixels = pixels[:, :, [0, 3]] if mode == "RGBA" else pixels[:, :, 0]
+            return Image.fromarray(numpy.ascontiguousarray(pixels), "LA" if mode == "RGBA" else "L"), {}
+        rgba = pixels if mode == "RGBA" else numpy.dstack([pixels, numpy.full(pixels.shape[:2], 255, numpy.uint8)])
+        palette = _palette(rgba)
+        if palette is not None:
+            indices, colors = palette
+            ret = Image.fromarray(indices, "P")
+            ret.putpalette(colors[:, :3].tobytes())
+            options = {"bits": next(b for b in (1, 2, 4, 8) if len(colors) <= 1 << b)}
+            transparent = numpy.flatnonzero(colors[:, 3] != 255)
+            if len(transparent) > 0:
+                options["transparency"] = colors[:transparent[-1] + 1, 3].tobytes()
+            return ret, options
+    if reduced is False:
+        return None
+    return Image.fromarray(numpy.ascontiguousarray(pixels), mode), {}
+
+
+def reduce_file(path: Path) -> int:
+    """Reduce the PNG at `path` in place if it gets smaller, returns the bytes saved"""
+    try:
+        infos = png.read_info(path)
+    except (png.PngError, OSError):
+        return 0
+    # Pillow reads 16 bits color images as 8 bits, and palettes are already reduced
+    if any(x.type not in SAFE_CHUNKS for x in infos.chunks) or infos.color_type == png.COLOR_PALETTE or (infos.bit_depth == 16 and infos.color_type != png.COLOR_GREY):
+        return 0
+    with Image.open(path) as img:
+        img.load()
+        icc = img.info.get("icc_profile")
+        res = reduce_image(img, icc is not None)
+    if res is None:
+        return 0
+    reduced, options = res
+    pnginfo = PngImagePlugin.PngInfo()
+    with open(path, "rb") as f:
+        for chunk in infos.chunks:
+            if chunk.type in COPIED_CHUNKS:
+                f.seek(chunk.offset + 8)
+                pnginfo.add(chunk.type, f.read(chunk.size))
+    tmpfile = path.with_name(f".{path.name}.tmp")
+    reduced.save(tmpfile, "PNG", compress_level=9, pnginfo=pnginfo, icc_profile=icc, **options)
+    saved = path.stat().st_size - tmpfile.stat().st_size
+    if saved <= 0:
+        tmpfile.unlink()
+        return 0
+    shutil.copymode(path, tmpfile)
+    tmpfile.replace(path)
+    return saved
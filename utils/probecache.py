@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+Persistent cache of media probes (ffmpeg -i, mkvmerge -J, mediainfo…)
+Entries are keyed by (kind, path, size, mtime_ns, inode) and stored in a SQLite database
+in the user cache directory, the least recently used entries are evicted past `max_bytes`.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Optional
+from utils import common
+
+DEFAULT_MAX_BYTES = 256 * 1048576
+# Do not rewrite the access time of an entry on every hit
+ACCESS_RESOLUTION = 86400
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS probes (
+    kind TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    bytes INTEGER NOT NULL,
+    last_access REAL NOT NULL,
+    PRIMARY KEY (kind, path)
+);
+CREATE INDEX IF NOT EXISTS probes_last_access ON probes (last_access);
+"""
+
+
+def file_key(path: Path) -> tuple:
+    """(size, mtime_ns, inode) of `path`, any change invalidates its entries"""
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns, st.st_ino
+
+
+class ProbeCache:
+    """SQLite backed probe cache, safe to share between threads and processes"""
+
+    def __init__(self, db_path: Path = None, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.db_path = db_path if db_path is not None else common.cache_dir() / "probes.sqlite"
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # Running total of the entries, loaded on the first insertion
+        self._bytes: int = None
+
+    def _connection(self) -> sqlite3.Connection:
+        """One connection per thread (and per process after a fork)"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(str(self.db_path), timeout=30, isolation_level=None, check_same_thread=False)
+            # WAL lets readers run while another process writes
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, kind: str, path: Path) -> Optional[str]:
+        """Cached `kind` probe of `path`, None if missing or stale"""
+        try:
+            key = file_key(path)
+        except OSError:
+            return None
+        conn = self._connection()
+        spath = os.path.abspath(path)
+        row = conn.execute("SELECT data, last_access FROM probes WHERE kind = ? AND path = ? AND size = ? AND mtime_ns = ? AND inode = ?",
+                           (kind, spath, *key)).fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        if now - row[1] > ACCESS_RESOLUTION:
+            conn.execute("UPDATE probes SET last_access = ? WHERE kind = ? AND path = ?", (now, kind, spath))
+        return row[0]
+
+    def put(self, kind: str, path: Path, data: str):
+        """Store the `kind` probe of `path`"""
+        try:
+            key = file_key(path)
+        except OSError:
+            return
+        conn = self._connection()
+        conn.execute("INSERT OR REPLACE INTO probes (kind, path, size, mtime_ns, inode, data, bytes, last_access) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                     (kind, os.path.abspath(path), *key, data, len(data), time.time()))
+        self._account(len(data))
+
+    def _account(self, added: int):
+        """Add `added` bytes to the running total and evict once it goes past `max_bytes`, the first call checks the size as found on disk.
+        Replaced entries are counted again so the total errs on the high side, `evict` resyncs it with the database"""
+        with self._lock:
+            if self._bytes is None:
+                # Already includes the entry just inserted
+                self._bytes = self._connection().execute("SELECT COALESCE(SUM(bytes), 0) FROM probes").fetchone()[0]
+            else:
+                self._bytes += added
+            over = self._bytes > self.max_bytes
+        if over is True:
+            self.evict()
+
+    def evict(self):
+        """Drop the least recently used entries until the cache is under 90% of `max_bytes`"""
+        conn = self._connection()
+        total = conn.execute("SELECT COALESCE(SUM(bytes), 0) FROM probes").fetchone()[0]
+        with self._lock:
+            self._bytes = total
+        if total <= self.max_bytes:
+            return
+        target = total - int(self.max_bytes * 0.9)
+        freed = 0
+        stale = []
+        for kind, path, size in conn.execute("SELECT kind, path, bytes FROM probes ORDER BY last_access"):
+            stale.append((kind, path))
+            freed += size
+            if freed >= target:
+                break
+        conn.executemany("DELETE FROM probes WHERE kind = ? AND path = ?", stale)
+        with self._lock:
+            self._bytes = total - freed
+
+
+ENABLED = True
+_CACHE: ProbeCache = None
+_LOCK = threading.Lock()
+
+
+def disable():
+    """Bypass the cache (--no-cache)"""
+    global ENABLED  # pylint: disable=global-statement
+    ENABLED = False
+
+
+def default() -> ProbeCache:
+    """Shared cache instance"""
+    global _CACHE  # pylint: disable=global-statement
+    with _LOCK:
+        if _CACHE is None:
+            _CACHE = ProbeCache()
+    return _CACHE
+
+
+def cached(kind: str, path: Path, compute: Callable[[], Optional[str]]) -> Optional[str]:
+    """Returns the cached `kind` probe of `path` or `compute()` it, a None result is not stored"""
+    if ENABLED is False:
+        return compute()
+    # A broken or locked cache must never prevent the probe
+    try:
+        data = default().get(kind, path)
+    except (sqlite3.Error, OSError):
+        data = None
+    if data is None:
+        data = compute()
+        if data is not None:
+            try:
+                default().put(kind, path, data)
+            except (sqlite3.Error, OSError):
+                pass
+    return data
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+Subprocess runner
+Commands are argv lists executed without a shell on a background asyncio loop,
+a semaphore caps the number of commands running at the same time and heavy programs
+go through the memory/CPU admission control of `utils.resources`.
+"""
+
+import asyncio
+import atexit
+import os
+import signal
+import sys
+import threading
+import time
+import warnings
+from collections import namedtuple
+from shlex import join
+from typing import Callable, Dict, List, Union
+from utils import common, resources
+
+# `cpu`: user + system seconds of the command and its children, None if it could not be measured
+CommandResult = namedtuple('CommandResult', ['args', 'returncode', 'stdout', 'stderr', 'elapsed', 'timed_out', 'cpu'], defaults=(None,))
+
+CHUNK_SIZE = 65536
+# How often `race` checks if a running command should be killed
+RACE_POLL_INTERVAL = 0.2
+# Each command leads its own process group so it can be killed with everything it spawned
+NEW_GROUP = {"process_group": 0} if sys.version_info >= (3, 11) else {"preexec_fn": os.setpgrp}
+
+# Process groups of the commands running, killed if the script is interrupted
+_GROUPS = set()
+_GROUPS_LOCK = threading.Lock()
+
+
+async def _pump(stream: asyncio.StreamReader, callback: Callable[[bytes], None], chunks: List[bytes]):
+    """Read `stream` until EOF, forwarding each chunk to `callback` and/or storing it in `chunks`"""
+    while True:
+        chunk = await stream.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        if callback is not None:
+            callback(chunk)
+        if chunks is not None:
+            chunks.append(chunk)
+
+
+async def _feed(stream: asyncio.StreamWriter, data: bytes):
+    """Write `data` to the stdin of a process and close it"""
+    try:
+        stream.write(data)
+        await stream.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        pass
+    finally:
+        stream.close()
+
+
+def _kill(process: asyncio.subprocess.Process):
+    """Kill `process` and everything it spawned"""
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def kill_all():
+    """Kill the commands still running and everything they spawned"""
+    with _GROUPS_LOCK:
+        groups = list(_GROUPS)
+    for pgid in groups:
+        try:
+            os.killpg(pgid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+
+def _on_signal(signum: int, frame):
+    """The commands are not in the foreground process group, they do not get the signals of the terminal"""
+    kill_all()
+    previous = _PREVIOUS_HANDLERS[signum]
+    if callable(previous) is True:
+        previous(signum, frame)
+    elif previous != signal.SIG_IGN:
+        signal.signal(signum, signal.SIG_DFL)
+        os.kill(os.getpid(), signum)
+
+
+_PREVIOUS_HANDLERS = {}
+if threading.current_thread() is threading.main_thread():
+    for _signum in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+        _PREVIOUS_HANDLERS[_signum] = signal.getsignal(_signum)
+        if _PREVIOUS_HANDLERS[_signum] != signal.SIG_IGN:
+            signal.signal(_signum, _on_signal)
+atexit.register(kill_all)
+
+
+class _RusageWatcher(asyncio.ThreadedChildWatcher):
+    """Child watcher reaping with `wait4`, which also gives the CPU time of the child"""
+
+    def __init__(self):
+        super().__init__()
+        self.cpu: Dict[int, float] = {}
+
+    def _do_waitpid(self, loop, expected_pid, callback, args):
+        try:
+            _, status, usage = os.wait4(expected_pid, 0)
+        except ChildProcessError:
+            returncode = 255
+        else:
+            returncode = os.waitstatus_to_exitcode(status)
+            self.cpu[expected_pid] = usage.ru_utime + usage.ru_stime
+        if loop.is_closed() is False:
+            loop.call_soon_threadsafe(callback, expected_pid, returncode, *args)
+        self._threads.pop(expected_pid, None)
+
+
+def _install_watcher() -> _RusageWatcher:
+    """Make asyncio reap the commands with `_RusageWatcher`, None where it has no child watchers anymore (3.14+)"""
+    if hasattr(asyncio, "set_child_watcher") is False:
+        return None
+    watcher = _RusageWatcher()
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)
+        asyncio.set_child_watcher(watcher)
+    return watcher
+
+
+_WATCHER = _install_watcher()
+
+
+def _cpu_of(pid: int) -> float:
+    """CPU time of the reaped child `pid`, None if unknown"""
+    return _WATCHER.cpu.pop(pid, None) if _WATCHER is not None else None
+
+
+class Runner:
+    """Execute commands on a dedicated event loop, at most `max_concurrent` at a time"""
+
+    def __init__(self, max_concurrent: int = 0, timeout: float = None, admission: resources.Admission = None):
+        self.max_concurrent = common.pool_size(None, max_concurrent)
+        self.timeout = timeout
+        self.admission = admission
+        self._loop: asyncio.AbstractEventLoop = None
+        self._semaphore: asyncio.Semaphore = None
+        self._lock = threading.Lock()
+
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        """Start the event loop thread on first use"""
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="proc", daemon=True).start()
+                self._loop = loop
+        return self._loop
+
+    async def _execute(self, args: List[str], stdin: bytes, timeout: float, capture: bool, on_stdout: Callable, on_stderr: Callable, cwd: str, env: dict, token: int) -> CommandResult:
+        """Spawn `args` and wait for it, killing it after `timeout` seconds"""
+        t_start = time.time()
+        out_chunks = [] if capture is True else None
+        err_chunks = [] if capture is True else None
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *args,
+                stdin=asyncio.subprocess.PIPE if stdin is not None else asyncio.subprocess.DEVNULL,
+                # Uncaptured output goes to the terminal, as with a shell
+                stdout=asyncio.subprocess.PIPE if capture is True or on_stdout is not None else None,
+                stderr=asyncio.subprocess.PIPE if capture is True or on_stderr is not None else None,
+                cwd=cwd, env=env, **NEW_GROUP)
+        except OSError as e:
+            # Same convention as the shell for a command that cannot be executed
+            return CommandResult(args, 127, b"", str(e).encode("utf-8"), time.time() - t_start, False)
+        with _GROUPS_LOCK:
+            _GROUPS.add(process.pid)
+        try:
+            return await self._wait(process, args, stdin, timeout, on_stdout, on_stderr, out_chunks, err_chunks, token, t_start)
+        finally:
+            with _GROUPS_LOCK:
+                _GROUPS.discard(process.pid)
+
+    async def _wait(self, process: asyncio.subprocess.Process, args: List[str], stdin: bytes, timeout: float, on_stdout: Callable, on_stderr: Callable, out_chunks: List[bytes], err_chunks: List[bytes], token: int, t_start: float) -> CommandResult:
+        """Feed and drain the running `process`, killing it after `timeout` seconds"""
+        if token is not None:
+            self.admission.attach(token, process.pid)
+
+        tasks = []
+        if process.stdin is not None:
+            tasks.append(asyncio.ensure_future(_feed(process.stdin, stdin)))
+        if process.stdout is not None:
+            tasks.append(asyncio.ensure_future(_pump(process.stdout, on_stdout, out_chunks)))
+        if process.stderr is not None:
+            tasks.append(asyncio.ensure_future(_pump(process.stderr, on_stderr, err_chunks)))
+
+        timed_out = False
+        try:
+            await asyncio.wait_for(process.wait(), timeout)
+        except asyncio.TimeoutError:
+            timed_out = True
+            _kill(process)
+            await process.wait()
+        except asyncio.CancelledError:
+            _kill(process)
+            await process.wait()
+            _cpu_of(process.pid)
+            raise
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        stdout = b"".join(out_chunks) if out_chunks is not None else b""
+        stderr = b"".join(err_chunks) if err_chunks is not None else b""
+        return CommandResult(args, process.returncode, stdout, stderr, time.time() - t_start, timed_out, _cpu_of(process.pid))
+
+    async def run_async(self, args: List[str], stdin: bytes = None, timeout: float = None, capture: bool = True, on_stdout: Callable = None, on_stderr: Callable = None, cwd: str = None, env: dict = None, cost: resources.JobCost = None) -> CommandResult:
+        """Coroutine version of `run`, must be awaited on the runner loop"""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrent)
+        args = [str(x) for x in args]
+        token = None
+        if self.admission is not None:
+            token = await self.admission.acquire(cost if cost is not None else resources.cost_for(args))
+        try:
+            async with self._semaphore:
+                return await self._execute(args, stdin, timeout if timeout is not None else self.timeout, capture, on_stdout, on_stderr, cwd, env, token)
+        finally:
+            if token is not None:
+                self.admission.release(token)
+
+    def run(self, args: List[str], stdin: bytes = None, timeout: float = None, capture: bool = True, on_stdout: Callable = None, on_stderr: Callable = None, cwd: str = None, env: dict = None, cost: resources.JobCost = None) -> CommandResult:
+        """Execute `args` and block until it exits, callable from any thread"""
+        loop = self._ensure_loop()
+        future = asyncio.run_coroutine_threadsafe(self.run_async(args, stdin, timeout, capture, on_stdout, on_stderr, cwd, env, cost), loop)
+        return future.result()
+
+    def run_many(self, commands: List[List[str]], timeout: float = None, capture: bool = True) -> List[CommandResult]:
+        """Execute all `commands` concurrently (within the runner limit), results are in the same order"""
+        loop = self._ensure_loop()
+
+        async def _gather():
+            return await asyncio.gather(*[self.run_async(args, timeout=timeout, capture=capture) for args in commands])
+        return asyncio.run_coroutine_threadsafe(_gather(), loop).result()
+
+    async def race_async(self, commands: List[List[str]], should_cancel: Callable[[int], bool], on_done: Callable[[int, CommandResult], None] = None, timeout: Union[float, List[float]] = None, capture: bool = True) -> List[CommandResult]:
+        """Coroutine version of `race`, must be awaited on the runner loop"""
+        timeouts = timeout if isinstance(timeout, list) else [timeout] * len(commands)
+        tasks = [asyncio.ensure_future(self.run_async(args, timeout=limit, capture=capture)) for args, limit in zip(commands, timeouts)]
+        index = {task: i for i, task in enumerate(tasks)}
+        results: List[CommandResult] = [None] * len(tasks)
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, timeout=RACE_POLL_INTERVAL, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.cancelled() is True:
+                    continue
+                results[index[task]] = task.result()
+                if on_done is not None:
+                    on_done(index[task], results[index[task]])
+            for task in pending:
+                if task.cancelled() is False and should_cancel(index[task]) is True:
+                    task.cancel()
+        return results
+
+    def race(self, commands: List[List[str]], should_cancel: Callable[[int], bool], on_done: Callable[[int, CommandResult], None] = None, timeout: Union[float, List[float]] = None, capture: bool = True) -> List[CommandResult]:
+        """Execute all `commands` concurrently, `should_cancel(i)` is polled while the i-th command runs and kills it when True.
+        `on_done(i, result)` is called as soon as a command exits, the result of a killed command is None. Callbacks run on the runner loop.
+        `timeout` is a single limit or one per command"""
+        loop = self._ensure_loop()
+        return asyncio.run_coroutine_threadsafe(self.race_async(commands, should_cancel, on_done, timeout, capture), loop).result()
+
+
+RUNNER = Runner(admission=resources.Admission())
+
+
+def configure(max_concurrent: int = 0, timeout: float = None, admission: bool = True):
+    """Replace the default runner"""
+    global RUNNER  # pylint: disable=global-statement
+    RUNNER = Runner(max_concurrent, timeout, resources.Admission() if admission is True else None)
+
+
+def run(args: List[str], stdin: bytes = None, timeout: float = None, capture: bool = True, on_stdout: Callable = None, on_stderr: Callable = None, cwd: str = None, env: dict = None, cost: resources.JobCost = None) -> CommandResult:
+    """Execute `args` with the default runner"""
+    return RUNNER.run(args, stdin, timeout, capture, on_stdout, on_stderr, cwd, env, cost)
+
+
+def run_many(commands: List[List[str]], timeout: float = None, capture: bool = True) -> List[CommandResult]:
+    """Execute `commands` concurrently with the default runner"""
+    return RUNNER.run_many(commands, timeout, capture)
+
+
+def race(commands: List[List[str]], should_cancel: Callable[[int], bool], on_done: Callable[[int, CommandResult], None] = None, timeout: Union[float, List[float]] = None, capture: bool = True) -> List[CommandResult]:
+    """Race `commands` with the default runner"""
+    return RUNNER.race(commands, should_cancel, on_done, timeout, capture)
+
+
+def check(res: CommandResult) -> bool:
+    """Report `res` if the command failed, returns True if it succeeded"""
+    if res.returncode == 0:
+        return True
+    reason = "timed out" if res.timed_out is True else f"exit status {res.returncode}"
+    print(f"{common.COLOR_RED}[!] ERROR: {common.COLOR_YELLOW}{describe(res.args)}{common.COLOR_RED} failed ({reason}){common.COLOR_WHITE}")
+    return False
+
+
+def describe(args: List[str]) -> str:
+    """Printable version of `args`"""
+    return join([str(x) for x in args])
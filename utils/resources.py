@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+Resource aware admission of external programs
+Each program declares an estimated peak RSS and the number of cores it keeps busy,
+a new command only starts when the free memory and the running commands leave enough headroom.
+"""
+
+import asyncio
+import multiprocessing
+import os
+import threading
+import time
+from collections import namedtuple
+from pathlib import Path
+from typing import Dict, List
+
+MB = 1048576
+
+JobCost = namedtuple('JobCost', ['rss', 'cpu'])
+
+# Light commands (probes, metadata editing…) are always admitted
+DEFAULT_COST = JobCost(0, 0)
+
+JOB_COSTS: Dict[str, JobCost] = {
+    str('7zz'): JobCost(768 * MB, 2),
+    str('afconvert'): JobCost(128 * MB, 1),
+    str('cjxl'): JobCost(512 * MB, 1),
+    str('djxl'): JobCost(256 * MB, 1),
+    str('ffmpeg'): JobCost(256 * MB, 1),
+    str('guetzli'): JobCost(2048 * MB, 1),
+    str('jpegtran'): JobCost(64 * MB, 1),
+    str('magick'): JobCost(512 * MB, 1),
+    str('optipng'): JobCost(128 * MB, 1),
+    str('pngquant'): JobCost(128 * MB, 1),
+    str('zopflipng'): JobCost(512 * MB, 1),
+}
+
+POLL_INTERVAL = 0.25
+
+
+def cost_for(args: List[str]) -> JobCost:
+    """Returns the declared cost of the command `args`"""
+    return JOB_COSTS.get(Path(str(args[0])).name, DEFAULT_COST)
+
+
+def read_meminfo() -> Dict[str, int]:
+    """Parse /proc/meminfo, values in bytes. Empty on systems without procfs"""
+    ret: Dict[str, int] = {}
+    try:
+        with open("/proc/meminfo", "r", encoding="utf-8") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                fields = value.split()
+                if fields:
+                    ret[key] = int(fields[0]) * (1024 if len(fields) > 1 else 1)
+    except OSError:
+        pass
+    return ret
+
+
+def process_rss(pid: int) -> int:
+    """Current resident set size of `pid` in bytes, 0 if unknown"""
+    try:
+        with open(f"/proc/{pid}/statm", "r", encoding="utf-8") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, IndexError, ValueError):
+        return 0
+
+
+class Admission:
+    """Gate commands on CPU and memory headroom, must be used from a single event loop"""
+
+    def __init__(self, cpu_limit: int = 0, reserve: int = None):
+        self.cpu_limit = cpu_limit if cpu_limit > 0 else multiprocessing.cpu_count()
+        if reserve is None:
+            # Keep 10% of the RAM (at least 512Mb) for the system and page cache
+            total = read_meminfo().get("MemTotal", 0)
+            reserve = max(int(total / 10), 512 * MB)
+        self.reserve = reserve
+        self._running: Dict[int, list] = {}
+        self._next_token = 0
+
+    def _fits(self, cost: JobCost) -> bool:
+        """Check if a job of `cost` can start now"""
+        if len(self._running) == 0:
+            # Never starve, a lone job always runs
+            return True
+        cpu = sum(job[0].cpu for job in self._running.values())
+        if cost.cpu > 0 and cpu + cost.cpu > self.cpu_limit:
+            return False
+        if cost.rss == 0:
+            return True
+        available = read_meminfo().get("MemAvailable")
+        if available is None:
+            return True
+        # Memory the running jobs did not claim yet but are expected to
+        growth = sum(max(job[0].rss - process_rss(job[1]), 0) for job in self._running.values() if job[1] is not None)
+        growth += sum(job[0].rss for job in self._running.values() if job[1] is None)
+        return available - growth - cost.rss >= self.reserve
+
+    async def acquire(self, cost: JobCost) -> int:
+        """Wait until a job of `cost` is admitted, returns a token for `attach` and `release`"""
+        while self._fits(cost) is False:
+            await asyncio.sleep(POLL_INTERVAL)
+        token = self._next_token
+        self._next_token += 1
+        self._running[token] = [cost, None]
+        return token
+
+    def attach(self, token: int, pid: int):
+        """Associate the process `pid` to an admitted job so its live RSS is accounted"""
+        if token in self._running:
+            self._running[token][1] = pid
+
+    def release(self, token: int):
+        """The job is done"""
+        self._running.pop(token, None)
+
+
+class Budget:
+    """Wall clock and CPU seconds allowed to a run, with the time limit of each program. None means unlimited"""
+
+    def __init__(self, wall: float = None, cpu: float = None, timeouts: Dict[str, float] = None, default_timeout: float = None):
+        self.wall = wall
+        self.cpu = cpu
+        self.timeouts = timeouts if timeouts is not None else {}
+        self.default_timeout = default_timeout
+        self.t_start = time.time()
+        self.cpu_used = 0.0
+        self.unreached: List[Path] = []
+        self._lock = threading.Lock()
+
+    def is_limited(self) -> bool:
+        """Check if the run has a wall clock or CPU budget"""
+        return self.wall is not None or self.cpu is not None
+
+    def remaining_wall(self) -> float:
+        """Seconds left, None if unlimited"""
+        return self.wall - (time.time() - self.t_start) if self.wall is not None else None
+
+    def exhausted(self) -> bool:
+        """Check if no new program should start"""
+        if self.wall is not None and self.remaining_wall() <= 0:
+            return True
+        return self.cpu is not None and self.cpu_used >= self.cpu
+
+    def charge(self, cpu: float):
+        """Account the CPU seconds of a finished program"""
+        with self._lock:
+            self.cpu_used += cpu
+
+    def timeout(self, program: str) -> float:
+        """Time limit of `program`, never past the end of the wall clock budget"""
+        limits = [x for x in (self.timeouts.get(program, self.default_timeout), self.remaining_wall()) if x is not None]
+        return max(min(limits), 0.001) if limits else None
+
+    def unreached_file(self, path: Path):
+        """`path` could not be fully processed within the budget"""
+        with self._lock:
+            self.unreached.append(path)
+
+
+def parse_timeouts(values: List[str]) -> Dict[str, float]:
+    """program=seconds list to dict"""
+    ret: Dict[str, float] = {}
+    for value in values or []:
+        program, _, seconds = value.partition("=")
+        ret[program.strip()] = float(seconds)
+    return ret
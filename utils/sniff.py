@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+File type sniffing from magic numbers
+All the signatures are compiled in a prefix trie, a file is classified with a single
+read of the longest prefix any signature needs.
+"""
+
+import os
+import stat
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+from utils import common
+
+TYPE_JPEG = str("jpeg")
+TYPE_PNG = str("png")
+TYPE_FLAC = str("flac")
+TYPE_EBML = str("ebml")
+TYPE_MP4 = str("mp4")
+TYPE_WAV = str("wav")
+
+# None matches any byte
+SIGNATURES: List[Tuple[list, str]] = [
+    # JFIF, EXIF, ICC, Adobe and raw (quantization table first) JPEG
+    ([0xFF, 0xD8, 0xFF, 0xE0], TYPE_JPEG),
+    ([0xFF, 0xD8, 0xFF, 0xE1], TYPE_JPEG),
+    ([0xFF, 0xD8, 0xFF, 0xE2], TYPE_JPEG),
+    ([0xFF, 0xD8, 0xFF, 0xEE], TYPE_JPEG),
+    ([0xFF, 0xD8, 0xFF, 0xDB], TYPE_JPEG),
+    (list(b"\x89PNG\r\n\x1A\n"), TYPE_PNG),
+    (list(b"fLaC"), TYPE_FLAC),
+    # Matroska, WebM
+    ([0x1A, 0x45, 0xDF, 0xA3], TYPE_EBML),
+    # Box size then ftyp (mp4, m4a, mov…)
+    ([None] * 4 + list(b"ftyp"), TYPE_MP4),
+    (list(b"RIFF") + [None] * 4 + list(b"WAVE"), TYPE_WAV),
+]
+
+# Key of the type stored in a trie node
+_LEAF = -1
+
+
+class Sniffer:
+    """Classify files against a set of signatures"""
+
+    def __init__(self, signatures: List[Tuple[list, str]]):
+        self.trie: Dict = {}
+        self.length = 0
+        for signature, file_type in signatures:
+            node = self.trie
+            for byte in signature:
+                node = node.setdefault(byte, {})
+            node[_LEAF] = file_type
+            self.length = max(self.length, len(signature))
+
+    def match(self, data: bytes) -> Optional[str]:
+        """Type of the longest signature `data` starts with, None if unknown"""
+        best = None
+        best_depth = -1
+        stack = [(self.trie, 0)]
+        while stack:
+            node, depth = stack.pop()
+            if _LEAF in node and depth > best_depth:
+                best, best_depth = node[_LEAF], depth
+            if depth >= len(data):
+                continue
+            exact = node.get(data[depth])
+            if exact is not None:
+                stack.append((exact, depth + 1))
+            wildcard = node.get(None)
+            if wildcard is not None:
+                stack.append((wildcard, depth + 1))
+        return best
+
+    def classify(self, path: Path, st: os.stat_result = None) -> Optional[str]:
+        """Type of the file at `path`, `st` (from the scanner) avoids opening empty files and directories"""
+        if st is not None and (stat.S_ISREG(st.st_mode) is False or st.st_size == 0):
+            return None
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            return None
+        try:
+            data = os.pread(fd, self.length, 0)
+        except OSError:
+            return None
+        finally:
+            os.close(fd)
+        return self.match(data)
+
+
+DEFAULT = Sniffer(SIGNATURES)
+
+
+def classify(path: Path, st: os.stat_result = None) -> Optional[str]:
+    """Type of the file at `path` with the default signatures"""
+    return DEFAULT.classify(path, st)
+
+
+def filter_for(types: List[str]) -> Callable[[common.ScanEntry], bool]:
+    """`scan_directory` filter keeping the files of `types`"""
+    wanted = set(types)
+    return lambda entry: DEFAULT.classify(entry.path, entry.stat) in wanted